@@ -0,0 +1,137 @@
+"""Summary statistics over raw samples, computed column-wise with NumPy.
+
+Samples are pulled as one float64 matrix (epoch milliseconds plus one
+column per requested metric, NaN where a value is missing) and every
+statistic is a vectorized reduction over it.
+"""
+import numpy as np
+
+# API metric name -> metrics table column
+STAT_METRICS = {
+    'cpu_percent': 'cpu_percent',
+    'gpu_percent': 'gpu_percent',
+    'ram_percent': 'ram_percent',
+    'ram_used_gb': 'ram_used_gb',
+    'ping_ms': 'ping_ms',
+}
+# Short names used by the charts and rollups
+METRIC_ALIASES = {'cpu': 'cpu_percent', 'gpu': 'gpu_percent', 'ram': 'ram_percent', 'ping': 'ping_ms'}
+DEFAULT_METRICS = ('cpu_percent', 'gpu_percent', 'ram_percent', 'ping_ms')
+DEFAULT_PERCENTILES = (50.0, 90.0, 95.0, 99.0)
+
+
+def resolve_metrics(value):
+    """Comma-separated metric names (or aliases) to column names; all defaults when empty."""
+    if not value:
+        return list(DEFAULT_METRICS)
+    metrics = []
+    for name in value.split(','):
+        name = METRIC_ALIASES.get(name.strip(), name.strip())
+        if name not in STAT_METRICS:
+            raise ValueError(f"Unknown metric '{name}', expected one of {', '.join(STAT_METRICS)}")
+        if name not in metrics:
+            metrics.append(name)
+    return metrics
+
+
+def parse_percentiles(value):
+    """Comma-separated percentiles in [0, 100]; DEFAULT_PERCENTILES when empty."""
+    if not value:
+        return list(DEFAULT_PERCENTILES)
+    try:
+        percentiles = [float(p) for p in value.split(',') if p.strip()]
+    except ValueError:
+        raise ValueError(f"Invalid percentiles '{value}', expected numbers between 0 and 100")
+    if not percentiles or any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError(f"Invalid percentiles '{value}', expected numbers between 0 and 100")
+    return percentiles
+
+
+def load_columns(pool, metrics, start, end, client_id=None, limit=5000000, fetch_size=50000, after_id=None):
+    """Samples in [start, end) as an (n, 1 + len(metrics)) float64 array, oldest first.
+
+    Column 0 is the sample time in epoch milliseconds. Rows are fetched in
+    ``fetch_size`` chunks straight into arrays, so no per-sample dicts are built.
+    With ``after_id`` only samples with a greater id are read.
+    """
+    columns = ', '.join(STAT_METRICS[metric] for metric in metrics)
+    present = ' OR '.join(f'{STAT_METRICS[metric]} IS NOT NULL' for metric in metrics)
+    where = 'timestamp >= ? AND timestamp < ?'
+    params = [limit]
+    if client_id:
+        where = 'client_id = ? AND ' + where
+        params.append(client_id)
+    params.extend([start, end])
+    if after_id is not None:
+        where += ' AND id > ?'
+        params.append(after_id)
+    chunks = []
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT TOP (?) DATEDIFF_BIG(millisecond, '1970-01-01', timestamp) AS t, {columns}
+            FROM metrics
+            WHERE {where} AND ({present})
+            ORDER BY timestamp
+        ''', params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            chunks.append(np.array([tuple(row) for row in rows], dtype=np.float64))
+    if not chunks:
+        return np.empty((0, 1 + len(metrics)), dtype=np.float64)
+    return np.concatenate(chunks)
+
+
+def columns_from_metrics(metrics_list, metrics, start, end):
+    """The same array as ``load_columns`` built from cached metric dicts."""
+    readers = {
+        'cpu_percent': lambda m: m.get('cpu_percent'),
+        'gpu_percent': lambda m: m.get('gpu_percent'),
+        'ram_percent': lambda m: (m.get('ram') or {}).get('percent'),
+        'ram_used_gb': lambda m: (m.get('ram') or {}).get('used_gb'),
+        'ping_ms': lambda m: m.get('ping_ms'),
+    }
+    data = np.empty((len(metrics_list), 1 + len(metrics)), dtype=np.float64)
+    data[:, 0] = np.array([m['timestamp'] for m in metrics_list], dtype='datetime64[ms]').astype(np.int64)
+    for i, metric in enumerate(metrics, 1):
+        data[:, i] = np.array([readers[metric](m) for m in metrics_list], dtype=np.float64)
+    bounds = np.array([start, end], dtype='datetime64[ms]').astype(np.int64)
+    keep = (data[:, 0] >= bounds[0]) & (data[:, 0] < bounds[1]) & ~np.isnan(data[:, 1:]).all(axis=1)
+    data = data[keep]
+    return data[np.argsort(data[:, 0], kind='stable')]
+
+
+def summarize(times_ms, values, percentiles=DEFAULT_PERCENTILES):
+    """count/mean/min/max/stddev/percentiles and rate of change of one column.
+
+    NaNs (missing values) are ignored. ``rate_of_change`` is the least-squares
+    slope per second over the window; ``net_change`` is last minus first.
+    """
+    present = ~np.isnan(values)
+    if present.all():
+        v, t = values, times_ms / 1000.0
+    else:
+        v, t = values[present], times_ms[present] / 1000.0
+    n = int(v.size)
+    if not n:
+        return {'count': 0}
+    mean = float(v.mean())
+    result = {
+        'count': n,
+        'mean': mean,
+        'min': float(v.min()),
+        'max': float(v.max()),
+        'stddev': float(v.std(ddof=1)) if n > 1 else 0.0,
+        'percentiles': {f'p{p:g}': float(q) for p, q in zip(percentiles, np.percentile(v, percentiles))},
+        'first': float(v[0]),
+        'last': float(v[-1]),
+        'net_change': float(v[-1] - v[0]),
+        'rate_of_change': None,
+    }
+    centered = t - t.mean()
+    spread = float(centered @ centered)
+    if spread > 0:
+        result['rate_of_change'] = float(centered @ (v - mean)) / spread
+    return result
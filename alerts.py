@@ -0,0 +1,399 @@
+"""Staleness and threshold alerts evaluated over in-memory client state.
+
+Threshold rules are written as ``<field> <op> <value> [for <duration>]``,
+for example ``cpu_percent > 90 for 5m`` or ``internet_connected == false``.
+A rule fires once every sample a client sent over ``duration`` breaches it
+and resolves with the first sample that does not. A client is stale when
+nothing has arrived from it for ``stale_intervals`` of its own upload
+intervals (estimated from arrival gaps). Alert transitions are handed to
+sinks: callables taking one event dict.
+"""
+import re
+import json
+import queue
+import threading
+import time
+import logging
+import traceback
+import urllib.request
+from collections import deque
+from datetime import datetime, timezone
+
+from leader_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+STALE_RULE = 'stale'
+
+# Rule field -> how to read it from a metric dict
+FIELDS = {
+    'cpu_percent': lambda m: m.get('cpu_percent'),
+    'gpu_percent': lambda m: m.get('gpu_percent'),
+    'ping_ms': lambda m: m.get('ping_ms'),
+    'ram_percent': lambda m: (m.get('ram') or {}).get('percent'),
+    'ram_used_gb': lambda m: (m.get('ram') or {}).get('used_gb'),
+    'internet_connected': lambda m: m.get('internet_connected'),
+}
+OPERATORS = {
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+_RULE_PATTERN = re.compile(r'^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(\S+)(?:\s+for\s+(\S+))?\s*$')
+
+
+class AlertRule:
+    """One threshold condition on a metric field, held for at least ``duration`` seconds."""
+
+    def __init__(self, field, op, threshold, duration=0.0, name=None):
+        if field not in FIELDS:
+            raise ValueError(f"Unknown alert field '{field}', expected one of {', '.join(FIELDS)}")
+        self.field = field
+        self.op = op
+        self.threshold = threshold
+        self.duration = duration
+        self._read = FIELDS[field]
+        self._compare = OPERATORS[op]
+        if name is None:
+            threshold_text = str(threshold).lower() if isinstance(threshold, bool) else f'{threshold:g}'
+            name = f"{field} {op} {threshold_text}" + (f" for {duration:g}s" if duration else '')
+        self.name = name
+
+    def value(self, metric):
+        return self._read(metric)
+
+    def breached(self, value):
+        return value is not None and self._compare(value, self.threshold)
+
+    def describe(self):
+        return {'name': self.name, 'field': self.field, 'op': self.op,
+                'threshold': self.threshold, 'for_seconds': self.duration}
+
+
+def parse_rules(spec, parse_duration):
+    """Parse ``;``-separated rule expressions; ``parse_duration`` turns '5m' into a timedelta."""
+    rules = []
+    for text in (spec or '').split(';'):
+        if not text.strip():
+            continue
+        match = _RULE_PATTERN.match(text)
+        if not match:
+            raise ValueError(f"Invalid alert rule '{text.strip()}', expected '<field> <op> <value> [for <duration>]'")
+        field, op, raw, duration = match.groups()
+        if raw.lower() in ('true', 'false'):
+            threshold = raw.lower() == 'true'
+        else:
+            try:
+                threshold = float(raw)
+            except ValueError:
+                raise ValueError(f"Invalid alert threshold '{raw}' in rule '{text.strip()}'")
+        seconds = parse_duration(duration).total_seconds() if duration else 0.0
+        name = f"{field} {op} {raw}" + (f" for {duration}" if duration else '')
+        rules.append(AlertRule(field, op, threshold, seconds, name))
+    return rules
+
+
+def _parse(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _format(value):
+    return value.isoformat(timespec='milliseconds') if value is not None else None
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class _Track:
+    """Per-client evaluation state."""
+    __slots__ = ('client_name', 'last_received', 'interval', 'breaches')
+
+    def __init__(self):
+        self.client_name = None
+        self.last_received = None
+        self.interval = None
+        # rule -> [first breaching sample time, last breaching sample time, last value]
+        self.breaches = {}
+
+
+class AlertEngine:
+    """Evaluate alert rules for every client and deliver transitions to sinks.
+
+    ``observe()`` is a recent-cache listener: it only updates per-client
+    breach windows and arrival-interval estimates, so it stays cheap on the
+    ingest path. A background loop calls ``evaluate()`` every ``interval``
+    seconds, which walks those windows plus ``client_states()`` (an
+    iterable of ``(client_id, client_name, last_received_at)``, normally the
+    client state index) and fires or resolves alerts.
+
+    Every worker evaluates so that ``/api/alerts`` is complete on each of
+    them, but only the worker holding an flock on ``lock_path`` (when given)
+    delivers events to the sinks, so each transition is sent once. Where
+    flock is unavailable every worker delivers; run a single worker there.
+
+    A client silent for more than ``stale_max_age`` seconds (0 or None: no
+    limit) is considered retired rather than stale: it gets no stale alert,
+    and an active one is moved to the history as ``retired`` without an
+    event, so decommissioned clients do not alert again after every restart.
+
+    ``delivered`` counts events the sinks accepted; sinks with a
+    ``stats()`` method (such as WebhookSink, which sends from a queue)
+    report their own outcome under ``sinks``.
+    """
+
+    def __init__(self, rules, client_states, sinks=(), interval=5.0, stale_intervals=5,
+                 min_stale_seconds=30.0, default_interval=30.0, history=500, lock_path=None,
+                 stale_max_age=7 * 86400.0):
+        self.rules = list(rules)
+        self._client_states = client_states
+        self._sinks = list(sinks)
+        self.interval = interval
+        self.stale_intervals = stale_intervals
+        self.min_stale_seconds = min_stale_seconds
+        self.default_interval = default_interval
+        self.stale_max_age = stale_max_age
+        self._leader = FileLock(lock_path, 'delivers alerts')
+        self._lock = threading.Lock()
+        self._tracks = {}
+        self._active = {}
+        self._history = deque(maxlen=history)
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self._evaluations = 0
+        self._fired = 0
+        self._resolved = 0
+        self._retired = 0
+        self._delivered = 0
+        self._delivery_failures = 0
+        self._last_eval_ms = 0.0
+        self._last_eval_clients = 0
+
+    # ---------- ingest side ----------
+    def observe(self, entries):
+        """Update breach windows and interval estimates from new (id, metric) pairs."""
+        with self._lock:
+            for _, metric in entries:
+                client_id = metric.get('client_id')
+                timestamp = _parse(metric.get('timestamp'))
+                if client_id is None or timestamp is None:
+                    continue
+                track = self._tracks.get(client_id)
+                if track is None:
+                    track = self._tracks[client_id] = _Track()
+                track.client_name = metric.get('client_name') or track.client_name
+
+                received = _parse(metric.get('received_at')) or timestamp
+                if track.last_received is not None and received > track.last_received:
+                    gap = (received - track.last_received).total_seconds()
+                    track.interval = gap if track.interval is None else 0.8 * track.interval + 0.2 * gap
+                if track.last_received is None or received > track.last_received:
+                    track.last_received = received
+
+                for rule in self.rules:
+                    value = rule.value(metric)
+                    window = track.breaches.get(rule)
+                    if rule.breached(value):
+                        if window is None:
+                            track.breaches[rule] = [timestamp, timestamp, value]
+                        elif timestamp >= window[1]:
+                            window[1], window[2] = timestamp, value
+                    elif window is not None and timestamp >= window[1]:
+                        del track.breaches[rule]
+
+    # ---------- evaluation ----------
+    def evaluate(self, now=None):
+        """Fire and resolve alerts; return the events produced."""
+        now = now or _utc_now()
+        started = time.perf_counter()
+        firing = {}
+        retired = set()
+        with self._lock:
+            tracks = self._tracks
+            for client_id, track in tracks.items():
+                for rule, (since, last, value) in track.breaches.items():
+                    if (last - since).total_seconds() >= rule.duration:
+                        firing[(client_id, rule.name)] = (track.client_name, since, value,
+                                                          f"{rule.field} is {value} ({rule.name})")
+            last_seen = {client_id: (client_name, last_received)
+                         for client_id, client_name, last_received in self._client_states()}
+            for client_id, track in tracks.items():
+                if track.last_received is None:
+                    continue
+                known = last_seen.get(client_id)
+                if known is None or track.last_received > known[1]:
+                    last_seen[client_id] = (track.client_name, track.last_received)
+            for client_id, (client_name, last_received) in last_seen.items():
+                track = tracks.get(client_id)
+                interval = track.interval if track is not None and track.interval else self.default_interval
+                stale_after = max(self.min_stale_seconds, self.stale_intervals * interval)
+                silent = (now - last_received).total_seconds()
+                if self.stale_max_age and silent > self.stale_max_age:
+                    retired.add((client_id, STALE_RULE))
+                elif silent > stale_after:
+                    firing[(client_id, STALE_RULE)] = (
+                        client_name, last_received, round(silent, 3),
+                        f"No sample for {silent:.0f}s (expected every {interval:.0f}s)")
+
+            events = []
+            for key, (client_name, since, value, message) in firing.items():
+                alert = self._active.get(key)
+                if alert is None:
+                    alert = self._active[key] = {
+                        'rule': key[1], 'client_id': key[0], 'client_name': client_name or key[0],
+                        'state': 'firing', 'since': _format(since), 'fired_at': _format(now),
+                        'value': value, 'message': message,
+                    }
+                    self._fired += 1
+                    events.append(dict(alert))
+                else:
+                    alert['value'], alert['message'] = value, message
+            for key in [key for key in self._active if key not in firing]:
+                alert = self._active.pop(key)
+                alert['state'] = 'retired' if key in retired else 'resolved'
+                alert['resolved_at'] = _format(now)
+                self._history.append(alert)
+                if key in retired:
+                    self._retired += 1
+                    continue
+                self._resolved += 1
+                events.append(dict(alert))
+
+            self._evaluations += 1
+            self._last_eval_clients = len(last_seen)
+            self._last_eval_ms = (time.perf_counter() - started) * 1000
+        return events
+
+    def alerts(self, client_id=None, include_resolved=False):
+        """Active alerts (and optionally recently resolved ones), newest first."""
+        with self._lock:
+            alerts = [dict(alert) for alert in self._active.values()]
+            if include_resolved:
+                alerts.extend(dict(alert) for alert in self._history)
+        if client_id:
+            alerts = [alert for alert in alerts if alert['client_id'] == client_id]
+        alerts.sort(key=lambda alert: alert.get('resolved_at') or alert['fired_at'], reverse=True)
+        return alerts
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rules': len(self.rules) + 1,
+                'active': len(self._active),
+                'evaluations': self._evaluations,
+                'fired': self._fired,
+                'resolved': self._resolved,
+                'retired': self._retired,
+                'delivering': self._leader.held,
+                'delivered': self._delivered,
+                'delivery_failures': self._delivery_failures,
+                'last_eval_clients': self._last_eval_clients,
+                'last_eval_ms': round(self._last_eval_ms, 3),
+                'sinks': {sink.name: sink.stats() for sink in self._sinks if hasattr(sink, 'stats')},
+            }
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='alert-engine', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        self._leader.release()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                events = self.evaluate()
+                if events and self._leader.acquire():
+                    self._deliver(events)
+            except Exception as e:
+                logger.error(f"✗ Alert evaluation failed: {str(e)}")
+                logger.error(traceback.format_exc())
+
+    def _deliver(self, events):
+        for event in events:
+            for sink in self._sinks:
+                try:
+                    sink(event)
+                    with self._lock:
+                        self._delivered += 1
+                except Exception as e:
+                    with self._lock:
+                        self._delivery_failures += 1
+                    logger.error(f"✗ Alert sink failed for {event['rule']} on {event['client_id']}: {str(e)}")
+
+
+def log_sink(event):
+    """Write alert transitions to the application log."""
+    if event['state'] == 'firing':
+        logger.warning(f"✗ ALERT {event['rule']} firing for {event['client_name']}: {event['message']}")
+    else:
+        logger.info(f"✓ ALERT {event['rule']} resolved for {event['client_name']}")
+
+
+class WebhookSink:
+    """POST each alert event as JSON to ``url`` from a background thread.
+
+    Events are queued so a slow endpoint never delays evaluation; when
+    ``max_queue`` events are already waiting, new ones are dropped.
+    ``stats()`` counts the POSTs that succeeded and failed.
+    """
+
+    name = 'webhook'
+
+    def __init__(self, url, timeout=5.0, max_queue=1000):
+        self.url = url
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+        self._last_error = None
+        self._thread = threading.Thread(target=self._run, name='alert-webhook', daemon=True)
+        self._thread.start()
+
+    def __call__(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            raise RuntimeError(f"Webhook queue full, dropping alert for {self.url}")
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            request = urllib.request.Request(self.url, data=json.dumps(event).encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'}, method='POST')
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    response.read()
+            except Exception as e:
+                with self._lock:
+                    self._failed += 1
+                    self._last_error = str(e)
+                logger.error(f"✗ Alert webhook {self.url} failed: {str(e)}")
+                continue
+            with self._lock:
+                self._sent += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'sent': self._sent,
+                'failed': self._failed,
+                'dropped': self._dropped,
+                'last_error': self._last_error,
+            }
@@ -1,29 +1,75 @@
-from flask import Flask, request, jsonify, render_template_string
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend
-import matplotlib.pyplot as plt
-import io
-import base64
-from datetime import datetime
-import pyodbc
+from flask import (Flask, request, jsonify, render_template_string, make_response, url_for,
+                   Response, stream_with_context, g)
+import hashlib
+import numpy as np
+from datetime import datetime, timedelta, timezone
 import json
 import os
 import logging
 import traceback
+import threading
+import time
+import atexit
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None  # only needed by the azuresql storage backend
+
+from aggregates import METRIC_ALIASES, columns_from_metrics, parse_percentiles, resolve_metrics, summarize
+from alerts import AlertEngine, WebhookSink, log_sink, parse_rules
+from charts import CHARTS, ChartCache, ChartRenderer, available_charts, chart_points, series_points
+from client_state import ClientStateIndex, describe_clients
+from db_pool import ConnectionPool
+from ingest import BatchWriter, QueueFull
+from log_pipeline import RateLimitedLog, configure_logging
+from live_stream import SampleBroadcaster, TooManySubscribers, sse_stream
+from recent_cache import RecentMetricsCache
+from spool import Spool
+from storage import AzureSQLStore, SQLiteStore
+from telemetry import CONTENT_TYPE as METRICS_CONTENT_TYPE, SIZE_BUCKETS, Registry, numeric_stats
+from tsdb import TimeSeriesStore
+from metric_counters import MetricCounters
+from retention import RetentionJob
+from rollups import RollupJob, RESOLUTIONS, choose_resolution
+from wire_format import BINARY_CONTENT_TYPES, WireFormatError, decode_body, decode_sample, decode_samples
+
+# Configure logging: records are queued and written to a file and stderr by a background
+# thread; LOG_FORMAT is 'json' (one object per line) or 'text'. Gunicorn workers must not
+# rotate one file between them, so by default each process writes its own app.<pid>.log,
+# rotated at LOG_MAX_BYTES; LOG_ROTATION=external shares app.log and leaves rotation to logrotate
+LOG_FILE = os.environ.get('LOG_FILE', 'app.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'info').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_ROTATION = os.environ.get('LOG_ROTATION', 'size').lower()
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Per-request success messages on the ingest path are logged at most once per interval
+LOG_SAMPLE_INTERVAL = float(os.environ.get('LOG_SAMPLE_INTERVAL', 10))
+
+log_pipeline = configure_logging(
+    LOG_FILE,
+    level=LOG_LEVEL,
+    fmt=LOG_FORMAT,
+    rotation=LOG_ROTATION,
+    max_bytes=LOG_MAX_BYTES,
+    backup_count=LOG_BACKUP_COUNT,
+    max_queue=LOG_QUEUE_SIZE
 )
 logger = logging.getLogger(__name__)
+received_log = RateLimitedLog(logger, LOG_SAMPLE_INTERVAL)
+batch_received_log = RateLimitedLog(logger, LOG_SAMPLE_INTERVAL)
+inserted_log = RateLimitedLog(logger, LOG_SAMPLE_INTERVAL)
 
 app = Flask(__name__)
 
+# Storage backend: 'azuresql' (the DB_* settings below) or 'sqlite' (a local WAL-mode file)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'azuresql').lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'metrics.db')
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 5))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+
 # Azure SQL Database configuration
 DB_SERVER = os.environ.get('DB_SERVER', 'sqldb-knowledgehub-01.database.windows.net')
 DB_NAME = os.environ.get('DB_NAME', 'sql-knowledgehub-01')
@@ -41,6 +87,133 @@ CONNECTION_STRING = (
     f'Connection Timeout=30;'
 )
 
+# Connection pool configuration
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))
+DB_POOL_VALIDATE_AFTER = float(os.environ.get('DB_POOL_VALIDATE_AFTER', 30))
+
+# Ingestion pipeline configuration
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', 1.0))
+INGEST_RETRY_AFTER = int(os.environ.get('INGEST_RETRY_AFTER', 5))
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 10000))
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+INGEST_MAX_DECODED_BYTES = int(os.environ.get('INGEST_MAX_DECODED_BYTES', 64 * 1024 * 1024))
+STORE_RAW_DATA = os.environ.get('STORE_RAW_DATA', 'true').lower() == 'true'
+
+# Write-ahead spool configuration (replaces the in-memory ingest queue when enabled)
+SPOOL_ENABLED = os.environ.get('SPOOL_ENABLED', 'true').lower() == 'true'
+SPOOL_DIR = os.environ.get('SPOOL_DIR', 'spool')
+SPOOL_SEGMENT_BYTES = int(os.environ.get('SPOOL_SEGMENT_BYTES', 16 * 1024 * 1024))
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 1024 * 1024 * 1024))
+SPOOL_FSYNC_INTERVAL = float(os.environ.get('SPOOL_FSYNC_INTERVAL', 0.05))
+SPOOL_MAX_RETRY_DELAY = float(os.environ.get('SPOOL_MAX_RETRY_DELAY', 30))
+
+# Recent metrics cache configuration
+RECENT_CACHE_SIZE = int(os.environ.get('RECENT_CACHE_SIZE', 1000))
+RECENT_CACHE_PER_CLIENT = int(os.environ.get('RECENT_CACHE_PER_CLIENT', 100))
+RECENT_CACHE_REFRESH_INTERVAL = float(os.environ.get('RECENT_CACHE_REFRESH_INTERVAL', 2.0))
+COUNTER_RECONCILE_INTERVAL = float(os.environ.get('COUNTER_RECONCILE_INTERVAL', 300))
+
+# Client state configuration
+CLIENT_OFFLINE_AFTER = float(os.environ.get('CLIENT_OFFLINE_AFTER', 120))
+CLIENT_STATE_RELOAD_INTERVAL = float(os.environ.get('CLIENT_STATE_RELOAD_INTERVAL', 300))
+
+# Alert configuration; rules are ';'-separated '<field> <op> <value> [for <duration>]'
+ALERTS_ENABLED = os.environ.get('ALERTS_ENABLED', 'true').lower() == 'true'
+ALERT_RULES = os.environ.get('ALERT_RULES', 'cpu_percent > 90 for 5m; internet_connected == false')
+ALERT_EVAL_INTERVAL = float(os.environ.get('ALERT_EVAL_INTERVAL', 5))
+ALERT_STALE_INTERVALS = float(os.environ.get('ALERT_STALE_INTERVALS', 5))
+ALERT_STALE_MIN_SECONDS = float(os.environ.get('ALERT_STALE_MIN_SECONDS', 30))
+ALERT_DEFAULT_INTERVAL = float(os.environ.get('ALERT_DEFAULT_INTERVAL', 30))
+# Clients silent for longer than this (seconds, 0 = never) count as retired and get no stale alert
+ALERT_STALE_MAX_AGE = float(os.environ.get('ALERT_STALE_MAX_AGE', 7 * 86400))
+ALERT_HISTORY = int(os.environ.get('ALERT_HISTORY', 500))
+ALERT_WEBHOOK_URL = os.environ.get('ALERT_WEBHOOK_URL', '')
+ALERT_LOCK_FILE = os.environ.get('ALERT_LOCK_FILE', 'alerts.lock')
+
+# Time-range query configuration
+RANGE_DEFAULT_WINDOW = timedelta(hours=float(os.environ.get('RANGE_DEFAULT_WINDOW_HOURS', 1)))
+RANGE_MAX_LIMIT = int(os.environ.get('RANGE_MAX_LIMIT', 10000))
+STREAM_MAX_LIMIT = int(os.environ.get('STREAM_MAX_LIMIT', 1000000))
+STREAM_FETCH_SIZE = int(os.environ.get('STREAM_FETCH_SIZE', 500))
+MIGRATION_CHUNK_SIZE = int(os.environ.get('MIGRATION_CHUNK_SIZE', 10000))
+STATS_MAX_SAMPLES = int(os.environ.get('STATS_MAX_SAMPLES', 5000000))
+STATS_FETCH_SIZE = int(os.environ.get('STATS_FETCH_SIZE', 50000))
+
+# Columnar time-series files (a derived copy of the numeric fields for stats and charts)
+TSDB_ENABLED = os.environ.get('TSDB_ENABLED', 'true').lower() == 'true'
+TSDB_DIR = os.environ.get('TSDB_DIR', 'tsdb')
+TSDB_CHUNK_POINTS = int(os.environ.get('TSDB_CHUNK_POINTS', 512))
+TSDB_MAX_HEAD_AGE = float(os.environ.get('TSDB_MAX_HEAD_AGE', 600))
+TSDB_INTERVAL = float(os.environ.get('TSDB_INTERVAL', 5))
+TSDB_BATCH_SIZE = int(os.environ.get('TSDB_BATCH_SIZE', 5000))
+# How often the writer drops chunks past the raw retention period
+TSDB_PRUNE_INTERVAL = float(os.environ.get('TSDB_PRUNE_INTERVAL', 3600))
+
+# Rollup configuration
+ROLLUP_ENABLED = os.environ.get('ROLLUP_ENABLED', 'true').lower() == 'true'
+ROLLUP_INTERVAL = float(os.environ.get('ROLLUP_INTERVAL', 60))
+ROLLUP_MIN_POINTS = int(os.environ.get('ROLLUP_MIN_POINTS', 200))
+# Only the worker holding this lock runs rollup passes
+ROLLUP_LOCK_FILE = os.environ.get('ROLLUP_LOCK_FILE', 'rollups.lock')
+
+# Retention configuration, in days per tier (0 keeps a tier forever)
+RETENTION_ENABLED = os.environ.get('RETENTION_ENABLED', 'true').lower() == 'true'
+RETENTION_RAW_DAYS = float(os.environ.get('RETENTION_RAW_DAYS', 30))
+# Stored agent payloads (raw_data) are kept as long as their rows unless this is set
+RETENTION_RAW_DATA_DAYS = float(os.environ.get('RETENTION_RAW_DATA_DAYS', 0))
+RETENTION_1M_DAYS = float(os.environ.get('RETENTION_1M_DAYS', 90))
+RETENTION_1H_DAYS = float(os.environ.get('RETENTION_1H_DAYS', 730))
+RETENTION_1D_DAYS = float(os.environ.get('RETENTION_1D_DAYS', 0))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 3600))
+RETENTION_CHUNK_SIZE = int(os.environ.get('RETENTION_CHUNK_SIZE', 4000))
+# Only the worker holding this lock purges
+RETENTION_LOCK_FILE = os.environ.get('RETENTION_LOCK_FILE', 'retention.lock')
+
+# Chart cache configuration
+CHART_CACHE_ENTRIES = int(os.environ.get('CHART_CACHE_ENTRIES', 256))
+CHART_CACHE_BYTES = int(os.environ.get('CHART_CACHE_BYTES', 32 * 1024 * 1024))
+CHART_MAX_AGE = int(os.environ.get('CHART_MAX_AGE', 10))
+CHART_RENDER_WORKERS = int(os.environ.get('CHART_RENDER_WORKERS', 2))
+# Windows whose charts are kept pre-rendered as new data lands (besides the default view)
+CHART_HOT_WINDOWS = frozenset(window.strip() for window in os.environ.get('CHART_HOT_WINDOWS', '15m,1h,6h,24h,7d').split(',')
+                              if window.strip())
+CHART_MODE = os.environ.get('CHART_MODE', 'client')  # 'client' draws in the browser, 'server' uses PNGs
+DASHBOARD_CHART_SAMPLES = 20
+
+# Live stream (Server-Sent Events) configuration
+SSE_BUFFER_SIZE = int(os.environ.get('SSE_BUFFER_SIZE', 256))
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', 1000))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+
+# Self-metrics (/metrics); clients beyond the limit share one ingest series
+METRICS_MAX_CLIENTS = int(os.environ.get('METRICS_MAX_CLIENTS', 10000))
+
+telemetry = Registry()
+request_seconds = telemetry.histogram(
+    'monitoring_http_request_duration_seconds', 'Time to handle a request, up to its response headers.',
+    ('method', 'route', 'status'))
+request_bytes = telemetry.histogram(
+    'monitoring_http_request_body_bytes', 'Request body sizes.', ('route',), buckets=SIZE_BUCKETS)
+response_bytes = telemetry.histogram(
+    'monitoring_http_response_body_bytes', 'Response body sizes (streamed responses are not counted).',
+    ('route',), buckets=SIZE_BUCKETS)
+db_connect_seconds = telemetry.histogram(
+    'monitoring_db_connect_duration_seconds', 'Time to open a new database connection.')
+db_query_seconds = telemetry.histogram(
+    'monitoring_db_query_duration_seconds', 'Time spent in the storage backend, by calling function.',
+    ('function',))
+chart_render_seconds = telemetry.histogram(
+    'monitoring_chart_render_duration_seconds', 'Time from submitting a chart render to its PNG.',
+    ('chart',))
+ingested_samples = telemetry.counter(
+    'monitoring_ingested_samples_total', 'Samples accepted for storage, by client.',
+    ('client_id',), max_series=METRICS_MAX_CLIENTS)
+
 max_entries = 100
 
 # HTML template with embedded table and charts
@@ -105,9 +278,10 @@ HTML_TEMPLATE = '''
             margin-bottom: 15px;
         }
 
-        .chart-container img {
+        .chart-container img, .chart-container canvas {
             width: 100%;
             border-radius: 10px;
+            background: #fff;
         }
 
         .stats {
@@ -231,13 +405,20 @@ HTML_TEMPLATE = '''
 
         {% if metrics %}
 
-        {% if charts and charts.items %}
+        {% if charts %}
         <h2 class="section-title">Performance Charts</h2>
         <div class="charts">
-            {% for chart_name, chart_data in charts.items() %}
+            {% for chart in charts %}
             <div class="chart-container">
-                <h3>{{ chart_name }}</h3>
-                <img src="data:image/png;base64,{{ chart_data }}" alt="{{ chart_name }}" />
+                <h3>{{ chart.name }}</h3>
+                {% if chart_mode == 'client' %}
+                <canvas class="chart-canvas" width="800" height="400" data-chart="{{ chart.key }}"
+                        data-series="{{ chart.series_url }}" data-fallback="{{ chart.url }}"
+                        data-title="{{ chart.title }}" data-color="{{ chart.color }}" data-ymax="{{ chart.ymax }}"></canvas>
+                <noscript><img src="{{ chart.url }}" alt="{{ chart.name }}" /></noscript>
+                {% else %}
+                <img src="{{ chart.url }}" alt="{{ chart.name }}" />
+                {% endif %}
             </div>
             {% endfor %}
         </div>
@@ -252,21 +433,21 @@ HTML_TEMPLATE = '''
             </div>
             <div class="stat-card">
                 <h3>Total Metrics</h3>
-                <p class="value">{{ total_metrics }}</p>
+                <p class="value" id="stat-total-metrics">{{ total_metrics }}</p>
             </div>
             <div class="stat-card">
                 <h3>Latest CPU</h3>
-                <p class="value">{{ "%.1f"|format(latest_metrics.cpu_percent) if latest_metrics.cpu_percent else "N/A" }}%</p>
+                <p class="value" id="stat-latest-cpu">{{ "%.1f"|format(latest_metrics.cpu_percent) if latest_metrics.cpu_percent else "N/A" }}%</p>
             </div>
             <div class="stat-card">
                 <h3>Latest RAM</h3>
-                <p class="value">{{ "%.1f"|format(latest_metrics.ram.percent) if latest_metrics.ram else "N/A" }}%</p>
+                <p class="value" id="stat-latest-ram">{{ "%.1f"|format(latest_metrics.ram.percent) if latest_metrics.ram else "N/A" }}%</p>
             </div>
         </div>
         {% endif %}
 
         <h2 class="section-title">Client Metrics</h2>
-        <table>
+        <table id="metrics-table">
             <thead>
                 <tr>
                     <th>Client</th>
@@ -319,6 +500,123 @@ HTML_TEMPLATE = '''
         </div>
 
     </div>
+    <script>
+    (function () {
+        var streamUrl = {{ stream_url|tojson }}, chartClient = {{ chart_client|tojson }};
+        var liveCharts = {{ live_charts|tojson }}, chartSamples = {{ chart_samples }}, tableRows = {{ metrics|length }};
+        function pad(n) { return (n < 10 ? '0' : '') + n; }
+        function label(ms, longSpan) {
+            var d = new Date(ms);
+            var time = pad(d.getUTCHours()) + ':' + pad(d.getUTCMinutes());
+            return longSpan ? pad(d.getUTCMonth() + 1) + '-' + pad(d.getUTCDate()) + ' ' + time
+                            : time + ':' + pad(d.getUTCSeconds());
+        }
+        function draw(canvas, t, v) {
+            var ctx = canvas.getContext('2d'), w = canvas.width, h = canvas.height;
+            var left = 60, right = 20, top = 40, bottom = 70, n = v.length;
+            var ymax = parseFloat(canvas.dataset.ymax), ymin = 0;
+            if (isNaN(ymax)) {
+                ymin = Infinity; ymax = -Infinity;
+                for (var i = 0; i < n; i++) { ymin = Math.min(ymin, v[i]); ymax = Math.max(ymax, v[i]); }
+                var margin = (ymax - ymin) * 0.05 || 1; ymin -= margin; ymax += margin;
+            }
+            var x = function (i) { return left + (n > 1 ? i / (n - 1) : 0.5) * (w - left - right); };
+            var y = function (val) { return top + (1 - (val - ymin) / (ymax - ymin)) * (h - top - bottom); };
+            ctx.clearRect(0, 0, w, h);
+            ctx.font = '12px Roboto, sans-serif'; ctx.fillStyle = '#1e3a5f'; ctx.strokeStyle = '#e0e0e0';
+            ctx.textAlign = 'center'; ctx.fillText(canvas.dataset.title, w / 2, 22);
+            ctx.textAlign = 'right';
+            for (var g = 0; g <= 5; g++) {
+                var gv = ymin + (ymax - ymin) * g / 5, gy = y(gv);
+                ctx.beginPath(); ctx.moveTo(left, gy); ctx.lineTo(w - right, gy); ctx.stroke();
+                ctx.fillText(gv.toFixed(gv >= 100 ? 0 : 1), left - 6, gy + 4);
+            }
+            var longSpan = n > 1 && t[n - 1] - t[0] > 86400000, step = Math.max(1, Math.ceil(n / 8));
+            ctx.textAlign = 'center';
+            for (var k = 0; k < n; k += step) { ctx.fillText(label(t[k], longSpan), x(k), h - bottom + 18); }
+            ctx.strokeStyle = canvas.dataset.color; ctx.lineWidth = 2; ctx.beginPath();
+            for (var j = 0; j < n; j++) { j ? ctx.lineTo(x(j), y(v[j])) : ctx.moveTo(x(j), y(v[j])); }
+            ctx.stroke();
+        }
+        function show(canvas, t, v) {
+            canvas.points = {t: t, v: v};
+            draw(canvas, t, v);
+        }
+        function fallback(canvas) {
+            var img = document.createElement('img');
+            img.src = canvas.dataset.fallback; img.alt = canvas.dataset.title;
+            canvas.parentNode.replaceChild(img, canvas);
+        }
+        document.querySelectorAll('canvas.chart-canvas').forEach(function (canvas) {
+            if (!window.fetch || !canvas.getContext) { fallback(canvas); return; }
+            fetch(canvas.dataset.series).then(function (response) {
+                if (!response.ok) { throw new Error(response.status); }
+                var n = parseInt(response.headers.get('X-Series-Count'), 10);
+                return response.arrayBuffer().then(function (buf) {
+                    show(canvas, Array.from(new Float64Array(buf, 0, n)), Array.from(new Float32Array(buf, 8 * n, n)));
+                });
+            }).catch(function () { fallback(canvas); });
+        });
+
+        // Live updates: new samples arrive over Server-Sent Events instead of page reloads.
+        var values = {
+            cpu: function (m) { return m.cpu_percent; },
+            ram: function (m) { return m.ram ? m.ram.percent : null; },
+            gpu: function (m) { return m.gpu_percent; },
+            ping: function (m) { return m.ping_ms; }
+        };
+        function fixed(v, digits) { return v ? v.toFixed(digits) : 'N/A'; }
+        function setText(id, text) { var el = document.getElementById(id); if (el) { el.textContent = text; } }
+        function cell(row, text, className) {
+            var td = row.insertCell();
+            td.textContent = text;
+            if (className) { td.className = className; }
+        }
+        function addRow(tbody, m) {
+            var row = tbody.insertRow(0), name = document.createElement('strong');
+            name.textContent = m.client_name || m.client_id;
+            row.insertCell().appendChild(name);
+            cell(row, m.timestamp);
+            cell(row, fixed(m.cpu_percent, 1) + '%');
+            cell(row, fixed(m.gpu_percent, 1));
+            cell(row, m.ram ? fixed(m.ram.used_gb, 2) + ' / ' + fixed(m.ram.total_gb, 2) : 'N/A');
+            cell(row, (m.ram ? fixed(m.ram.percent, 1) : 'N/A') + '%');
+            cell(row, fixed(m.ping_ms, 1));
+            var online = m.internet_connected;
+            cell(row, online === null || online === undefined ? 'N/A' : (online ? 'Connected' : 'Disconnected'),
+                 online ? 'status-connected' : 'status-disconnected');
+            while (tbody.rows.length > tableRows) { tbody.deleteRow(-1); }
+        }
+        var dirty = [];
+        function redraw() {
+            dirty.forEach(function (canvas) { draw(canvas, canvas.points.t, canvas.points.v); });
+            dirty = [];
+        }
+        function addPoint(canvas, m) {
+            var p = canvas.points, value = values[canvas.dataset.chart](m);
+            if (!p || value === null || value === undefined || !m.timestamp) { return; }
+            p.t.push(Date.parse(m.timestamp + 'Z'));
+            p.v.push(value);
+            while (p.v.length > chartSamples) { p.t.shift(); p.v.shift(); }
+            if (!dirty.length) { requestAnimationFrame(redraw); }
+            if (dirty.indexOf(canvas) < 0) { dirty.push(canvas); }
+        }
+        if (!window.EventSource) { return; }
+        var source = new EventSource(streamUrl);
+        source.addEventListener('metric', function (event) {
+            var m = JSON.parse(event.data), tbody = document.querySelector('#metrics-table tbody');
+            if (!tbody) { source.close(); location.reload(); return; }
+            addRow(tbody, m);
+            var total = document.getElementById('stat-total-metrics');
+            if (total) { total.textContent = (parseInt(total.textContent, 10) || 0) + 1; }
+            setText('stat-latest-cpu', fixed(m.cpu_percent, 1) + '%');
+            setText('stat-latest-ram', (m.ram ? fixed(m.ram.percent, 1) : 'N/A') + '%');
+            if (liveCharts && (!chartClient || m.client_id === chartClient)) {
+                document.querySelectorAll('canvas.chart-canvas').forEach(function (canvas) { addPoint(canvas, m); });
+            }
+        });
+    })();
+    </script>
 </body>
 </html>
 
@@ -328,10 +626,15 @@ HTML_TEMPLATE = '''
 
 # ==================== DATABASE FUNCTIONS ====================
 def get_db_connection():
-    """Get a database connection to Azure SQL."""
+    """Open a new database connection to Azure SQL.
+
+    Data-access functions should go through ``store`` instead; this is the
+    factory its connection pool uses when it needs a fresh connection.
+    """
     try:
-        logger.info("Attempting database connection...")
-        conn = pyodbc.connect(CONNECTION_STRING)
+        logger.debug("Attempting database connection...")
+        with db_connect_seconds.time():
+            conn = pyodbc.connect(CONNECTION_STRING)
         logger.info("✓ Database connection successful")
         return conn
     except Exception as e:
@@ -339,112 +642,110 @@ def get_db_connection():
         logger.error(traceback.format_exc())
         raise
 
+if STORAGE_BACKEND == 'azuresql':
+    db_pool = ConnectionPool(
+        get_db_connection,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        validate_after=DB_POOL_VALIDATE_AFTER
+    )
+    store = AzureSQLStore(db_pool, migration_chunk_size=MIGRATION_CHUNK_SIZE)
+elif STORAGE_BACKEND == 'sqlite':
+    db_pool = None
+    store = SQLiteStore(SQLITE_PATH, busy_timeout=SQLITE_BUSY_TIMEOUT, synchronous=SQLITE_SYNCHRONOUS)
+else:
+    raise ValueError(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', expected 'azuresql' or 'sqlite'")
+
 def init_db():
-    """Initialize the Azure SQL database tables."""
-    try:
-        logger.info("Starting database initialization...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        logger.info("Creating metrics table if not exists...")
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='metrics' AND xtype='U')
-            CREATE TABLE metrics (
-                id INT IDENTITY(1,1) PRIMARY KEY,
-                client_id NVARCHAR(255) NOT NULL,
-                client_name NVARCHAR(255),
-                timestamp NVARCHAR(50) NOT NULL,
-                received_at NVARCHAR(50) NOT NULL,
-                cpu_percent FLOAT,
-                gpu_percent FLOAT,
-                ram_json NVARCHAR(MAX),
-                ping_ms FLOAT,
-                internet_connected BIT,
-                raw_data NVARCHAR(MAX),
-                created_at DATETIME2 DEFAULT GETDATE()
-            )
-        ''')
-        logger.info("✓ Metrics table created/verified")
-        
-        logger.info("Creating index on client_id...")
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_client_id' AND object_id = OBJECT_ID('metrics'))
-            CREATE INDEX idx_client_id ON metrics(client_id)
-        ''')
-        logger.info("✓ Index idx_client_id created/verified")
-        
-        logger.info("Creating index on timestamp...")
-        cursor.execute('''
-            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_timestamp' AND object_id = OBJECT_ID('metrics'))
-            CREATE INDEX idx_timestamp ON metrics(timestamp DESC)
-        ''')
-        logger.info("✓ Index idx_timestamp created/verified")
-        
-        conn.commit()
-        conn.close()
+    """Create or migrate the storage backend's tables."""
+    try:
+        logger.info(f"Starting database initialization ({store.backend})...")
+        store.init_schema()
         logger.info("✓ Database initialization complete")
     except Exception as e:
         logger.error(f"✗ Database initialization failed: {str(e)}")
         logger.error(traceback.format_exc())
         raise
 
-def insert_metric(client_id, data):
-    """Insert a metric into the database."""
-    try:
-        logger.info(f"Inserting metric for client: {client_id}")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Extract fields
-        client_name = data.get('client_name')
-        timestamp = data.get('timestamp')
-        received_at = data.get('received_at')
-        cpu_percent = data.get('cpu_percent')
-        gpu_percent = data.get('gpu_percent')
-        ram = data.get('ram')
-        ping_ms = data.get('ping_ms')
-        internet_connected = data.get('internet_connected')
-        
-        ram_json = json.dumps(ram) if ram else None
-        raw_data = json.dumps(data)
-        
-        logger.info(f"Data - CPU: {cpu_percent}%, RAM: {ram.get('percent') if ram else 'N/A'}%")
-        
-        cursor.execute('''
-            INSERT INTO metrics 
-            (client_id, client_name, timestamp, received_at, cpu_percent, gpu_percent, 
-                ram_json, ping_ms, internet_connected, raw_data)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (client_id, client_name, timestamp, received_at, cpu_percent, gpu_percent,
-                ram_json, ping_ms, internet_connected, raw_data))
-        
-        conn.commit()
-        conn.close()
+def _metric_params(client_id, data):
+    """Build the INSERT parameter tuple for one metric sample."""
+    ram = data.get('ram') or {}
+    received_at = parse_timestamp(data.get('received_at')) or utc_now()
+    return (
+        client_id,
+        data.get('client_name'),
+        parse_timestamp(data.get('timestamp')) or received_at,
+        received_at,
+        data.get('cpu_percent'),
+        data.get('gpu_percent'),
+        ram.get('used_gb'),
+        ram.get('total_gb'),
+        ram.get('percent'),
+        data.get('ping_ms'),
+        data.get('internet_connected'),
+        json.dumps(data) if STORE_RAW_DATA else None
+    )
+
+def insert_metrics(samples):
+    """Insert a batch of (client_id, data) samples and update their clients' state."""
+    try:
+        logger.debug("Inserting batch of %d metrics...", len(samples))
+        params = [_metric_params(client_id, data) for client_id, data in samples]
+        with db_query_seconds.labels('insert_metrics').time():
+            store.insert_metrics(params)
+        
+        recent_cache.notify()
+        inserted_log("✓ Inserted %d metrics", len(samples))
     except Exception as e:
-        logger.error(f"✗ Insert metric failed for client {client_id}: {str(e)}")
+        logger.error(f"✗ Insert metrics batch failed ({len(samples)} samples): {str(e)}")
         logger.error(traceback.format_exc())
         raise
 
-def get_all_metrics(limit=50):
-    """Get all metrics from database."""
+def insert_metric(client_id, data):
+    """Insert a single metric into the database synchronously."""
+    insert_metrics([(client_id, data)])
+
+def check_database():
+    """Raise if the database cannot answer a trivial query."""
+    with db_query_seconds.labels('check_database').time():
+        store.check()
+
+def load_latest_metrics(limit, client_id=None):
+    """Load the newest (id, metric) pairs in ascending id order for the recent cache."""
+    with db_query_seconds.labels('load_latest_metrics').time():
+        return store.latest_entries(limit, client_id)
+
+def load_metrics_after(after_id, limit):
+    """Load (id, metric) pairs with id greater than after_id, in ascending id order."""
+    with db_query_seconds.labels('load_metrics_after').time():
+        return store.entries_after(after_id, limit)
+
+def load_newest_before(before_id, client_id=None):
+    """Load the newest sample timestamp among ids below before_id, for recent cache coverage."""
+    with db_query_seconds.labels('load_newest_before').time():
+        return store.newest_timestamp_before(before_id, client_id)
+
+def load_client_states():
+    """Load every client's state row and the highest metrics id for the client index."""
+    with db_query_seconds.labels('load_client_states').time():
+        return store.client_states()
+
+def get_all_metrics(limit=50, include_raw=False):
+    """Get all metrics, from the recent cache when it can serve the request.
+    
+    The stored raw payloads are only read (from the database) with include_raw.
+    """
     try:
-        logger.info(f"Fetching all metrics (limit: {limit})...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if not include_raw:
+            cached = recent_cache.latest(limit)
+            if cached is not None:
+                return cached
         
-        cursor.execute('''
-            SELECT TOP (?) * FROM metrics 
-            ORDER BY timestamp DESC
-        ''', (limit,))
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        metrics = []
-        for row in rows:
-            metric = json.loads(row.raw_data)
-            metric['client_id'] = row.client_id
-            metrics.append(metric)
+        logger.info(f"Fetching all metrics (limit: {limit})...")
+        with db_query_seconds.labels('get_all_metrics').time():
+            metrics = store.newest_metrics(limit, include_raw=include_raw)
         
         logger.info(f"✓ Retrieved {len(metrics)} metrics")
         return metrics
@@ -454,32 +755,18 @@ def get_all_metrics(limit=50):
         return []
 
 def get_client_metrics(client_id=None, limit=20):
-    """Get metrics for a specific client or all clients."""
+    """Get metrics for a specific client or all clients, preferring the recent cache."""
     try:
-        logger.info(f"Fetching metrics for client: {client_id or 'all'} (limit: {limit})")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         if client_id:
-            cursor.execute('''
-                SELECT TOP (?) * FROM metrics 
-                WHERE client_id = ?
-                ORDER BY timestamp DESC
-            ''', (limit, client_id))
+            cached = recent_cache.latest_for_client(client_id, limit)
         else:
-            cursor.execute('''
-                SELECT TOP (?) * FROM metrics 
-                ORDER BY timestamp DESC
-            ''', (limit,))
-        
-        rows = cursor.fetchall()
-        conn.close()
+            cached = recent_cache.latest(limit)
+        if cached is not None:
+            return cached
         
-        metrics = []
-        for row in rows:
-            metric = json.loads(row.raw_data)
-            metric['client_id'] = row.client_id
-            metrics.append(metric)
+        logger.info(f"Fetching metrics for client: {client_id or 'all'} (limit: {limit})")
+        with db_query_seconds.labels('get_client_metrics').time():
+            metrics = store.newest_metrics(limit, client_id=client_id)
         
         logger.info(f"✓ Retrieved {len(metrics)} client metrics")
         return metrics
@@ -488,17 +775,115 @@ def get_client_metrics(client_id=None, limit=20):
         logger.error(traceback.format_exc())
         return []
 
+def get_metrics_range(start, end, client_id=None, limit=1000, include_raw=False):
+    """Get metrics with start <= timestamp < end, oldest first, using index seeks."""
+    try:
+        logger.info(f"Fetching metrics for client: {client_id or 'all'} from {start} to {end} (limit: {limit})")
+        with db_query_seconds.labels('get_metrics_range').time():
+            metrics = store.metrics_range(start, end, client_id=client_id, limit=limit, include_raw=include_raw)
+        
+        logger.info(f"✓ Retrieved {len(metrics)} metrics in range")
+        return metrics
+    except Exception as e:
+        logger.error(f"✗ Get metrics range failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
+
+def stream_metrics(after_id=0, limit=1000, client_id=None, include_raw=False):
+    """Yield metrics with id > after_id in id order, fetching STREAM_FETCH_SIZE rows at a time.
+    
+    Each metric carries its 'id' so the caller can resume from the last one.
+    """
+    logger.info(f"Streaming metrics for client: {client_id or 'all'} after id {after_id} (limit: {limit})")
+    return store.stream_metrics(after_id, limit, client_id=client_id, include_raw=include_raw,
+                                fetch_size=STREAM_FETCH_SIZE)
+
+def get_rollups(resolution, start, end, client_id=None, limit=10000):
+    """Get rollup buckets at one resolution with start <= bucket_start < end, oldest first."""
+    try:
+        logger.info(f"Fetching {resolution} rollups for client: {client_id or 'all'} from {start} to {end}")
+        with db_query_seconds.labels('get_rollups').time():
+            rollups = store.rollups(resolution, start, end, client_id=client_id, limit=limit)
+        for rollup in rollups:
+            rollup['bucket_start'] = format_timestamp(rollup['bucket_start'])
+        
+        logger.info(f"✓ Retrieved {len(rollups)} rollups")
+        return rollups
+    except Exception as e:
+        logger.error(f"✗ Get rollups failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
+
+def get_metric_stats(metrics, start, end, client_id=None, percentiles=None):
+    """Summary statistics per metric over [start, end), from the recent cache when it covers the window.
+    
+    Otherwise the time-series files are used when enabled, then the database.
+    Returns (summaries by metric, sample rows used, source, whether STATS_MAX_SAMPLES cut the window short).
+    """
+    try:
+        cached = recent_cache.covering(format_timestamp(start), client_id=client_id)
+        if cached is not None:
+            data = columns_from_metrics(cached, metrics, start, end)
+            source = 'cache'
+        elif TSDB_ENABLED and tsdb.ready:
+            series, truncated = get_field_series(metrics, start, end, client_id=client_id)
+            summaries = {metric: summarize(*series[metric], percentiles) for metric in metrics}
+            samples = max(len(series[metric][0]) for metric in metrics)
+            
+            logger.info(f"✓ Computed stats over {samples} samples from the time-series files")
+            return summaries, samples, 'tsdb', truncated
+        else:
+            logger.info(f"Loading {', '.join(metrics)} for client: {client_id or 'all'} from {start} to {end}")
+            with db_query_seconds.labels('get_metric_stats').time():
+                data = store.metric_columns(metrics, start, end, client_id=client_id,
+                                            limit=STATS_MAX_SAMPLES, fetch_size=STATS_FETCH_SIZE)
+            source = 'database'
+        
+        columns = np.ascontiguousarray(data.T)
+        summaries = {metric: summarize(columns[0], columns[i], percentiles)
+                     for i, metric in enumerate(metrics, 1)}
+        
+        logger.info(f"✓ Computed stats over {len(data)} samples from the {source}")
+        return summaries, len(data), source, len(data) >= STATS_MAX_SAMPLES
+    except Exception as e:
+        logger.error(f"✗ Get metric stats failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
+
+def get_field_series(fields, start, end, client_id=None, limit=STATS_MAX_SAMPLES):
+    """(epoch ms, values) arrays per field over [start, end), oldest first, from the time-series files.
+    
+    Samples the files do not hold yet (id > their through_id) are read from the database.
+    Returns (series by field, whether ``limit`` cut that database read short).
+    """
+    series, through_id = tsdb.read(fields, start, end, client_id=client_id)
+    with db_query_seconds.labels('get_field_series').time():
+        tail = store.metric_columns(fields, start, end, client_id=client_id, limit=limit,
+                                    fetch_size=STATS_FETCH_SIZE, after_id=through_id)
+    if len(tail):
+        for i, field in enumerate(fields, 1):
+            present = ~np.isnan(tail[:, i])
+            times = np.concatenate([series[field][0], tail[present, 0].astype(np.int64)])
+            values = np.concatenate([series[field][1], tail[present, i]])
+            order = np.argsort(times, kind='stable')
+            series[field] = times[order], values[order]
+    return series, len(tail) >= limit
+
+def load_metric_totals():
+    """Load (total metrics, distinct client ids, max id) for counter reconciliation."""
+    with db_query_seconds.labels('load_metric_totals').time():
+        return store.totals()
+
 def get_total_clients():
     """Get count of unique clients."""
     try:
-        logger.info("Counting total clients...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if metric_counters.ready:
+            return metric_counters.total_clients
         
-        cursor.execute('SELECT COUNT(DISTINCT client_id) as count FROM metrics')
-        count = cursor.fetchone()[0]
+        logger.info("Counting total clients...")
+        with db_query_seconds.labels('get_total_clients').time():
+            count = store.count_clients()
         
-        conn.close()
         logger.info(f"✓ Total clients: {count}")
         return count
     except Exception as e:
@@ -509,14 +894,13 @@ def get_total_clients():
 def get_total_metrics():
     """Get total count of metrics."""
     try:
-        logger.info("Counting total metrics...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        if metric_counters.ready:
+            return metric_counters.total_metrics
         
-        cursor.execute('SELECT COUNT(*) as count FROM metrics')
-        count = cursor.fetchone()[0]
+        logger.info("Counting total metrics...")
+        with db_query_seconds.labels('get_total_metrics').time():
+            count = store.count_metrics()
         
-        conn.close()
         logger.info(f"✓ Total metrics: {count}")
         return count
     except Exception as e:
@@ -524,34 +908,16 @@ def get_total_metrics():
         logger.error(traceback.format_exc())
         return 0
 
-def get_client_list():
-    """Get list of all clients with their info."""
+def get_client_list(status=None):
+    """Get every client's latest state, optionally only 'online' or 'offline' ones."""
     try:
+        if client_index.ready:
+            return client_index.clients(status)
+        
         logger.info("Fetching client list...")
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT 
-                client_id,
-                client_name,
-                MAX(timestamp) as last_seen,
-                COUNT(*) as metric_count
-            FROM metrics
-            GROUP BY client_id, client_name
-        ''')
-        
-        rows = cursor.fetchall()
-        conn.close()
-        
-        clients = []
-        for row in rows:
-            clients.append({
-                'client_id': row.client_id,
-                'client_name': row.client_name or row.client_id,
-                'last_seen': row.last_seen,
-                'metric_count': row.metric_count
-            })
+        with db_query_seconds.labels('get_client_list').time():
+            states, _ = store.client_states()
+        clients = describe_clients(states, CLIENT_OFFLINE_AFTER, utc_now(), status)
         
         logger.info(f"✓ Retrieved {len(clients)} clients")
         return clients
@@ -561,112 +927,559 @@ def get_client_list():
         return []
 
 # ==================== HELPER FUNCTIONS ====================
-def generate_charts(metrics_list):
-    """Generate matplotlib charts from metrics data."""
-    try:
-        logger.info(f"Generating charts from {len(metrics_list)} metrics...")
-        
-        if not metrics_list or len(metrics_list) < 2:
-            logger.info("✓ Not enough data for charts (need at least 2 points)")
-            return {}
-        
-        charts = {}
-        
-        timestamps = [m.get('timestamp', '')[-8:] for m in metrics_list]
-        cpu_data = [m.get('cpu_percent', 0) for m in metrics_list if m.get('cpu_percent') is not None]
-        ram_data = [m.get('ram', {}).get('percent', 0) for m in metrics_list if m.get('ram', {}).get('percent') is not None]
-        
-        # CPU Chart
-        if cpu_data and len(cpu_data) > 1:
-            logger.info("Generating CPU chart...")
-            cpu_timestamps = [m.get('timestamp', '')[-8:] for m in metrics_list if m.get('cpu_percent') is not None]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(cpu_timestamps, cpu_data, marker='o', linewidth=2, markersize=4, color='#667eea')
-            ax.set_xlabel('Time')
-            ax.set_ylabel('CPU Usage (%)')
-            ax.set_title('CPU Usage Over Time')
-            ax.grid(True, alpha=0.3)
-            ax.set_ylim(0, 100)
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            charts['CPU Usage'] = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            logger.info("✓ CPU chart generated")
-        
-        # RAM Chart
-        if ram_data and len(ram_data) > 1:
-            logger.info("Generating RAM chart...")
-            ram_timestamps = [m.get('timestamp', '')[-8:] for m in metrics_list if m.get('ram', {}).get('percent') is not None]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(ram_timestamps, ram_data, marker='o', linewidth=2, markersize=4, color='#764ba2')
-            ax.set_xlabel('Time')
-            ax.set_ylabel('RAM Usage (%)')
-            ax.set_title('RAM Usage Over Time')
-            ax.grid(True, alpha=0.3)
-            ax.set_ylim(0, 100)
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            charts['RAM Usage'] = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            logger.info("✓ RAM chart generated")
-        
-        # GPU Chart
-        gpu_data = [m.get('gpu_percent') for m in metrics_list if m.get('gpu_percent') is not None]
-        if gpu_data and len(gpu_data) > 1:
-            logger.info("Generating GPU chart...")
-            gpu_timestamps = [m.get('timestamp', '')[-8:] for m in metrics_list if m.get('gpu_percent') is not None]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(gpu_timestamps, gpu_data, marker='o', linewidth=2, markersize=4, color='#22c55e')
-            ax.set_xlabel('Time')
-            ax.set_ylabel('GPU Usage (%)')
-            ax.set_title('GPU Usage Over Time')
-            ax.grid(True, alpha=0.3)
-            ax.set_ylim(0, 100)
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            charts['GPU Usage'] = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            logger.info("✓ GPU chart generated")
-        
-        # Ping Chart
-        ping_data = [m.get('ping_ms') for m in metrics_list if m.get('ping_ms') is not None]
-        if ping_data and len(ping_data) > 1:
-            logger.info("Generating Ping chart...")
-            ping_timestamps = [m.get('timestamp', '')[-8:] for m in metrics_list if m.get('ping_ms') is not None]
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(ping_timestamps, ping_data, marker='o', linewidth=2, markersize=4, color='#f59e0b')
-            ax.set_xlabel('Time')
-            ax.set_ylabel('Ping (ms)')
-            ax.set_title('Network Latency Over Time')
-            ax.grid(True, alpha=0.3)
-            plt.xticks(rotation=45, ha='right')
-            plt.tight_layout()
-            
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png', dpi=100)
-            buf.seek(0)
-            charts['Network Latency'] = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            logger.info("✓ Ping chart generated")
-        
-        logger.info(f"✓ Generated {len(charts)} charts total")
-        return charts
-    except Exception as e:
-        logger.error(f"✗ Chart generation failed: {str(e)}")
-        logger.error(traceback.format_exc())
-        return {}
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def utc_now():
+    """Current time as a naive UTC datetime with millisecond precision."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 string into a naive UTC datetime, or None if invalid.
+
+    Values without a UTC offset are taken to be UTC already.
+    """
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    else:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.replace(microsecond=parsed.microsecond // 1000 * 1000)
+
+def format_timestamp(value):
+    """Format a stored datetime as a fixed-width ISO 8601 string."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    return value.isoformat(timespec='milliseconds')
+
+def parse_duration(value):
+    """Parse a duration such as '90s', '15m', '6h' or '30d' into a timedelta."""
+    if not value:
+        return None
+    unit = value[-1].lower()
+    if unit not in _DURATION_UNITS:
+        raise ValueError(f"Invalid duration '{value}', expected a number followed by s, m, h, d or w")
+    try:
+        amount = float(value[:-1])
+    except ValueError:
+        raise ValueError(f"Invalid duration '{value}', expected a number followed by s, m, h, d or w")
+    return timedelta(seconds=amount * _DURATION_UNITS[unit])
+
+def parse_time_range(args):
+    """Resolve from/to/window query arguments into a (start, end) pair of UTC datetimes."""
+    end = utc_now()
+    if args.get('to'):
+        end = parse_timestamp(args['to'])
+        if end is None:
+            raise ValueError(f"Invalid 'to' timestamp: {args['to']}")
+    if args.get('from'):
+        start = parse_timestamp(args['from'])
+        if start is None:
+            raise ValueError(f"Invalid 'from' timestamp: {args['from']}")
+    else:
+        start = end - (parse_duration(args.get('window')) or RANGE_DEFAULT_WINDOW)
+    if start >= end:
+        raise ValueError("'from' must be earlier than 'to'")
+    return start, end
+
+def parse_limit(args, default, maximum):
+    """Read the limit query argument, capped at maximum; raise ValueError unless it is at least 1."""
+    value = args.get('limit', default)
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid 'limit': {value}")
+    if limit < 1:
+        raise ValueError(f"'limit' must be at least 1, got {limit}")
+    return min(limit, maximum)
+
+_NUMERIC_FIELDS = ('cpu_percent', 'gpu_percent', 'ping_ms')
+_RAM_FIELDS = ('used_gb', 'total_gb', 'percent')
+
+def resolve_client_id(data, remote_addr):
+    """Pick the identifier a sample is stored under."""
+    return data.get('client_name') or data.get('client_id') or remote_addr
+
+def validate_metric(data):
+    """Return an error message if a sample is malformed, otherwise None."""
+    if not isinstance(data, dict):
+        return 'Sample must be a JSON object'
+    if not data:
+        return 'No data provided'
+    for field in _NUMERIC_FIELDS:
+        value = data.get(field)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            return f"'{field}' must be a number"
+    ram = data.get('ram')
+    if ram is not None:
+        if not isinstance(ram, dict):
+            return "'ram' must be an object"
+        for field in _RAM_FIELDS:
+            value = ram.get(field)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+                return f"'ram.{field}' must be a number"
+    connected = data.get('internet_connected')
+    if connected is not None and not isinstance(connected, bool):
+        return "'internet_connected' must be a boolean"
+    for field in ('client_id', 'client_name', 'timestamp'):
+        value = data.get(field)
+        if value is not None and not isinstance(value, str):
+            return f"'{field}' must be a string"
+    if data.get('timestamp') and parse_timestamp(data['timestamp']) is None:
+        return "'timestamp' must be an ISO 8601 date-time"
+    # MessagePack can carry bytes and extension types that the spool and raw_data cannot store
+    try:
+        json.dumps(data)
+    except (TypeError, ValueError) as e:
+        return f"Sample must only hold JSON values: {str(e)}"
+    return None
+
+def parse_metric_batch(body, content_type, content_encoding=None):
+    """Decode a batch body into a list of (sample, error) pairs.
+
+    The body is first decompressed according to Content-Encoding. Binary
+    bodies (see wire_format) hold a sequence of samples. NDJSON bodies (one
+    sample per line) are decoded line by line so that one bad line only
+    rejects that sample; anything else must be a JSON array.
+    """
+    body = decode_body(body, content_encoding, INGEST_MAX_DECODED_BYTES)
+    if content_type in BINARY_CONTENT_TYPES:
+        return [(item, None) for item in decode_samples(body, content_type)]
+    text = body.decode('utf-8')
+    if content_type in NDJSON_CONTENT_TYPES:
+        items = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append((json.loads(line), None))
+            except ValueError as e:
+                items.append((None, f'Invalid JSON: {str(e)}'))
+        return items
+    
+    payload = json.loads(text)
+    if not isinstance(payload, list):
+        raise ValueError('Batch body must be a JSON array or NDJSON')
+    return [(item, None) for item in payload]
+
+def parse_metric(body, content_type, content_encoding=None):
+    """Decode a single-sample body in any accepted format and encoding."""
+    return decode_sample(decode_body(body, content_encoding, INGEST_MAX_DECODED_BYTES), content_type)
+
+def prepare_metric_batch(items, remote_addr):
+    """Validate decoded batch items into (samples to store, per-item results)."""
+    received_at = format_timestamp(utc_now())
+    results = []
+    samples = []
+    for index, (data, error) in enumerate(items):
+        error = error or validate_metric(data)
+        if error:
+            results.append({'index': index, 'status': 'rejected', 'error': error})
+            continue
+        data['received_at'] = received_at
+        client_id = resolve_client_id(data, remote_addr)
+        samples.append((client_id, data))
+        results.append({'index': index, 'status': 'accepted', 'client_id': client_id})
+    return samples, results
+
+def enqueue_metric_batch(samples, results):
+    """Hand validated samples to the ingest writer and return how many it took.
+    
+    Results of samples that did not fit (queue or spool full) are turned into
+    rejections in place.
+    """
+    try:
+        queued = ingest_writer.submit_many(samples)
+    except QueueFull:
+        queued = 0
+    count_ingested(samples[:queued])
+    if queued < len(samples):
+        overflow = [result for result in results if result['status'] == 'accepted'][queued:]
+        for result in overflow:
+            result.update(status='rejected', error='Ingestion queue is full')
+            del result['client_id']
+    return queued
+
+def accept_metric(body, content_type, content_encoding, remote_addr):
+    """Decode, validate and queue one uploaded sample.
+    
+    Shared by the Flask view and the ASGI fast path. Returns (status, JSON
+    payload, response headers as (name, value) pairs).
+    """
+    try:
+        data = parse_metric(body, content_type, content_encoding)
+    except WireFormatError as e:
+        logger.warning(f"✗ Unreadable metrics from {remote_addr}: {str(e)}")
+        return e.status, {'error': str(e)}, []
+    
+    if not data:
+        logger.warning("✗ No data provided in request")
+        return 400, {'error': 'No data provided'}, []
+    error = validate_metric(data)
+    if error:
+        logger.warning(f"✗ Invalid metrics from {remote_addr}: {error}")
+        return 400, {'error': error}, []
+    
+    data['received_at'] = format_timestamp(utc_now())
+    client_id = resolve_client_id(data, remote_addr)
+    
+    logger.debug("Processing metrics from client: %s", client_id)
+    
+    try:
+        ingest_writer.submit((client_id, data))
+    except QueueFull as e:
+        logger.warning(f"✗ Rejecting metrics from {client_id}: {str(e)}")
+        return 503, {'error': str(e)}, [('Retry-After', str(INGEST_RETRY_AFTER))]
+    count_ingested([(client_id, data)])
+    
+    received_log("✓ Metrics received successfully from %s", client_id)
+    return 200, {
+        'status': 'success',
+        'message': 'Metrics received',
+        'client_id': client_id
+    }, []
+
+def accept_metric_batch(body, content_type, content_encoding, remote_addr):
+    """Decode, validate and queue an uploaded batch; returns (status, JSON payload, headers) like accept_metric."""
+    try:
+        items = parse_metric_batch(body, content_type, content_encoding)
+    except ValueError as e:
+        logger.warning(f"✗ Unreadable batch: {str(e)}")
+        return getattr(e, 'status', 400), {'error': str(e)}, []
+    
+    if not items:
+        logger.warning("✗ No data provided in batch")
+        return 400, {'error': 'No data provided'}, []
+    if len(items) > BATCH_MAX_ITEMS:
+        logger.warning(f"✗ Batch of {len(items)} samples exceeds limit of {BATCH_MAX_ITEMS}")
+        return 413, {'error': f'Batch exceeds {BATCH_MAX_ITEMS} samples'}, []
+    
+    samples, results = prepare_metric_batch(items, remote_addr)
+    
+    queued = enqueue_metric_batch(samples, results)
+    rejected = len(results) - queued
+    batch_received_log("✓ Batch queued: %d accepted, %d rejected", queued, rejected)
+    
+    if not queued:
+        status_code = 503 if samples else 400
+    elif rejected:
+        status_code = 207
+    else:
+        status_code = 200
+    headers = [('Retry-After', str(INGEST_RETRY_AFTER))] if queued < len(samples) else []
+    return status_code, {
+        'status': 'success' if not rejected else 'partial',
+        'accepted': queued,
+        'rejected': rejected,
+        'results': results
+    }, headers
+
+def count_ingested(samples):
+    """Add queued (client_id, data) samples to the per-client ingest counters."""
+    for client_id, _ in samples:
+        ingested_samples.labels(client_id).inc()
+
+def rollup_to_metric(rollup):
+    """Present a rollup bucket as a metric sample (using averages) for charting."""
+    return {
+        'client_id': rollup['client_id'],
+        'timestamp': rollup['bucket_start'],
+        'cpu_percent': rollup['cpu_avg'],
+        'gpu_percent': rollup['gpu_avg'],
+        'ram': {'percent': rollup['ram_avg']} if rollup['ram_avg'] is not None else {},
+        'ping_ms': rollup['ping_avg']
+    }
+
+def get_chart_series(args):
+    """Samples to chart for the dashboard's window/from/to/client arguments.
+
+    Without a time range this is the latest DASHBOARD_CHART_SAMPLES samples; with one, the
+    coarsest rollup resolution that still gives ROLLUP_MIN_POINTS buckets.
+    Returns (metrics oldest first, resolution, whether the span exceeds a day).
+    """
+    client_id = args.get('client') or None
+    if not any(args.get(key) for key in ('from', 'to', 'window')):
+        return list(reversed(get_client_metrics(client_id=client_id, limit=DASHBOARD_CHART_SAMPLES))), 'raw', False
+    
+    start, end = parse_time_range(args)
+    long_span = end - start > timedelta(days=1)
+    resolution = choose_resolution(start, end, ROLLUP_MIN_POINTS) if store.supports_rollups else 'raw'
+    if resolution == 'raw':
+        return get_metrics_range(start, end, client_id=client_id, limit=RANGE_MAX_LIMIT), resolution, long_span
+    rollups = get_rollups(resolution, start, end, client_id=client_id, limit=RANGE_MAX_LIMIT)
+    return [rollup_to_metric(rollup) for rollup in rollups], resolution, long_span
+
+def get_tsdb_series_points(name, args):
+    """(epoch ms, values, resolution) for one chart from the time-series files, or None if they can't serve it.
+    
+    Serves time ranges that would otherwise be drawn from raw samples, thinned
+    evenly to at most RANGE_MAX_LIMIT points.
+    """
+    if not TSDB_ENABLED or not tsdb.ready or not any(args.get(key) for key in ('from', 'to', 'window')):
+        return None
+    start, end = parse_time_range(args)
+    if store.supports_rollups and choose_resolution(start, end, ROLLUP_MIN_POINTS) != 'raw':
+        return None
+    field = METRIC_ALIASES[name]
+    series, _ = get_field_series([field], start, end, client_id=args.get('client') or None)
+    times, values = series[field]
+    if len(times) > RANGE_MAX_LIMIT:
+        step = -(-len(times) // RANGE_MAX_LIMIT)
+        times, values = times[::step], values[::step]
+    return times, values, 'raw'
+
+def load_chart_points(name, args):
+    """(labels, values) for one chart given the dashboard's query arguments."""
+    chart_metrics, _, long_span = get_chart_series(args)
+    return chart_points(name, chart_metrics, long_span)
+
+def is_hot_chart(args):
+    """Whether a chart is worth re-rendering as data lands.
+    
+    Only charts of all clients or of a client that has sent samples, over the
+    default view or one of CHART_HOT_WINDOWS, qualify.
+    """
+    if args.get('from') or args.get('to'):
+        return False
+    if args.get('window') and args['window'] not in CHART_HOT_WINDOWS:
+        return False
+    client_id = args.get('client')
+    return not client_id or client_index.has_client(client_id)
+
+def chart_data_version(client_id=None):
+    """Version of the data a chart of one client (None: all clients) shows, or None if unknown.
+    
+    A client's charts only change when that client's samples land, so their
+    version is its newest metrics id and other clients' uploads leave them cached.
+    """
+    if not recent_cache.ready:
+        return None
+    return recent_cache.client_version(client_id) if client_id else recent_cache.version
+
+def chart_urls(names, args):
+    """Dashboard entries linking each chart to its PNG and its series data."""
+    params = {key: args[key] for key in ('client', 'window', 'from', 'to') if args.get(key)}
+    params['v'] = chart_data_version(args.get('client') or None)
+    return [{
+        'key': name,
+        'name': CHARTS[name]['display_name'],
+        'title': CHARTS[name]['title'],
+        'color': CHARTS[name]['color'],
+        'ymax': CHARTS[name]['ylim'][1] if CHARTS[name]['ylim'] else '',
+        'url': url_for('chart_png', name=name, **params),
+        'series_url': url_for('get_series', name=name, format='binary', **params)
+    } for name in names]
+
+def series_etag(name, args):
+    """ETag for a chart's data at the current data version, or None if unknown."""
+    client_id = args.get('client') or None
+    version = chart_data_version(client_id)
+    if version is None:
+        return None
+    key = (name, client_id, tuple(args.get(k) or '' for k in ('window', 'from', 'to')), version)
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+def stream_backlog(last_event_id, client_id=None):
+    """Cached samples a reconnecting stream subscriber missed after last_event_id."""
+    if not last_event_id or not last_event_id.isdigit():
+        return []
+    return recent_cache.entries_after(int(last_event_id), client_id)
+
+def epoch_ms(timestamp):
+    """Milliseconds since the Unix epoch for an ISO 8601 UTC timestamp."""
+    return parse_timestamp(timestamp).replace(tzinfo=timezone.utc).timestamp() * 1000
+
+# ==================== BACKGROUND SERVICES ====================
+if SPOOL_ENABLED:
+    ingest_writer = Spool(
+        SPOOL_DIR,
+        insert_metrics,
+        health_check=check_database,
+        segment_bytes=SPOOL_SEGMENT_BYTES,
+        max_bytes=SPOOL_MAX_BYTES,
+        fsync_interval=SPOOL_FSYNC_INTERVAL,
+        batch_size=INGEST_BATCH_SIZE,
+        idle_interval=INGEST_FLUSH_INTERVAL,
+        max_retry_delay=SPOOL_MAX_RETRY_DELAY
+    )
+else:
+    ingest_writer = BatchWriter(
+        insert_metrics,
+        max_queue=INGEST_QUEUE_SIZE,
+        batch_size=INGEST_BATCH_SIZE,
+        flush_interval=INGEST_FLUSH_INTERVAL
+    )
+
+recent_cache = RecentMetricsCache(
+    load_latest_metrics,
+    load_metrics_after,
+    load_newest_before,
+    capacity=RECENT_CACHE_SIZE,
+    per_client_capacity=RECENT_CACHE_PER_CLIENT,
+    refresh_interval=RECENT_CACHE_REFRESH_INTERVAL
+)
+
+metric_counters = MetricCounters(load_metric_totals, reconcile_interval=COUNTER_RECONCILE_INTERVAL)
+recent_cache.add_listener(metric_counters.observe)
+
+client_index = ClientStateIndex(
+    load_client_states,
+    offline_after=CLIENT_OFFLINE_AFTER,
+    reload_interval=CLIENT_STATE_RELOAD_INTERVAL
+)
+recent_cache.add_listener(client_index.observe)
+
+alert_sinks = [log_sink] + ([WebhookSink(ALERT_WEBHOOK_URL)] if ALERT_WEBHOOK_URL else [])
+alert_engine = AlertEngine(
+    parse_rules(ALERT_RULES, parse_duration),
+    client_index.last_received,
+    sinks=alert_sinks,
+    interval=ALERT_EVAL_INTERVAL,
+    stale_intervals=ALERT_STALE_INTERVALS,
+    min_stale_seconds=ALERT_STALE_MIN_SECONDS,
+    default_interval=ALERT_DEFAULT_INTERVAL,
+    history=ALERT_HISTORY,
+    lock_path=ALERT_LOCK_FILE or None,
+    stale_max_age=ALERT_STALE_MAX_AGE
+)
+recent_cache.add_listener(alert_engine.observe)
+
+rollup_job = RollupJob(db_pool, interval=ROLLUP_INTERVAL, lock_path=ROLLUP_LOCK_FILE or None)
+chart_cache = ChartCache(max_entries=CHART_CACHE_ENTRIES, max_bytes=CHART_CACHE_BYTES)
+chart_renderer = ChartRenderer(
+    chart_cache,
+    load_chart_points,
+    chart_data_version,
+    workers=CHART_RENDER_WORKERS,
+    on_render=lambda name, seconds: chart_render_seconds.labels(name).observe(seconds),
+    keep_hot=is_hot_chart
+)
+recent_cache.add_listener(chart_renderer.refresh)
+
+sample_broadcaster = SampleBroadcaster(buffer_size=SSE_BUFFER_SIZE, max_subscribers=SSE_MAX_SUBSCRIBERS)
+recent_cache.add_listener(sample_broadcaster.publish)
+
+tsdb = TimeSeriesStore(
+    TSDB_DIR,
+    load_metrics_after,
+    chunk_points=TSDB_CHUNK_POINTS,
+    max_head_age=TSDB_MAX_HEAD_AGE,
+    interval=TSDB_INTERVAL,
+    batch_size=TSDB_BATCH_SIZE,
+    # Raw samples are only purged from the table where the retention job runs
+    retention_days=RETENTION_RAW_DAYS if RETENTION_ENABLED and store.supports_rollups else 0,
+    prune_interval=TSDB_PRUNE_INTERVAL
+)
+
+retention_job = RetentionJob(
+    db_pool,
+    {'raw': RETENTION_RAW_DAYS, 'raw_data': RETENTION_RAW_DATA_DAYS, '1m': RETENTION_1M_DAYS, '1h': RETENTION_1H_DAYS, '1d': RETENTION_1D_DAYS},
+    interval=RETENTION_INTERVAL,
+    chunk_size=RETENTION_CHUNK_SIZE,
+    respect_rollups=ROLLUP_ENABLED,
+    on_purge=metric_counters.discount,
+    lock_path=RETENTION_LOCK_FILE or None
+)
+
+def service_stats():
+    """Every background service's stats() by name, as reported by /health."""
+    return {
+        'storage': store.stats(),
+        'ingest': ingest_writer.stats(),
+        'recent_cache': recent_cache.stats(),
+        'counters': metric_counters.stats(),
+        'client_state': client_index.stats(),
+        'alerts': alert_engine.stats(),
+        'tsdb': tsdb.stats() if TSDB_ENABLED else {'enabled': False},
+        'rollups': rollup_job.stats(),
+        'chart_cache': chart_cache.stats(),
+        'chart_renderer': chart_renderer.stats(),
+        'stream': sample_broadcaster.stats(),
+        'logging': log_pipeline.stats()
+    }
+
+telemetry.gauge(
+    'monitoring_service_stat', 'Numeric fields of the background service stats in /health.',
+    lambda: [((service, key), value) for service, stats in service_stats().items()
+             for key, value in numeric_stats(stats)],
+    ('service', 'stat'))
+
+_services_lock = threading.Lock()
+_services_started = False
+
+def start_background_services():
+    """Start background threads once per process.
+
+    Called lazily from the first request so that threads are created after
+    a pre-forking server has forked its workers.
+    """
+    global _services_started
+    if _services_started:
+        return
+    with _services_lock:
+        if _services_started:
+            return
+        logger.info("Starting background services...")
+        ingest_writer.start()
+        metric_counters.start()
+        client_index.start()
+        recent_cache.start()
+        chart_renderer.start()
+        if ALERTS_ENABLED:
+            alert_engine.start()
+        if TSDB_ENABLED:
+            tsdb.start()
+        if ROLLUP_ENABLED and store.supports_rollups:
+            rollup_job.start()
+        if RETENTION_ENABLED and store.supports_rollups:
+            retention_job.start()
+        atexit.register(stop_background_services)
+        _services_started = True
+        logger.info("✓ Background services started")
+
+def stop_background_services():
+    """Flush pending work and stop background threads."""
+    logger.info("Stopping background services...")
+    ingest_writer.stop()
+    recent_cache.stop()
+    metric_counters.stop()
+    client_index.stop()
+    alert_engine.stop()
+    tsdb.stop()
+    rollup_job.stop()
+    retention_job.stop()
+    chart_renderer.stop()
+    store.close()
+    logger.info("✓ Background services stopped")
+
+@app.before_request
+def _ensure_background_services():
+    start_background_services()
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_seconds.labels(request.method, route, str(response.status_code)).observe(
+            time.perf_counter() - started)
+        if request.content_length:
+            request_bytes.labels(route).observe(request.content_length)
+        if not response.is_streamed:
+            response_bytes.labels(route).observe(response.calculate_content_length() or 0)
+    return response
 
 # ==================== FLASK ROUTES ====================
 @app.route('/')
@@ -677,8 +1490,12 @@ def dashboard():
         
         all_metrics = get_all_metrics(limit=50)
         latest = all_metrics[0] if all_metrics else None
-        recent_metrics = list(reversed(get_client_metrics(limit=20)))
-        charts = generate_charts(recent_metrics)
+        try:
+            chart_metrics, resolution, long_span = get_chart_series(request.args)
+        except ValueError as e:
+            return f"Dashboard Error: {str(e)}", 400
+        logger.info(f"Charting {len(chart_metrics)} points at {resolution} resolution")
+        charts = chart_urls(available_charts(chart_metrics, long_span), request.args)
         total_clients = get_total_clients()
         total_metrics = get_total_metrics()
         base_url = request.url_root.rstrip('/')
@@ -690,6 +1507,11 @@ def dashboard():
             metrics=all_metrics,
             latest_metrics=latest,
             charts=charts,
+            chart_mode=CHART_MODE,
+            chart_client=request.args.get('client') or None,
+            chart_samples=DASHBOARD_CHART_SAMPLES,
+            live_charts=not any(request.args.get(key) for key in ('from', 'to', 'window')),
+            stream_url=url_for('metric_stream'),
             total_clients=total_clients,
             total_metrics=total_metrics,
             base_url=base_url
@@ -699,45 +1521,235 @@ def dashboard():
         logger.error(traceback.format_exc())
         return f"Dashboard Error: {str(e)}", 500
 
-@app.route('/api/metrics', methods=['POST'])
-def receive_metrics():
-    """API endpoint to receive metrics from external monitoring clients."""
+@app.route('/charts/<name>.png')
+def chart_png(name):
+    """Serve one pre-rendered chart, revalidated by an ETag of the data it shows."""
     try:
-        logger.info(f"POST /api/metrics from {request.remote_addr}")
+        if name not in CHARTS:
+            return jsonify({'error': f"Unknown chart '{name}'"}), 404
         
-        data = request.get_json()
+        try:
+            png, key = chart_renderer.get(name, request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if png is None:
+            return jsonify({'error': 'Not enough data for chart (need at least 2 points)'}), 404
         
-        if not data:
-            logger.warning("✗ No data provided in request")
-            return jsonify({'error': 'No data provided'}), 400
-        
-        data['received_at'] = datetime.now().isoformat()
-        client_id = data.get('client_name') or data.get('client_id') or request.remote_addr
+        etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest() if key else None
+        if etag and request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(png)
+            response.mimetype = 'image/png'
+        if etag:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = f'public, max-age={CHART_MAX_AGE}'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error(f"✗ Chart {name} failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/series/<name>')
+def get_series(name):
+    """API endpoint with one chart's data as columns, for drawing in the browser.
+    
+    Takes the same client/window/from/to arguments as the charts. JSON
+    responses carry parallel 't' (epoch ms) and 'v' arrays; format=binary
+    returns little-endian float64 timestamps followed by float32 values, with
+    the point count in X-Series-Count.
+    """
+    try:
+        if name not in CHARTS:
+            return jsonify({'error': f"Unknown series '{name}'"}), 404
         
-        logger.info(f"Processing metrics from client: {client_id}")
+        etag = series_etag(name, request.args)
+        if etag and request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
         
-        insert_metric(client_id, data)
+        try:
+            points = get_tsdb_series_points(name, request.args)
+            if points is None:
+                chart_metrics, resolution, _ = get_chart_series(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if points is None:
+            timestamps, values = series_points(name, chart_metrics)
+            times = [epoch_ms(timestamp) for timestamp in timestamps]
+        else:
+            times, values, resolution = points
         
-        logger.info(f"✓ Metrics received successfully from {client_id}")
+        if request.args.get('format') == 'binary':
+            body = np.asarray(times, dtype='<f8').tobytes() + np.asarray(values, dtype='<f4').tobytes()
+            response = make_response(body)
+            response.mimetype = 'application/octet-stream'
+            response.headers['X-Series-Count'] = str(len(values))
+            response.headers['X-Series-Resolution'] = resolution
+        else:
+            response = jsonify({
+                'metric': name,
+                'client': request.args.get('client') or None,
+                'resolution': resolution,
+                't': np.asarray(times, dtype=np.float64).tolist(),
+                'v': np.asarray(values, dtype=np.float64).tolist()
+            })
+        if etag:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = f'public, max-age={CHART_MAX_AGE}'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.error(f"✗ Series {name} failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stream')
+def metric_stream():
+    """Server-Sent Events feed of newly ingested samples, optionally for one client.
+    
+    Each event carries the sample's id, so a browser that reconnects (for
+    example after being dropped for falling behind) resumes from the recent
+    cache via Last-Event-ID.
+    """
+    try:
+        client_id = request.args.get('client') or None
+        logger.info(f"GET /api/stream from {request.remote_addr} (client: {client_id or 'all'})")
         
-        return jsonify({
-            'status': 'success',
-            'message': 'Metrics received',
-            'client_id': client_id
-        }), 200
+        try:
+            subscription = sample_broadcaster.subscribe(client_id)
+        except TooManySubscribers as e:
+            logger.warning(f"✗ Rejecting stream subscriber: {str(e)}")
+            return jsonify({'error': str(e)}), 503
+        backlog = stream_backlog(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'),
+                                 client_id)
         
+        response = Response(stream_with_context(sse_stream(subscription, backlog, SSE_HEARTBEAT)),
+                            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+    except Exception as e:
+        logger.error(f"✗ Stream subscription failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/metrics', methods=['POST'])
+def receive_metrics():
+    """API endpoint to receive metrics from external monitoring clients."""
+    try:
+        logger.debug("POST /api/metrics from %s", request.remote_addr)
+        status, payload, headers = accept_metric(request.get_data(), request.mimetype,
+                                                 request.content_encoding, request.remote_addr)
+        return jsonify(payload), status, headers
     except Exception as e:
         logger.error(f"✗ Receive metrics failed: {str(e)}")
         logger.error(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/metrics/batch', methods=['POST'])
+def receive_metrics_batch():
+    """API endpoint to receive many samples, possibly from several clients, at once."""
+    try:
+        logger.debug("POST /api/metrics/batch from %s", request.remote_addr)
+        status, payload, headers = accept_metric_batch(request.get_data(), request.mimetype,
+                                                       request.content_encoding, request.remote_addr)
+        return jsonify(payload), status, headers
+    except Exception as e:
+        logger.error(f"✗ Receive metrics batch failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+def _stream_metrics_response(args):
+    """Stream a page of metrics after the after_id cursor as NDJSON or a JSON object."""
+    after_id = int(args.get('after_id') or 0)
+    limit = parse_limit(args, 1000, STREAM_MAX_LIMIT)
+    client_id = args.get('client') or None
+    include_raw = args.get('include_raw', '').lower() in ('1', 'true')
+    metrics = stream_metrics(after_id, limit, client_id=client_id, include_raw=include_raw)
+    
+    if args.get('format') == 'ndjson':
+        def generate():
+            for metric in metrics:
+                yield json.dumps(metric) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    def generate():
+        last_id = after_id
+        count = 0
+        yield '{"metrics": ['
+        for metric in metrics:
+            yield (',' if count else '') + json.dumps(metric)
+            last_id = metric['id']
+            count += 1
+        yield '], ' + json.dumps({
+            'total_entries': count,
+            'next_after_id': last_id if count >= limit else None
+        })[1:]
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
 @app.route('/api/metrics', methods=['GET'])
 def get_metrics():
-    """API endpoint to retrieve stored metrics."""
+    """API endpoint to retrieve stored metrics.
+    
+    With any of client, from, to or window it returns the samples in that time
+    range, oldest first, at the given resolution (raw, 1m, 1h, 1d or auto,
+    the default); otherwise the latest 1000 samples. include_raw=1 adds the
+    stored agent payload to raw samples.
+    
+    With after_id (or format=ndjson) it streams up to limit samples with a
+    larger id, in id order, as NDJSON or as a JSON object whose
+    next_after_id is the cursor for the following page.
+    """
     try:
         logger.info("GET /api/metrics")
         
-        all_metrics = get_all_metrics(limit=1000)
+        if 'after_id' in request.args or request.args.get('format') == 'ndjson':
+            try:
+                return _stream_metrics_response(request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        if any(request.args.get(key) for key in ('client', 'from', 'to', 'window')):
+            try:
+                start, end = parse_time_range(request.args)
+                limit = parse_limit(request.args, 1000, RANGE_MAX_LIMIT)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            client_id = request.args.get('client') or None
+            include_raw = request.args.get('include_raw', '').lower() in ('1', 'true')
+            resolution = request.args.get('resolution', 'auto')
+            if resolution == 'auto':
+                resolution = choose_resolution(start, end, ROLLUP_MIN_POINTS) if store.supports_rollups else 'raw'
+            if resolution != 'raw' and resolution not in RESOLUTIONS:
+                return jsonify({'error': f"Invalid resolution '{resolution}'"}), 400
+            if resolution != 'raw' and not store.supports_rollups:
+                return jsonify({'error': f"The {store.backend} storage backend keeps no rollups"}), 400
+            
+            response = {
+                'client': client_id,
+                'from': format_timestamp(start),
+                'to': format_timestamp(end),
+                'resolution': resolution
+            }
+            if resolution == 'raw':
+                metrics = get_metrics_range(start, end, client_id=client_id, limit=limit,
+                                            include_raw=include_raw)
+                response.update(total_entries=len(metrics), truncated=len(metrics) >= limit, metrics=metrics)
+            else:
+                rollups = get_rollups(resolution, start, end, client_id=client_id, limit=limit)
+                response.update(total_entries=len(rollups), truncated=len(rollups) >= limit, rollups=rollups)
+            
+            logger.info("✓ Metrics range retrieved successfully")
+            
+            return jsonify(response), 200
+        
+        include_raw = request.args.get('include_raw', '').lower() in ('1', 'true')
+        all_metrics = get_all_metrics(limit=1000, include_raw=include_raw)
         total_clients = get_total_clients()
         
         logger.info("✓ Metrics retrieved successfully")
@@ -754,16 +1766,20 @@ def get_metrics():
 
 @app.route('/api/clients', methods=['GET'])
 def get_clients():
-    """API endpoint to get list of connected clients."""
+    """API endpoint to get every client's latest state and online/offline status."""
     try:
-        logger.info("GET /api/clients")
+        status = request.args.get('status') or None
+        logger.info(f"GET /api/clients (status: {status or 'all'})")
+        if status not in (None, 'online', 'offline'):
+            return jsonify({'error': "status must be 'online' or 'offline'"}), 400
         
-        clients = get_client_list()
+        clients = get_client_list(status)
         
         logger.info("✓ Client list retrieved successfully")
         
         return jsonify({
             'total_clients': len(clients),
+            'online_clients': sum(1 for client in clients if client['status'] == 'online'),
             'clients': clients
         }), 200
     except Exception as e:
@@ -771,6 +1787,94 @@ def get_clients():
         logger.error(traceback.format_exc())
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """API endpoint with mean/min/max/stddev/percentiles and rate of change per metric.
+    
+    Takes client, metric (comma-separated, default cpu/gpu/ram/ping),
+    window/from/to like /api/metrics/range, and percentiles (default 50,90,95,99).
+    rate_of_change is the least-squares slope in units per second.
+    """
+    try:
+        client_id = request.args.get('client') or None
+        logger.info(f"GET /api/stats (client: {client_id or 'all'}, metric: {request.args.get('metric') or 'default'})")
+        try:
+            metrics = resolve_metrics(request.args.get('metric'))
+            percentiles = parse_percentiles(request.args.get('percentiles'))
+            start, end = parse_time_range(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        started = datetime.now()
+        summaries, samples, source, truncated = get_metric_stats(metrics, start, end, client_id, percentiles)
+        elapsed_ms = (datetime.now() - started).total_seconds() * 1000
+        
+        return jsonify({
+            'client': client_id,
+            'from': format_timestamp(start),
+            'to': format_timestamp(end),
+            'samples': samples,
+            'truncated': truncated,
+            'source': source,
+            'elapsed_ms': round(elapsed_ms, 3),
+            'stats': summaries
+        }), 200
+    except Exception as e:
+        logger.error(f"✗ Get stats API failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/alerts', methods=['GET'])
+def get_alerts():
+    """API endpoint to get firing (and optionally recently resolved) alerts."""
+    try:
+        client_id = request.args.get('client') or None
+        include_resolved = request.args.get('include_resolved', 'false').lower() == 'true'
+        logger.info(f"GET /api/alerts (client: {client_id or 'all'}, include_resolved: {include_resolved})")
+        
+        alerts = alert_engine.alerts(client_id, include_resolved)
+        
+        logger.info(f"✓ Retrieved {len(alerts)} alerts")
+        
+        return jsonify({
+            'enabled': ALERTS_ENABLED,
+            'firing': sum(1 for alert in alerts if alert['state'] == 'firing'),
+            'alerts': alerts,
+            'rules': [rule.describe() for rule in alert_engine.rules],
+            'stale_after_intervals': ALERT_STALE_INTERVALS,
+            'stale_max_age_seconds': ALERT_STALE_MAX_AGE
+        }), 200
+    except Exception as e:
+        logger.error(f"✗ Get alerts API failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/retention', methods=['GET'])
+def get_retention():
+    """API endpoint to report retention settings and recent purge runs."""
+    try:
+        logger.info("GET /api/retention")
+        
+        return jsonify({
+            'enabled': RETENTION_ENABLED and store.supports_rollups,
+            'retention_days': retention_job.retention,
+            'runs': retention_job.reports()
+        }), 200
+    except Exception as e:
+        logger.error(f"✗ Get retention API failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics')
+def self_metrics():
+    """Request, database, chart and ingest metrics of this process in the Prometheus text format."""
+    try:
+        return Response(telemetry.render(), content_type=METRICS_CONTENT_TYPE)
+    except Exception as e:
+        logger.error(f"✗ Metrics export failed: {str(e)}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/health')
 def health():
     """Health check endpoint for Azure."""
@@ -784,6 +1888,7 @@ def health():
         return jsonify({
             'status': 'healthy',
             'clients': total_clients,
+            **service_stats(),
             'timestamp': datetime.now().isoformat()
         }), 200
     except Exception as e:
@@ -796,14 +1901,20 @@ def health():
         }), 500
 
 # ==================== MAIN ====================
-if __name__ == '_main_':
+# Production runs under gunicorn (see gunicorn.conf.py), which initializes the
+# database once before starting its workers; this block is for local development.
+if __name__ == '__main__':
     try:
         logger.info("="*60)
         logger.info("STARTING FLASK APPLICATION")
         logger.info("="*60)
-        logger.info(f"Database Server: {DB_SERVER}")
-        logger.info(f"Database Name: {DB_NAME}")
-        logger.info(f"Database User: {DB_USER}")
+        logger.info(f"Storage Backend: {STORAGE_BACKEND}")
+        if STORAGE_BACKEND == 'sqlite':
+            logger.info(f"Database File: {SQLITE_PATH}")
+        else:
+            logger.info(f"Database Server: {DB_SERVER}")
+            logger.info(f"Database Name: {DB_NAME}")
+            logger.info(f"Database User: {DB_USER}")
         
         # Initialize database
         init_db()
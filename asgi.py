@@ -0,0 +1,205 @@
+"""ASGI entry point: non-blocking metric ingestion in front of the Flask app.
+
+POST /api/metrics and /api/metrics/batch are served on the event loop: the
+body is read asynchronously, decoded and validated, and the samples are
+queued on the app's batched writer without waiting on the database, so an
+idle agent connection costs a socket rather than a thread. GET /api/stream
+(Server-Sent Events) is also served on the loop, so open dashboards do not
+pin threads. Every other request is handed to the Flask app on a bounded
+thread pool.
+
+Production: ``gunicorn -c gunicorn.conf.py``. Development: ``uvicorn asgi:application``.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import traceback
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+import app as monitoring
+from spool import Spool
+from live_stream import TooManySubscribers, sse_stream_async
+
+logger = logging.getLogger(__name__)
+
+ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 16 * 1024 * 1024))
+# Bodies larger than this are decoded on a worker thread instead of the event loop
+ASGI_INLINE_PARSE_BYTES = int(os.environ.get('ASGI_INLINE_PARSE_BYTES', 64 * 1024))
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 16))
+
+
+class _Disconnected(Exception):
+    """The client went away before its request body was complete."""
+
+
+class _BodyTooLarge(Exception):
+    """The request body exceeds ASGI_MAX_BODY_BYTES."""
+
+
+async def _send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode('ascii'))] +
+                   [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+    return len(body)
+
+
+def _header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+class IngestionApp:
+    """ASGI app that accepts metric uploads on the event loop and delegates the rest.
+
+    With ``offload_submit`` (the default when the ingest writer is a Spool,
+    whose submit appends to a segment file) every upload is handled on a
+    worker thread, so file writes never run on the event loop.
+    """
+
+    def __init__(self, fallback, max_body_bytes=ASGI_MAX_BODY_BYTES,
+                 inline_parse_bytes=ASGI_INLINE_PARSE_BYTES, offload_submit=None):
+        self._fallback = fallback
+        self.max_body_bytes = max_body_bytes
+        self.inline_parse_bytes = inline_parse_bytes
+        if offload_submit is None:
+            offload_submit = isinstance(monitoring.ingest_writer, Spool)
+        self.offload_submit = offload_submit
+        self._routes = {
+            '/api/metrics': monitoring.accept_metric,
+            '/api/metrics/batch': monitoring.accept_metric_batch,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/api/stream':
+            monitoring.start_background_services()
+            await self._stream(scope, receive, send)
+            return
+        handler = None
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            handler = self._routes.get(scope['path'])
+        if handler is None:
+            await self._fallback(scope, receive, send)
+            return
+
+        monitoring.start_background_services()
+        started = time.perf_counter()
+        route = scope['path']
+        client = scope.get('client')
+        remote_addr = client[0] if client else None
+        content_type = (_header(scope, b'content-type') or '').split(';')[0].strip().lower()
+        content_encoding = _header(scope, b'content-encoding')
+        logger.debug("POST %s from %s", scope['path'], remote_addr)
+        try:
+            body = await self._read_body(scope, receive)
+            monitoring.request_bytes.labels(route).observe(len(body))
+            if self.offload_submit or len(body) > self.inline_parse_bytes:
+                status, payload, headers = await asyncio.to_thread(
+                    handler, body, content_type, content_encoding, remote_addr)
+            else:
+                status, payload, headers = handler(body, content_type, content_encoding, remote_addr)
+        except _Disconnected:
+            return
+        except _BodyTooLarge:
+            logger.warning(f"✗ Rejecting body over {self.max_body_bytes} bytes from {remote_addr}")
+            status, payload, headers = 413, {'error': f'Body exceeds {self.max_body_bytes} bytes'}, ()
+        except Exception as e:
+            logger.error(f"✗ Async receive metrics failed: {str(e)}")
+            logger.error(traceback.format_exc())
+            status, payload, headers = 500, {'error': str(e)}, ()
+        size = await _send_json(send, status, payload, headers)
+        monitoring.request_seconds.labels('POST', route, str(status)).observe(time.perf_counter() - started)
+        monitoring.response_bytes.labels(route).observe(size)
+
+    # ---------- request handling ----------
+    async def _read_body(self, scope, receive):
+        length = _header(scope, b'content-length')
+        if length and length.isdigit() and int(length) > self.max_body_bytes:
+            raise _BodyTooLarge()
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise _Disconnected()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_bytes:
+                raise _BodyTooLarge()
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    async def _stream(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        client_id = query.get('client', [''])[0] or None
+        client = scope.get('client')
+        logger.info(f"GET /api/stream from {client[0] if client else None} (client: {client_id or 'all'})")
+        try:
+            subscription = monitoring.sample_broadcaster.subscribe(client_id)
+        except TooManySubscribers as e:
+            logger.warning(f"✗ Rejecting stream subscriber: {str(e)}")
+            await _send_json(send, 503, {'error': str(e)})
+            return
+        last_event_id = _header(scope, b'last-event-id') or query.get('last_event_id', [''])[0]
+        events = sse_stream_async(subscription, monitoring.stream_backlog(last_event_id, client_id),
+                                  monitoring.SSE_HEARTBEAT)
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')],
+            })
+            async for chunk in events:
+                if disconnected.done():
+                    break
+                await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            await events.aclose()
+            subscription.close()
+
+    # ---------- lifecycle ----------
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    monitoring.start_background_services()
+                except Exception as e:
+                    logger.error(f"✗ Background services failed to start: {str(e)}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # Flushes the ingest queue, which blocks on the database.
+                await asyncio.to_thread(monitoring.stop_background_services)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+application = IngestionApp(WSGIMiddleware(monitoring.app, workers=ASGI_WSGI_THREADS))
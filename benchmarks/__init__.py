@@ -0,0 +1 @@
+"""Standalone benchmarks; run each with ``python -m benchmarks.<name>`` from the repository root."""
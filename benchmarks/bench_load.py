@@ -0,0 +1,485 @@
+"""Load test of the ingest and dashboard paths against a local SQLite database.
+
+    python -m benchmarks.bench_load [--agents 200] [--interval 1] [--viewers 4] [--duration 15]
+    python -m benchmarks.bench_load --save-baseline       # record benchmarks/baselines/bench_load.json
+    python -m benchmarks.bench_load --check                # exit 1 on a regression against it
+
+The app runs in this process on a threaded WSGI server with
+STORAGE_BACKEND=sqlite, everything else at its defaults, in a scratch
+directory seeded with ``--seed-minutes`` of history. Load comes from
+separate processes so it does not compete for the server's GIL:
+
+- ``--agents`` agents, each posting one sample every ``--interval`` seconds
+  on its own open-loop schedule (``--batch`` > 1 posts that many at a time
+  to /api/metrics/batch);
+- ``--viewers`` dashboard viewers, each loading the dashboard and then the
+  data of its charts (series, or PNGs with ``--chart-mode server``) every
+  ``--view-interval`` seconds.
+
+Reported per route: throughput and p50/p99 latency. Reported for the
+server: CPU per request, storage calls per request (calls made while
+serving requests; the background writers' calls are reported per second)
+and CPU per chart render. Charts render in the server process
+(CHART_RENDER_WORKERS=0) so that their CPU can be measured. Only requests
+started after ``--warmup`` seconds count.
+
+Baselines are per machine; re-record one when the hardware changes and
+compare like with like (the comparison warns when the settings differ).
+"""
+import argparse
+import heapq
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baselines', 'bench_load.json')
+
+# Storage methods counted as database calls
+STORE_METHODS = ('insert_metrics', 'latest_entries', 'entries_after', 'newest_metrics', 'metrics_range',
+                 'stream_metrics', 'totals', 'count_metrics', 'count_clients', 'client_states',
+                 'metric_columns', 'rollups', 'check')
+CHART_NAMES = ('cpu', 'ram', 'gpu', 'ping')
+
+# Result fields compared against a baseline: (path, True if higher is better)
+COMPARED = [
+    ('server.cpu_us_per_request', False),
+    ('server.db_calls_per_request', False),
+    ('server.chart_render_cpu_ms', False),
+    ('ingest.stored_per_s', True),
+]
+ROUTE_COMPARED = [('throughput_per_s', True), ('p50_ms', False), ('p99_ms', False)]
+
+
+def agent_sample(rng, client, when):
+    """One sample shaped like an agent's, with plausibly noisy values."""
+    total = (8, 16, 32, 64)[client % 4]
+    used = round(rng.uniform(0.2, 0.9) * total, 2)
+    return {
+        'client_id': f'client-{client:04d}',
+        'client_name': f'workstation-{client:04d}',
+        'timestamp': when.isoformat(timespec='milliseconds') + 'Z',
+        'cpu_percent': round(rng.uniform(0, 100), 1),
+        'gpu_percent': round(rng.uniform(0, 100), 1) if client % 3 else None,
+        'ram': {'used_gb': used, 'total_gb': float(total), 'percent': round(used / total * 100, 1)},
+        'ping_ms': round(rng.lognormvariate(3, 0.5), 1),
+        'internet_connected': rng.random() > 0.01,
+    }
+
+
+def _utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class _Client:
+    """Keep-alive HTTP connection that reconnects after errors."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        try:
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            response.read()
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return 0
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def _timed(records, record_from, route, client, method, path, body=None, headers=None):
+    started = time.time()
+    status = client.request(method, path, body, headers)
+    if started >= record_from:
+        records.append((route, time.time() - started, status))
+
+
+def _agent_thread(port, agents, interval, batch, record_from, deadline, seed, records):
+    rng = random.Random(seed)
+    client = _Client(port)
+    period = interval * batch
+    schedule = [(record_from - rng.uniform(0, period), agent) for agent in agents]
+    heapq.heapify(schedule)
+    while True:
+        due, agent = heapq.heappop(schedule)
+        if due >= deadline:
+            break
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = _utc_now()
+        if batch == 1:
+            body = json.dumps(agent_sample(rng, agent, now)).encode('utf-8')
+            _timed(records, record_from, 'POST /api/metrics', client, 'POST', '/api/metrics', body,
+                   {'Content-Type': 'application/json'})
+        else:
+            samples = [agent_sample(rng, agent, now - timedelta(seconds=interval * (batch - 1 - i)))
+                       for i in range(batch)]
+            _timed(records, record_from, 'POST /api/metrics/batch', client, 'POST', '/api/metrics/batch',
+                   json.dumps(samples).encode('utf-8'), {'Content-Type': 'application/json'})
+        heapq.heappush(schedule, (due + period, agent))
+    client.close()
+
+
+def _viewer_thread(port, view_interval, chart_mode, window, record_from, deadline, seed, records):
+    rng = random.Random(seed)
+    client = _Client(port)
+    query = f'window={window}' if window else ''
+    time.sleep(rng.uniform(0, view_interval))
+    while time.time() < deadline:
+        started = time.time()
+        _timed(records, record_from, 'GET /', client, 'GET', '/?' + query)
+        for name in CHART_NAMES:
+            if chart_mode == 'server':
+                _timed(records, record_from, 'GET /charts/<name>.png', client, 'GET', f'/charts/{name}.png?{query}')
+            else:
+                _timed(records, record_from, 'GET /api/series/<name>', client, 'GET',
+                       f'/api/series/{name}?format=binary&{query}')
+        time.sleep(max(0.0, view_interval - (time.time() - started)))
+    client.close()
+
+
+def _load_process(kind, port, assignments, options, record_from, deadline, results):
+    """Run load threads in a child process and send their (route, seconds, status) records back."""
+    records = []
+    threads = []
+    for assignment in assignments:
+        if kind == 'agents':
+            args = (port, assignment, options['interval'], options['batch'], record_from, deadline,
+                    assignment[0], records)
+            target = _agent_thread
+        else:
+            args = (port, options['view_interval'], options['chart_mode'], options['window'], record_from,
+                    deadline, -1 - assignment, records)
+            target = _viewer_thread
+        threads.append(threading.Thread(target=target, args=args, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(records)
+
+
+def _percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+class _Probe:
+    """Server-side counters: storage calls (request vs background threads) and chart render CPU."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.request_calls = {}
+        self.background_calls = {}
+        self.stored = 0
+        self.renders = 0
+        self.render_cpu = 0.0
+
+    def wrap_wsgi(self, wsgi_app):
+        def wrapped(environ, start_response):
+            self.local.in_request = True
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                self.local.in_request = False
+        return wrapped
+
+    def wrap_method(self, name, method):
+        def wrapped(store, *args, **kwargs):
+            calls = self.request_calls if getattr(self.local, 'in_request', False) else self.background_calls
+            with self.lock:
+                calls[name] = calls.get(name, 0) + 1
+                if name == 'insert_metrics':
+                    self.stored += len(args[0])
+            return method(store, *args, **kwargs)
+        return wrapped
+
+    def wrap_render(self, render):
+        def wrapped(*args, **kwargs):
+            started = time.thread_time()
+            try:
+                return render(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.renders += 1
+                    self.render_cpu += time.thread_time() - started
+        return wrapped
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'request_calls': dict(self.request_calls),
+                'background_calls': dict(self.background_calls),
+                'stored': self.stored,
+                'renders': self.renders,
+                'render_cpu': self.render_cpu,
+                'cpu': time.process_time(),
+                'time': time.time(),
+            }
+
+
+def _start_app(workdir, options, probe):
+    """Import the app against a SQLite database in ``workdir`` and serve it on a free port."""
+    os.environ.update({
+        'STORAGE_BACKEND': 'sqlite',
+        'SQLITE_PATH': os.path.join(workdir, 'metrics.db'),
+        'SPOOL_DIR': os.path.join(workdir, 'spool'),
+        'TSDB_DIR': os.path.join(workdir, 'tsdb'),
+        'ALERT_LOCK_FILE': os.path.join(workdir, 'alerts.lock'),
+        'CHART_RENDER_WORKERS': '0',
+        'CHART_MODE': options['chart_mode'],
+    })
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    os.chdir(workdir)  # app.log and any other relative paths land in the scratch directory
+
+    import storage
+    for name in STORE_METHODS:
+        setattr(storage.SQLiteStore, name, probe.wrap_method(name, getattr(storage.SQLiteStore, name)))
+    import charts
+    charts.render_chart = probe.wrap_render(charts.render_chart)
+
+    # Log handlers keep their formatting and file writes, but console output is discarded
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        import app
+    finally:
+        sys.stderr = stderr
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    app.init_db()
+    rng = random.Random(0)
+    now = _utc_now()
+    steps = int(options['seed_minutes'] * 60 / options['interval'])
+    batch = []
+    for step in range(steps):
+        when = now - timedelta(seconds=(steps - step) * options['interval'])
+        for agent in range(options['agents']):
+            sample = agent_sample(rng, agent, when)
+            batch.append((sample['client_id'], sample))
+        if len(batch) >= 5000 or step == steps - 1:
+            app.insert_metrics(batch)
+            batch = []
+
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+    server = make_server('127.0.0.1', 0, probe.wrap_wsgi(app.app.wsgi_app), threaded=True, request_handler=Handler)
+    thread = threading.Thread(target=server.serve_forever, name='bench-server', daemon=True)
+    thread.start()
+    return app, server
+
+
+def run(options):
+    probe = _Probe()
+    original_cwd = os.getcwd()
+    app = server = None
+    with tempfile.TemporaryDirectory(prefix='bench_load-') as workdir:
+        try:
+            app, server = _start_app(workdir, options, probe)
+            port = server.server_address[1]
+            _Client(port).request('GET', '/health')  # starts the background services
+            time.sleep(1)
+
+            context = multiprocessing.get_context('spawn')
+            results = context.Queue()
+            record_from = time.time() + 1 + options['warmup']
+            deadline = record_from + options['duration']
+            agents = list(range(options['agents']))
+            connections = max(1, options['connections'])
+            processes = []
+            for p in range(max(1, options['agent_processes'])):
+                mine = agents[p::max(1, options['agent_processes'])]
+                assignments = [mine[c::connections] for c in range(connections) if mine[c::connections]]
+                processes.append(context.Process(target=_load_process, args=(
+                    'agents', port, assignments, options, record_from, deadline, results)))
+            if options['viewers']:
+                processes.append(context.Process(target=_load_process, args=(
+                    'viewers', port, list(range(options['viewers'])), options, record_from, deadline, results)))
+            for process in processes:
+                process.start()
+
+            time.sleep(max(0.0, record_from - time.time()))
+            before = probe.snapshot()
+            time.sleep(max(0.0, deadline - time.time()))
+            after = probe.snapshot()
+            records = []
+            for _ in processes:
+                records.extend(results.get(timeout=60 + options['duration']))
+            for process in processes:
+                process.join()
+        finally:
+            if server is not None:
+                server.shutdown()
+            if app is not None:
+                app.stop_background_services()
+                # The log file lives in workdir; stop writing to it before it is removed
+                app.log_pipeline.stop()
+            os.chdir(original_cwd)
+    return summarize(options, records, before, after)
+
+
+def summarize(options, records, before, after):
+    elapsed = after['time'] - before['time']
+    routes = {}
+    for route in sorted({record[0] for record in records}):
+        latencies = [seconds for name, seconds, status in records if name == route]
+        errors = sum(1 for name, _, status in records if name == route and not 200 <= status < 400)
+        routes[route] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput_per_s': round(len(latencies) / options['duration'], 2),
+            'p50_ms': round(_percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(_percentile(latencies, 99) * 1000, 3),
+        }
+    requests = len(records)
+
+    def delta(key):
+        return {name: after[key].get(name, 0) - before[key].get(name, 0)
+                for name in after[key] if after[key].get(name, 0) - before[key].get(name, 0)}
+
+    request_calls, background_calls = delta('request_calls'), delta('background_calls')
+    renders = after['renders'] - before['renders']
+    render_cpu = after['render_cpu'] - before['render_cpu']
+    cpu = after['cpu'] - before['cpu']
+    return {
+        'settings': {key: options[key] for key in ('agents', 'interval', 'batch', 'viewers', 'view_interval',
+                                                   'chart_mode', 'window', 'duration', 'seed_minutes')},
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpus': os.cpu_count()},
+        'routes': routes,
+        'ingest': {
+            'target_per_s': round(options['agents'] / options['interval'], 2),
+            'stored_per_s': round((after['stored'] - before['stored']) / elapsed, 2),
+        },
+        'server': {
+            'cpu_percent': round(cpu / elapsed * 100, 1),
+            'cpu_us_per_request': round(cpu / requests * 1e6, 1) if requests else None,
+            'db_calls_per_request': round(sum(request_calls.values()) / requests, 3) if requests else None,
+            'db_calls_by_method': request_calls,
+            'background_db_calls_per_s': round(sum(background_calls.values()) / elapsed, 2),
+            'background_db_calls_by_method': background_calls,
+            'chart_renders': renders,
+            'chart_render_cpu_ms': round(render_cpu / renders * 1000, 3) if renders else None,
+            'chart_render_cpu_percent': round(render_cpu / cpu * 100, 1) if cpu else None,
+        },
+    }
+
+
+def _lookup(result, path):
+    value = result
+    for part in path:
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def compare(result, baseline, tolerance):
+    """Rows of (metric, baseline, current, relative change, regressed) for the compared fields."""
+    fields = [(path.split('.'), higher) for path, higher in COMPARED]
+    for route in sorted(set(result['routes']) | set(baseline['routes'])):
+        fields.extend((['routes', route, name], higher) for name, higher in ROUTE_COMPARED)
+    rows = []
+    for path, higher in fields:
+        old, new = _lookup(baseline, path), _lookup(result, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher else change
+        rows.append(('.'.join(path), old, new, change, worse > tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', type=int, default=200, help='number of simulated agents')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between samples per agent')
+    parser.add_argument('--batch', type=int, default=1, help='samples per agent request')
+    parser.add_argument('--viewers', type=int, default=4, help='number of simulated dashboard viewers')
+    parser.add_argument('--view-interval', type=float, default=2.0, help='seconds between dashboard loads')
+    parser.add_argument('--chart-mode', choices=('client', 'server'), default='client',
+                        help='fetch chart series (client) or rendered PNGs (server)')
+    parser.add_argument('--window', default='', help='dashboard time window, e.g. 1h (default: latest samples)')
+    parser.add_argument('--duration', type=float, default=15.0, help='seconds of measured load')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds of unmeasured load first')
+    parser.add_argument('--seed-minutes', type=float, default=10.0, help='minutes of history to preload')
+    parser.add_argument('--agent-processes', type=int, default=2, help='processes generating agent load')
+    parser.add_argument('--connections', type=int, default=8, help='connections per agent process')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative change counted as a regression')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    options = {key: getattr(args, key) for key in (
+        'agents', 'interval', 'batch', 'viewers', 'view_interval', 'chart_mode', 'window', 'duration',
+        'warmup', 'seed_minutes', 'agent_processes', 'connections')}
+    result = run(options)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"{args.agents} agents every {args.interval:g}s, {args.viewers} viewers every "
+              f"{args.view_interval:g}s, {args.duration:g}s measured")
+        print(f"{'route':<28} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+        for route, row in result['routes'].items():
+            print(f"{route:<28} {row['requests']:>9} {row['errors']:>7} {row['throughput_per_s']:>9} "
+                  f"{row['p50_ms']:>9} {row['p99_ms']:>9}")
+        print(f"ingest: {result['ingest']['stored_per_s']} samples/s stored "
+              f"(target {result['ingest']['target_per_s']})")
+        for key, value in result['server'].items():
+            print(f"server {key}: {value}")
+
+    regressed = False
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != result['settings']:
+            print("warning: the baseline was recorded with different settings:", baseline.get('settings'))
+        print(f"\nAgainst {os.path.relpath(args.baseline)} (tolerance {args.tolerance:.0%}):")
+        for name, old, new, change, worse in compare(result, baseline, args.tolerance):
+            regressed = regressed or worse
+            print(f"  {name:<48} {old:>10} -> {new:<10} {change:+7.1%}{'  REGRESSION' if worse else ''}")
+    if args.check and regressed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
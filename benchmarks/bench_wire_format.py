@@ -0,0 +1,132 @@
+"""Bytes on the wire and server-side decode cost of each ingestion format.
+
+    python -m benchmarks.bench_wire_format [--agents 2000] [--interval 5] [--batch 1 100]
+
+Every combination of body format (JSON, MessagePack, struct records) and
+Content-Encoding (identity, gzip, zstd when installed) is encoded once per
+batch size and then decoded repeatedly the way the ingestion endpoints do it
+(decompress, then decode). Results are reported per sample and scaled to a
+fleet of ``--agents`` agents each sending one sample every ``--interval``
+seconds. HTTP framing and database writes are not included.
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import wire_format
+from wire_format import MSGPACK_CONTENT_TYPES, STRUCT_CONTENT_TYPE
+
+FORMATS = {
+    'json': 'application/json',
+    'msgpack': MSGPACK_CONTENT_TYPES[0],
+    'struct': STRUCT_CONTENT_TYPE,
+}
+
+
+def make_samples(count, clients=50, seed=1):
+    """Samples shaped like the ones agents post, with plausibly noisy values."""
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1)
+    samples = []
+    for i in range(count):
+        client = i % clients
+        total = (8, 16, 32, 64)[client % 4]
+        used = round(rng.uniform(0.2, 0.9) * total, 2)
+        samples.append({
+            'client_id': f'client-{client:04d}',
+            'client_name': f'workstation-{client:04d}',
+            'timestamp': (start + timedelta(seconds=5 * (i // clients))).isoformat(timespec='milliseconds'),
+            'cpu_percent': round(rng.uniform(0, 100), 1),
+            'gpu_percent': round(rng.uniform(0, 100), 1) if client % 3 else None,
+            'ram': {'used_gb': used, 'total_gb': float(total), 'percent': round(used / total * 100, 1)},
+            'ping_ms': round(rng.lognormvariate(3, 0.5), 1),
+            'internet_connected': rng.random() > 0.01,
+        })
+    return samples
+
+
+def encode(samples, content_type, encoding, single):
+    if single and content_type == 'application/json':
+        body = json.dumps(samples[0]).encode('utf-8')
+    else:
+        body = wire_format.encode_samples(samples, content_type)
+    return wire_format.encode_body(body, encoding)
+
+
+def decode(body, content_type, encoding, single):
+    body = wire_format.decode_body(body, encoding, 64 * 1024 * 1024)
+    if single:
+        return [wire_format.decode_sample(body, content_type)]
+    if content_type == 'application/json':
+        return json.loads(body)
+    return wire_format.decode_samples(body, content_type)
+
+
+def measure(body, content_type, encoding, single, samples_per_body, min_time=0.2):
+    """Best-of-5 decode time per sample in microseconds."""
+    best = float('inf')
+    for _ in range(5):
+        loops = 0
+        started = time.perf_counter()
+        while True:
+            decode(body, content_type, encoding, single)
+            loops += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_time / 5:
+                break
+        best = min(best, elapsed / loops)
+    return best / samples_per_body * 1e6
+
+
+def run(batch_sizes, agents, interval):
+    encodings = ['identity', 'gzip'] + (['zstd'] if wire_format.zstandard is not None else [])
+    formats = {name: ct for name, ct in FORMATS.items()
+               if name != 'msgpack' or wire_format.msgpack is not None}
+    rate = agents / interval
+    results = []
+    for batch in batch_sizes:
+        samples = make_samples(batch)
+        single = batch == 1
+        for name, content_type in formats.items():
+            for encoding in encodings:
+                body = encode(samples, content_type, encoding, single)
+                assert len(decode(body, content_type, encoding, single)) == batch
+                per_sample = len(body) / batch
+                decode_us = measure(body, content_type, encoding, single, batch)
+                results.append({
+                    'batch': batch,
+                    'format': name,
+                    'encoding': encoding,
+                    'bytes_per_sample': round(per_sample, 1),
+                    'decode_us_per_sample': round(decode_us, 2),
+                    'fleet_kib_per_s': round(per_sample * rate / 1024, 1),
+                    'fleet_decode_cpu_percent': round(decode_us * rate / 1e6 * 100, 2),
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--agents', type=int, default=2000, help='number of agents in the fleet')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds between samples per agent')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 100], help='samples per request')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    results = run(args.batch, args.agents, args.interval)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.agents} agents, one sample every {args.interval:g}s "
+          f"({args.agents / args.interval:,.0f} samples/s)")
+    print(f"{'batch':>5}  {'format':<8} {'encoding':<9} {'B/sample':>9} {'us/sample':>10} "
+          f"{'fleet KiB/s':>12} {'fleet CPU %':>12}")
+    for row in results:
+        print(f"{row['batch']:>5}  {row['format']:<8} {row['encoding']:<9} {row['bytes_per_sample']:>9} "
+              f"{row['decode_us_per_sample']:>10} {row['fleet_kib_per_s']:>12} {row['fleet_decode_cpu_percent']:>12}")
+
+
+if __name__ == '__main__':
+    main()
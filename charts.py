@@ -0,0 +1,383 @@
+"""Dashboard chart definitions, PNG rendering and an LRU cache of rendered charts."""
+import io
+import time
+import threading
+import logging
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')  # Use non-interactive backend
+import matplotlib.pyplot as plt
+
+logger = logging.getLogger(__name__)
+
+# Chart name (as used in /charts/<name>.png) -> how to draw it
+CHARTS = {
+    'cpu': {
+        'display_name': 'CPU Usage',
+        'title': 'CPU Usage Over Time',
+        'ylabel': 'CPU Usage (%)',
+        'color': '#667eea',
+        'ylim': (0, 100),
+        'value': lambda m: m.get('cpu_percent'),
+    },
+    'ram': {
+        'display_name': 'RAM Usage',
+        'title': 'RAM Usage Over Time',
+        'ylabel': 'RAM Usage (%)',
+        'color': '#764ba2',
+        'ylim': (0, 100),
+        'value': lambda m: (m.get('ram') or {}).get('percent'),
+    },
+    'gpu': {
+        'display_name': 'GPU Usage',
+        'title': 'GPU Usage Over Time',
+        'ylabel': 'GPU Usage (%)',
+        'color': '#22c55e',
+        'ylim': (0, 100),
+        'value': lambda m: m.get('gpu_percent'),
+    },
+    'ping': {
+        'display_name': 'Network Latency',
+        'title': 'Network Latency Over Time',
+        'ylabel': 'Ping (ms)',
+        'color': '#f59e0b',
+        'ylim': None,
+        'value': lambda m: m.get('ping_ms'),
+    },
+}
+
+
+def chart_label(timestamp, long_span):
+    """Axis label for a sample: time of day, or date and time for multi-day charts."""
+    if long_span:
+        return timestamp[5:16].replace('T', ' ')
+    return timestamp[11:19]
+
+
+def chart_points(name, metrics_list, long_span=False):
+    """(labels, values) for one chart, skipping samples without that metric."""
+    value = CHARTS[name]['value']
+    labels = []
+    values = []
+    for m in metrics_list:
+        v = value(m)
+        if v is not None:
+            labels.append(chart_label(m.get('timestamp') or '', long_span))
+            values.append(v)
+    return labels, values
+
+
+def series_points(name, metrics_list):
+    """(timestamps, values) for one chart, skipping samples without that metric."""
+    value = CHARTS[name]['value']
+    timestamps = []
+    values = []
+    for m in metrics_list:
+        v = value(m)
+        if v is not None and m.get('timestamp'):
+            timestamps.append(m['timestamp'])
+            values.append(v)
+    return timestamps, values
+
+
+def available_charts(metrics_list, long_span=False):
+    """Names of the charts that have at least two points to draw."""
+    return [name for name in CHARTS if len(chart_points(name, metrics_list, long_span)[1]) > 1]
+
+
+# Per-process Figure/Axes/Line reused for every render of a chart type
+_FIGURES = {}
+_figures_lock = threading.Lock()
+MAX_TICKS = 12
+
+
+def _figure_for(name):
+    figure = _FIGURES.get(name)
+    if figure is None:
+        spec = CHARTS[name]
+        fig, ax = plt.subplots(figsize=(8, 4))
+        line, = ax.plot([], [], marker='o', linewidth=2, markersize=4, color=spec['color'])
+        ax.set_xlabel('Time')
+        ax.set_ylabel(spec['ylabel'])
+        ax.set_title(spec['title'])
+        ax.grid(True, alpha=0.3)
+        if spec['ylim']:
+            ax.set_ylim(*spec['ylim'])
+        fig.subplots_adjust(left=0.1, right=0.97, top=0.9, bottom=0.28)
+        figure = _FIGURES[name] = (fig, ax, line)
+    return figure
+
+
+def render_chart(name, labels, values):
+    """Render one chart to PNG bytes, reusing this process's figure for the chart type."""
+    spec = CHARTS[name]
+    logger.debug(f"Generating {spec['display_name']} chart...")
+    with _figures_lock:
+        fig, ax, line = _figure_for(name)
+        count = len(values)
+        line.set_data(range(count), values)
+        ax.set_xlim(-0.5, count - 0.5)
+        step = max(1, -(-count // MAX_TICKS))
+        ticks = list(range(0, count, step))
+        ax.set_xticks(ticks)
+        ax.set_xticklabels([labels[i] for i in ticks], rotation=45, ha='right')
+        if not spec['ylim']:
+            ax.relim()
+            ax.autoscale_view(scalex=False)
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=100)
+    logger.debug(f"✓ {spec['display_name']} chart generated")
+    return buf.getvalue()
+
+
+class ChartRenderer:
+    """Render charts off the request thread and keep hot charts pre-rendered.
+
+    PNGs are produced in a pool of ``workers`` processes (``workers=0``
+    renders in the calling thread instead), so matplotlib never holds the
+    request worker's GIL. Rendered charts land in ``cache`` under
+    ``(name, client, window, version)``, where ``version(client)`` is the
+    version of the data a chart of that client (None: all clients) shows,
+    or None while it is unknown.
+
+    A request for a chart whose current version is not rendered yet gets the
+    newest earlier rendering of the same chart while the new one is
+    produced; only the very first request for a chart waits for a render.
+    Charts requested within the last ``hot_ttl`` seconds are re-rendered on
+    a refresh thread, at most every ``min_refresh_interval`` seconds, when
+    ``refresh()`` reports new data; ``refresh()`` itself only wakes that
+    thread, so it is safe to call from the recent cache's listener thread. Only charts that
+    had data to draw and pass ``keep_hot(args)`` (when given) count as hot,
+    and at most ``max_hot`` of them (default: the cache's entry count), least
+    recently requested dropped first.
+
+    ``on_render(name, seconds)``, when given, is called after every successful
+    render with the time from submitting it to its PNG.
+    """
+
+    def __init__(self, cache, load_points, version, workers=2, hot_ttl=300.0,
+                 min_refresh_interval=5.0, render_timeout=30.0, on_render=None, keep_hot=None,
+                 max_hot=None):
+        self._cache = cache
+        self._load_points = load_points
+        self._version = version
+        self.workers = workers
+        self.hot_ttl = hot_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.render_timeout = render_timeout
+        self._on_render = on_render
+        self._keep_hot = keep_hot
+        self.max_hot = max_hot if max_hot is not None else cache.max_entries
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._latest = {}
+        self._hot = OrderedDict()
+        self._refresh_wanted = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._renders = 0
+        self._render_time = 0.0
+        self._stale_served = 0
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self.workers and self._executor is None:
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._refresh_loop, name='chart-refresh', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._refresh_wanted.set()
+        if self._thread is not None:
+            self._thread.join(5)
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': len(self._pending),
+                'hot_charts': len(self._hot),
+                'renders': self._renders,
+                'avg_render_ms': round(self._render_time / self._renders * 1000, 3) if self._renders else 0.0,
+                'stale_served': self._stale_served,
+            }
+
+    # ---------- request path ----------
+    def get(self, name, args):
+        """Return (png, key) for a chart, or (None, None) when there is too little data.
+
+        ``key`` identifies the data the PNG was rendered from and is None when
+        the PNG must not be cached by clients.
+        """
+        base = (name, args.get('client') or None,
+                tuple(args.get(k) or '' for k in ('window', 'from', 'to')))
+        version = self._version(base[1])
+        key = base + (version,) if version is not None else None
+
+        if key is not None:
+            png = self._cache.get(key)
+            if png is not None:
+                self._touch(base, args)
+                return png, key
+
+        future = self._submit(name, args, key)
+        if future is None:
+            return None, None
+        self._touch(base, args)
+
+        with self._lock:
+            stale_key = self._latest.get(base)
+        stale = self._cache.get(stale_key) if stale_key and key is not None else None
+        if stale is not None:
+            with self._lock:
+                self._stale_served += 1
+            return stale, stale_key
+        return future.result(timeout=self.render_timeout), key
+
+    # ---------- background refresh ----------
+    def refresh(self, *_):
+        """Ask the refresh thread to re-render hot charts for the current data version."""
+        self._refresh_wanted.set()
+
+    def _refresh_loop(self):
+        while not self._stopping.is_set():
+            self._refresh_wanted.wait()
+            if self._stopping.is_set():
+                break
+            self._refresh_wanted.clear()
+            try:
+                self._refresh_hot()
+            except Exception as e:
+                logger.error(f"✗ Chart refresh failed: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._stopping.wait(self.min_refresh_interval)
+
+    def _refresh_hot(self):
+        """Render every hot chart whose current version is not cached yet."""
+        now = time.monotonic()
+        with self._lock:
+            for base, (_, accessed) in list(self._hot.items()):
+                if now - accessed > self.hot_ttl:
+                    del self._hot[base]
+            hot = list(self._hot.items())
+        for base, (args, _) in hot:
+            version = self._version(base[1])
+            if version is None:
+                continue
+            key = base + (version,)
+            if self._cache.get(key) is None:
+                try:
+                    self._submit(base[0], args, key)
+                except Exception as e:
+                    logger.error(f"✗ Background render of {base[0]} chart failed: {str(e)}")
+
+    # ---------- internals ----------
+    def _touch(self, base, args):
+        if self._keep_hot is not None and not self._keep_hot(args):
+            return
+        with self._lock:
+            self._hot[base] = (dict(args), time.monotonic())
+            self._hot.move_to_end(base)
+            while len(self._hot) > self.max_hot:
+                self._hot.popitem(last=False)
+
+    def _submit(self, name, args, key):
+        with self._lock:
+            future = self._pending.get(key) if key is not None else None
+        if future is not None:
+            return future
+
+        labels, values = self._load_points(name, args)
+        if len(values) < 2:
+            return None
+
+        started = time.perf_counter()
+        if self._executor is None:
+            future = Future()
+            future.set_result(render_chart(name, labels, values))
+        else:
+            future = self._executor.submit(render_chart, name, labels, values)
+        if key is not None:
+            with self._lock:
+                self._pending[key] = future
+        future.add_done_callback(lambda done: self._finished(name, key, done, started))
+        return future
+
+    def _finished(self, name, key, future, started):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            if key is not None:
+                self._pending.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._renders += 1
+            self._render_time += elapsed
+            if key is not None:
+                self._latest[key[:3]] = key
+        if self._on_render is not None:
+            self._on_render(name, elapsed)
+        if key is not None:
+            self._cache.put(key, future.result())
+
+
+class ChartCache:
+    """LRU cache of rendered PNGs bounded by entry count and total bytes."""
+
+    def __init__(self, max_entries=256, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            png = self._entries.get(key)
+            if png is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = png
+            self._bytes += len(png)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+            }
@@ -0,0 +1,336 @@
+"""Latest known state of every client, kept current on ingest.
+
+``client_state`` holds one row per client id: when it was first and last
+seen, its most recent values and how many samples it has sent. Each ingest
+batch upserts it in the same transaction as the raw insert, so listing
+clients is a scan over clients rather than a GROUP BY over every sample.
+A client that changes its display name keeps one row under its id.
+"""
+import threading
+import logging
+import traceback
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Columns carried over from the newest sample (in metrics INSERT parameter order)
+VALUE_COLUMNS = ('cpu_percent', 'gpu_percent', 'ram_used_gb', 'ram_total_gb', 'ram_percent',
+                 'ping_ms', 'internet_connected')
+
+CREATE_CLIENT_STATE_TABLE = '''
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='client_state' AND xtype='U')
+    CREATE TABLE client_state (
+        client_id NVARCHAR(255) PRIMARY KEY,
+        client_name NVARCHAR(255),
+        first_seen DATETIME2(3) NOT NULL,
+        last_seen DATETIME2(3) NOT NULL,
+        last_received_at DATETIME2(3) NOT NULL,
+        cpu_percent FLOAT,
+        gpu_percent FLOAT,
+        ram_used_gb FLOAT,
+        ram_total_gb FLOAT,
+        ram_percent FLOAT,
+        ping_ms FLOAT,
+        internet_connected BIT,
+        sample_count BIGINT NOT NULL
+    )
+'''
+
+# One-time fill from existing history, when the table is first created
+BACKFILL_CLIENT_STATE = f'''
+    IF NOT EXISTS (SELECT * FROM client_state)
+    INSERT INTO client_state (client_id, client_name, first_seen, last_seen, last_received_at,
+                              {', '.join(VALUE_COLUMNS)}, sample_count)
+    SELECT client_id, client_name, first_seen, timestamp, last_received_at,
+           {', '.join(VALUE_COLUMNS)}, sample_count
+    FROM (
+        SELECT client_id, client_name, timestamp, {', '.join(VALUE_COLUMNS)},
+               ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY timestamp DESC, id DESC) AS newest,
+               MIN(timestamp) OVER (PARTITION BY client_id) AS first_seen,
+               MAX(received_at) OVER (PARTITION BY client_id) AS last_received_at,
+               COUNT_BIG(*) OVER (PARTITION BY client_id) AS sample_count
+        FROM metrics
+    ) AS ranked
+    WHERE newest = 1
+'''
+
+# Values only move forward in sample time, so a late (replayed or backfilled)
+# batch adds to the count without overwriting newer values.
+_NEWER = 's.last_seen >= t.last_seen'
+# SQL Server allows at most 2100 parameters per statement
+MAX_MERGE_CLIENTS = 2000 // (len(VALUE_COLUMNS) + 6)
+_STATE_COLUMNS = ('client_id', 'client_name', 'first_seen', 'last_seen', 'last_received_at',
+                  *VALUE_COLUMNS, 'sample_count')
+_STATE_ROW = '(' + ', '.join('?' * len(_STATE_COLUMNS)) + ')'
+
+
+def _merge_client_states_sql(count):
+    """A MERGE of ``count`` client_state parameter rows, supplied as one VALUES list."""
+    return f'''
+    MERGE client_state WITH (HOLDLOCK) AS t
+    USING (VALUES {', '.join([_STATE_ROW] * count)})
+        AS s ({', '.join(_STATE_COLUMNS)})
+    ON t.client_id = s.client_id
+    WHEN MATCHED THEN UPDATE SET
+        sample_count = t.sample_count + s.sample_count,
+        first_seen = CASE WHEN s.first_seen < t.first_seen THEN s.first_seen ELSE t.first_seen END,
+        last_received_at = CASE WHEN s.last_received_at > t.last_received_at
+                                THEN s.last_received_at ELSE t.last_received_at END,
+        client_name = CASE WHEN {_NEWER} THEN COALESCE(s.client_name, t.client_name) ELSE t.client_name END,
+        {', '.join(f'{column} = CASE WHEN {_NEWER} THEN s.{column} ELSE t.{column} END' for column in VALUE_COLUMNS)},
+        last_seen = CASE WHEN {_NEWER} THEN s.last_seen ELSE t.last_seen END
+    WHEN NOT MATCHED THEN INSERT ({', '.join(_STATE_COLUMNS)})
+        VALUES ({', '.join(f's.{column}' for column in _STATE_COLUMNS)});
+'''
+
+
+def client_state_params(rows):
+    """Collapse a batch into one state parameter tuple per client, in client id order.
+
+    ``rows`` are ``(client_id, client_name, timestamp, received_at, *VALUE_COLUMNS)``
+    tuples, i.e. the leading metrics INSERT parameters. Each result is
+    ``(client_id, client_name, first_seen, last_seen, last_received_at,
+    *VALUE_COLUMNS, sample_count)`` taken from the client's newest sample.
+    """
+    states = {}
+    for row in rows:
+        client_id, client_name, timestamp, received_at = row[:4]
+        state = states.get(client_id)
+        if state is None:
+            states[client_id] = [row, timestamp, received_at, 1]
+            continue
+        if timestamp >= state[0][2]:
+            state[0] = row
+        state[1] = min(state[1], timestamp)
+        state[2] = max(state[2], received_at)
+        state[3] += 1
+    params = []
+    for client_id in sorted(states):
+        newest, first_seen, last_received_at, count = states[client_id]
+        params.append((client_id, newest[1], first_seen, newest[2], last_received_at,
+                       *newest[4:4 + len(VALUE_COLUMNS)], count))
+    return params
+
+
+def upsert_client_states(cursor, rows):
+    """Fold a batch of metrics INSERT parameter rows into ``client_state``.
+
+    The newest state per client is worked out here, so the whole batch is
+    one set-based MERGE over a VALUES list (split only when a batch has more
+    than MAX_MERGE_CLIENTS clients), rather than a round trip per client.
+    Returns the number of clients touched.
+    """
+    params = client_state_params(rows)
+    for i in range(0, len(params), MAX_MERGE_CLIENTS):
+        chunk = params[i:i + MAX_MERGE_CLIENTS]
+        cursor.execute(_merge_client_states_sql(len(chunk)), [value for param in chunk for value in param])
+    return len(params)
+
+
+def discount_client_states(cursor, client_ids):
+    """Take purged samples out of ``client_state.sample_count``.
+
+    ``client_ids`` has one entry per deleted metrics row. The other columns
+    are left alone: first_seen and the latest values describe the client,
+    not what the table still holds. Returns the number of clients touched.
+    """
+    counts = {}
+    for client_id in client_ids:
+        counts[client_id] = counts.get(client_id, 0) + 1
+    params = sorted(counts.items())
+    # Two parameters per client, within SQL Server's 2100-parameter limit
+    for i in range(0, len(params), 1000):
+        chunk = params[i:i + 1000]
+        cursor.execute(f'''
+            UPDATE t SET sample_count = CASE WHEN t.sample_count > s.purged THEN t.sample_count - s.purged ELSE 0 END
+            FROM client_state AS t
+            JOIN (VALUES {', '.join(['(?, ?)'] * len(chunk))}) AS s (client_id, purged) ON t.client_id = s.client_id
+        ''', [value for param in chunk for value in param])
+    return len(params)
+
+
+def load_client_states(pool):
+    """Read every client's state row, plus the highest metrics id at the time."""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT client_id, client_name, first_seen, last_seen, last_received_at,
+                   {', '.join(VALUE_COLUMNS)}, sample_count
+            FROM client_state
+        ''')
+        rows = cursor.fetchall()
+        cursor.execute('SELECT MAX(id) AS max_id FROM metrics')
+        max_id = cursor.fetchone().max_id
+    states = [{
+        'client_id': row.client_id,
+        'client_name': row.client_name,
+        'first_seen': row.first_seen,
+        'last_seen': row.last_seen,
+        'last_received_at': row.last_received_at,
+        **{column: getattr(row, column) for column in VALUE_COLUMNS},
+        'sample_count': row.sample_count,
+    } for row in rows]
+    return states, max_id
+
+
+def _parse(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _format(value):
+    return value.isoformat(timespec='milliseconds') if value is not None else None
+
+
+class ClientStateIndex:
+    """In-memory copy of ``client_state`` for lookups that never touch the database.
+
+    Loaded from the table every ``reload_interval`` seconds and advanced in
+    between by ``observe()``, a recent-cache listener, so it sees samples
+    ingested by any worker. Samples with an id at or below the id watermark
+    of the last load are already counted and are ignored. A client is
+    ``online`` if a sample from it arrived within ``offline_after`` seconds.
+    """
+
+    def __init__(self, load_states, offline_after=120.0, reload_interval=300.0):
+        self._load_states = load_states
+        self.offline_after = offline_after
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._states = {}
+        self._loaded_max_id = 0
+        self._ready = False
+        self._reloads = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def observe(self, entries):
+        """Fold newly committed (id, metric) pairs into the client states."""
+        with self._lock:
+            for metric_id, metric in entries:
+                if metric_id <= self._loaded_max_id:
+                    continue
+                self._observe_locked(metric)
+
+    def reload(self):
+        """Replace the index with the table's contents."""
+        states, max_id = self._load_states()
+        with self._lock:
+            self._states = {state['client_id']: state for state in states}
+            self._loaded_max_id = max_id or 0
+            self._ready = True
+            self._reloads += 1
+
+    def clients(self, status=None, now=None):
+        """Every client's state as API dicts, optionally only 'online' or 'offline' ones."""
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            states = list(self._states.values())
+        return describe_clients(states, self.offline_after, now, status)
+
+    def has_client(self, client_id):
+        """True if the client has sent at least one sample."""
+        with self._lock:
+            return client_id in self._states
+
+    def last_received(self):
+        """(client_id, client_name, last_received_at) for every client."""
+        with self._lock:
+            return [(state['client_id'], state['client_name'], state['last_received_at'])
+                    for state in self._states.values()]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'clients': len(self._states),
+                'reloads': self._reloads,
+                'offline_after': self.offline_after,
+            }
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='client-state', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _observe_locked(self, metric):
+        client_id = metric.get('client_id')
+        timestamp = _parse(metric.get('timestamp'))
+        received_at = _parse(metric.get('received_at')) or timestamp
+        if client_id is None or timestamp is None:
+            return
+        state = self._states.get(client_id)
+        if state is None:
+            state = self._states[client_id] = {
+                'client_id': client_id, 'client_name': None, 'first_seen': timestamp,
+                'last_seen': timestamp, 'last_received_at': received_at, 'sample_count': 0,
+            }
+        state['sample_count'] += 1
+        state['first_seen'] = min(state['first_seen'], timestamp)
+        state['last_received_at'] = max(state['last_received_at'], received_at)
+        if timestamp >= state['last_seen']:
+            ram = metric.get('ram') or {}
+            state['last_seen'] = timestamp
+            state['client_name'] = metric.get('client_name') or state['client_name']
+            state.update({
+                'cpu_percent': metric.get('cpu_percent'),
+                'gpu_percent': metric.get('gpu_percent'),
+                'ram_used_gb': ram.get('used_gb'),
+                'ram_total_gb': ram.get('total_gb'),
+                'ram_percent': ram.get('percent'),
+                'ping_ms': metric.get('ping_ms'),
+                'internet_connected': metric.get('internet_connected'),
+            })
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.reload()
+            except Exception as e:
+                logger.error(f"✗ Client state reload failed: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._stopping.wait(self.reload_interval)
+
+
+def describe_clients(states, offline_after, now, status=None):
+    """Turn state rows into the /api/clients shape, sorted by client id."""
+    clients = []
+    for state in sorted(states, key=lambda s: s['client_id']):
+        idle = (now - state['last_received_at']).total_seconds()
+        client_status = 'online' if idle <= offline_after else 'offline'
+        if status and client_status != status:
+            continue
+        if state.get('ram_used_gb') is None and state.get('ram_total_gb') is None and state.get('ram_percent') is None:
+            ram = None
+        else:
+            ram = {'used_gb': state['ram_used_gb'], 'total_gb': state['ram_total_gb'],
+                   'percent': state['ram_percent']}
+        internet = state.get('internet_connected')
+        clients.append({
+            'client_id': state['client_id'],
+            'client_name': state['client_name'] or state['client_id'],
+            'status': client_status,
+            'seconds_since_seen': round(max(idle, 0.0), 3),
+            'first_seen': _format(state['first_seen']),
+            'last_seen': _format(state['last_seen']),
+            'last_received_at': _format(state['last_received_at']),
+            'metric_count': state['sample_count'],
+            'latest': {
+                'cpu_percent': state.get('cpu_percent'),
+                'gpu_percent': state.get('gpu_percent'),
+                'ram': ram,
+                'ping_ms': state.get('ping_ms'),
+                'internet_connected': None if internet is None else bool(internet),
+            },
+        })
+    return clients
@@ -0,0 +1,229 @@
+"""Thread-safe pool of reusable database connections."""
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the borrow timeout."""
+
+
+class _PooledConnection:
+    """A raw DB-API connection plus the bookkeeping the pool needs."""
+
+    __slots__ = ('conn', 'created_at', 'last_used')
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class ConnectionPool:
+    """Bounded pool of connections shared by all request threads.
+
+    Idle connections are handed out LIFO so the hottest connection is reused
+    and cold ones age out. A connection that has sat idle longer than
+    ``validate_after`` seconds is pinged before being handed out, and one
+    older than ``max_lifetime`` seconds is closed and replaced. A connection
+    whose borrower raised and which cannot be rolled back is discarded.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10.0,
+                 max_lifetime=1800.0, validate_after=30.0,
+                 validation_query='SELECT 1'):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool bounds: min_size={min_size}, max_size={max_size}")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.validate_after = validate_after
+        self.validation_query = validation_query
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._size = 0
+        self._closed = False
+
+        # Counters, only mutated while holding self._cond
+        self._borrows = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._broken = 0
+
+    # ---------- public API ----------
+    def fill(self):
+        """Open connections until at least ``min_size`` exist."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a ``with`` block."""
+        entry = self._acquire()
+        failed = True
+        try:
+            yield entry.conn
+            failed = False
+        finally:
+            # Also reached via GeneratorExit when a streaming response is abandoned.
+            self._release(entry, failed=failed)
+
+    def close(self):
+        """Close every idle connection and refuse further borrows."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close_quietly(entry)
+
+    def stats(self):
+        """Snapshot of pool occupancy and wait metrics."""
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'borrows': self._borrows,
+                'waits': self._waits,
+                'wait_time_total_ms': round(self._wait_time_total * 1000, 3),
+                'wait_time_max_ms': round(self._wait_time_max * 1000, 3),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'recycled': self._recycled,
+                'broken': self._broken,
+            }
+
+    # ---------- internals ----------
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._created += 1
+        return _PooledConnection(conn)
+
+    def _acquire(self):
+        deadline = None
+        waited_since = None
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        entry = None
+                        break
+                    now = time.monotonic()
+                    if deadline is None:
+                        deadline = now + self.timeout
+                        waited_since = now
+                        self._waits += 1
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {self.timeout}s "
+                            f"(max_size={self.max_size})")
+                    self._cond.wait(remaining)
+                self._borrows += 1
+                if waited_since is not None:
+                    waited = time.monotonic() - waited_since
+                    self._wait_time_total += waited
+                    self._wait_time_max = max(self._wait_time_max, waited)
+                    waited_since = None
+
+            if entry is None:
+                try:
+                    return self._open()
+                except Exception:
+                    self._discard_slot()
+                    raise
+
+            if self._usable(entry):
+                return entry
+            # Stale or broken: drop it and go round again for another one.
+            self._close_quietly(entry)
+            self._discard_slot()
+
+    def _usable(self, entry):
+        now = time.monotonic()
+        if self.max_lifetime and now - entry.created_at > self.max_lifetime:
+            with self._cond:
+                self._recycled += 1
+            return False
+        if now - entry.last_used >= self.validate_after:
+            try:
+                cursor = entry.conn.cursor()
+                cursor.execute(self.validation_query)
+                cursor.fetchall()
+                cursor.close()
+            except Exception as e:
+                logger.warning(f"✗ Pooled connection failed health check: {str(e)}")
+                with self._cond:
+                    self._broken += 1
+                return False
+        return True
+
+    def _release(self, entry, failed=False):
+        if failed:
+            try:
+                entry.conn.rollback()
+            except Exception:
+                with self._cond:
+                    self._broken += 1
+                self._close_quietly(entry)
+                self._discard_slot()
+                return
+        entry.last_used = time.monotonic()
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                closing = True
+            else:
+                self._idle.append(entry)
+                closing = False
+            self._cond.notify()
+        if closing:
+            self._close_quietly(entry)
+
+    def _discard_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(entry):
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
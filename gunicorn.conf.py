@@ -0,0 +1,51 @@
+"""Gunicorn settings for production.
+
+    gunicorn -c gunicorn.conf.py
+
+Runs asgi:application in several uvicorn (asyncio) workers so that each
+worker can hold many thousands of mostly idle agent connections. Every
+worker has its own database pool (DB_POOL_MAX_SIZE connections), so size
+WEB_CONCURRENCY * DB_POOL_MAX_SIZE against the database's connection limit.
+"""
+import os
+import sys
+import resource
+import subprocess
+import multiprocessing
+
+wsgi_app = 'asgi:application'
+worker_class = 'uvicorn_worker.UvicornWorker'
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 8000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+# Agents post every few seconds; keep their connections open between posts.
+keepalive = int(os.environ.get('KEEPALIVE', 75))
+backlog = int(os.environ.get('BACKLOG', 4096))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+# Long enough for a worker to flush its ingest queue on shutdown.
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 35))
+
+accesslog = None
+errorlog = '-'
+loglevel = os.environ.get('LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    """Raise the open-file limit and create/migrate the schema once for all workers.
+
+    init_db runs in a separate interpreter so the master never imports the
+    app (and its pool, caches and threads) before forking workers.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            server.log.info(f"Raised open file limit from {soft} to {hard}")
+        except (ValueError, OSError) as e:
+            server.log.warning(f"Could not raise open file limit from {soft}: {e}")
+
+    if os.environ.get('SKIP_INIT_DB', '').lower() in ('1', 'true'):
+        return
+    server.log.info("Initializing database before starting workers...")
+    subprocess.run([sys.executable, '-c', 'import app; app.init_db()'],
+                   cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
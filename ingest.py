@@ -0,0 +1,174 @@
+"""Buffered ingestion pipeline: a bounded queue drained by a background batch writer."""
+import queue
+import threading
+import time
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when the ingestion queue cannot accept more samples."""
+
+
+class BatchWriter:
+    """Accept samples from request threads and write them in batches.
+
+    ``write_batch`` is called from a single background thread with a list of
+    queued items. A batch is flushed as soon as it reaches ``batch_size`` or
+    once ``flush_interval`` seconds have passed since its first item arrived,
+    whichever comes first. A failing batch is retried ``max_retries`` times
+    with exponential backoff before it is dropped and counted.
+    """
+
+    def __init__(self, write_batch, max_queue=10000, batch_size=500,
+                 flush_interval=1.0, max_retries=3, retry_delay=0.5,
+                 name='ingest-writer'):
+        self._write_batch = write_batch
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._name = name
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        self._enqueued = 0
+        self._rejected = 0
+        self._written = 0
+        self._dropped = 0
+        self._batches = 0
+        self._failed_batches = 0
+        self._last_batch_size = 0
+        self._last_batch_ms = 0.0
+        self._max_batch_ms = 0.0
+        self._total_batch_ms = 0.0
+
+    # ---------- producer side ----------
+    def submit(self, item):
+        """Queue one item without blocking; raise QueueFull when saturated."""
+        if self._stopping.is_set():
+            raise QueueFull("Ingestion pipeline is shutting down")
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise QueueFull(f"Ingestion queue is full ({self.max_queue} samples pending)")
+        with self._lock:
+            self._enqueued += 1
+
+    def submit_many(self, items):
+        """Queue several items; return how many were accepted before the queue filled."""
+        accepted = 0
+        for item in items:
+            try:
+                self.submit(item)
+            except QueueFull:
+                break
+            accepted += 1
+        return accepted
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+        logger.info(f"✓ {self._name} started (batch_size={self.batch_size}, "
+                    f"flush_interval={self.flush_interval}s, max_queue={self.max_queue})")
+
+    def stop(self, timeout=30.0):
+        """Stop accepting samples and flush everything still queued."""
+        if self._stopping.is_set():
+            return
+        logger.info(f"Stopping {self._name}, flushing {self._queue.qsize()} queued samples...")
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        # Whatever the thread did not get to (or if it never started) is flushed here.
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                break
+            self._flush(batch)
+        logger.info(f"✓ {self._name} stopped")
+
+    def stats(self):
+        with self._lock:
+            batches = self._batches
+            return {
+                'queue_depth': self._queue.qsize(),
+                'max_queue': self.max_queue,
+                'enqueued': self._enqueued,
+                'rejected': self._rejected,
+                'written': self._written,
+                'dropped': self._dropped,
+                'batches': batches,
+                'failed_batches': self._failed_batches,
+                'last_batch_size': self._last_batch_size,
+                'last_batch_ms': round(self._last_batch_ms, 3),
+                'max_batch_ms': round(self._max_batch_ms, 3),
+                'avg_batch_ms': round(self._total_batch_ms / batches, 3) if batches else 0.0,
+            }
+
+    # ---------- consumer side ----------
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._drain(block=True)
+            if batch:
+                self._flush(batch)
+
+    def _drain(self, block):
+        """Collect up to batch_size items, waiting at most flush_interval after the first."""
+        try:
+            first = self._queue.get(timeout=self.flush_interval) if block else self._queue.get_nowait()
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if block and remaining > 0 and not self._stopping.is_set():
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                attempt += 1
+                with self._lock:
+                    self._failed_batches += 1
+                if attempt > self.max_retries:
+                    logger.error(f"✗ Dropping batch of {len(batch)} samples after "
+                                 f"{attempt} attempts: {str(e)}")
+                    logger.error(traceback.format_exc())
+                    with self._lock:
+                        self._dropped += len(batch)
+                    return
+                logger.warning(f"✗ Batch write failed (attempt {attempt}), retrying: {str(e)}")
+                time.sleep(self.retry_delay * (2 ** (attempt - 1)))
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self._batches += 1
+                self._written += len(batch)
+                self._last_batch_size = len(batch)
+                self._last_batch_ms = elapsed_ms
+                self._max_batch_ms = max(self._max_batch_ms, elapsed_ms)
+                self._total_batch_ms += elapsed_ms
+            return
@@ -0,0 +1,49 @@
+"""Non-blocking flock that elects one worker process to run a background job."""
+import os
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, every process holds the lock
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    """Exclusive flock on ``path``, held by at most one process at a time.
+
+    ``acquire()`` never blocks; once it succeeds the lock is kept until
+    ``release()`` (or the process exits, letting another worker take over).
+    With ``path`` None, or where flock is unavailable, every process counts
+    as holding it. ``role`` completes the "This worker now ..." log line
+    written when the lock is taken.
+    """
+
+    def __init__(self, path, role='holds the lock'):
+        self.path = path
+        self.role = role
+        self._fd = None
+
+    @property
+    def held(self):
+        return self.path is None or fcntl is None or self._fd is not None
+
+    def acquire(self):
+        """Try to take the lock; return True if this process holds it."""
+        if self.held:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        logger.info(f"✓ This worker now {self.role} (lock {self.path})")
+        return True
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            os.close(fd)
@@ -0,0 +1,192 @@
+"""Fan-out of newly ingested samples to Server-Sent Events subscribers."""
+import json
+import asyncio
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+RETRY_MS = 3000
+
+
+class SlowConsumer(Exception):
+    """Raised to a subscriber that fell so far behind that its buffer overflowed."""
+
+
+class TooManySubscribers(Exception):
+    """Raised when the broadcaster already has its maximum number of subscribers."""
+
+
+def format_event(metric_id, metric):
+    """One SSE ``metric`` event; the id lets a reconnecting browser resume from it."""
+    return f"id: {metric_id}\nevent: metric\ndata: {json.dumps(metric)}\n\n"
+
+
+class Subscription:
+    """One subscriber's bounded buffer of (id, metric) pairs.
+
+    Consumed either from a thread with ``get()`` or from an event loop with
+    ``get_async()``. Once the buffer would exceed ``buffer_size`` the
+    subscription is dropped and the next read raises SlowConsumer.
+    """
+
+    def __init__(self, broadcaster, client_id, buffer_size):
+        self.client_id = client_id
+        self.buffer_size = buffer_size
+        self._broadcaster = broadcaster
+        self._buffer = deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._dropped = False
+        self._event = None
+        self._loop = None
+
+    def wants(self, metric):
+        return self.client_id is None or metric.get('client_id') == self.client_id
+
+    def get(self, timeout):
+        """Wait up to ``timeout`` seconds and return the buffered entries (maybe none)."""
+        with self._cond:
+            if not self._buffer and not self._dropped:
+                self._cond.wait(timeout)
+            return self._take_locked()
+
+    async def get_async(self, timeout):
+        """Like ``get()`` but waits on the running event loop instead of a thread."""
+        if self._loop is None:
+            self._event = asyncio.Event()
+            self._loop = asyncio.get_running_loop()
+        with self._cond:
+            if self._buffer or self._dropped:
+                return self._take_locked()
+            self._event.clear()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            return self._take_locked()
+
+    def close(self):
+        self._broadcaster._unsubscribe(self)
+
+    def _offer(self, entries):
+        """Buffer entries for this subscriber; return False if it has to be dropped."""
+        with self._cond:
+            if len(self._buffer) + len(entries) > self.buffer_size:
+                self._dropped = True
+                self._buffer.clear()
+            else:
+                self._buffer.extend(entries)
+            self._cond.notify()
+            dropped = self._dropped
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._event.set)
+            except RuntimeError:
+                pass  # loop already closed
+        return not dropped
+
+    def _take_locked(self):
+        if self._dropped:
+            raise SlowConsumer(f"Subscriber fell more than {self.buffer_size} samples behind")
+        entries = list(self._buffer)
+        self._buffer.clear()
+        return entries
+
+
+class SampleBroadcaster:
+    """Publish new samples to every subscriber whose client filter matches.
+
+    ``publish`` is meant to be registered as a recent-cache listener, so
+    subscribers of every worker see samples ingested by any worker.
+    Publishing never blocks: a subscriber whose buffer is full is dropped and
+    its browser reconnects, resuming from the last event id it received.
+    """
+
+    def __init__(self, buffer_size=256, max_subscribers=1000):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._published = 0
+        self._dropped = 0
+
+    def subscribe(self, client_id=None):
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise TooManySubscribers(f"Stream has reached {self.max_subscribers} subscribers")
+            subscription = Subscription(self, client_id, self.buffer_size)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def publish(self, entries):
+        """Recent-cache listener: hand each subscriber the new (id, metric) pairs it wants."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._published += len(entries)
+        for subscription in subscribers:
+            wanted = [entry for entry in entries if subscription.wants(entry[1])]
+            if wanted and not subscription._offer(wanted):
+                logger.warning(f"✗ Dropping slow stream subscriber (client filter: {subscription.client_id or 'all'})")
+                with self._lock:
+                    self._subscribers.discard(subscription)
+                    self._dropped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'max_subscribers': self.max_subscribers,
+                'buffer_size': self.buffer_size,
+                'published': self._published,
+                'dropped_subscribers': self._dropped,
+            }
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+def _dropped_event(error):
+    return f"event: dropped\ndata: {json.dumps({'error': str(error)})}\n\n"
+
+
+def sse_stream(subscription, backlog, heartbeat):
+    """Yield SSE text for ``backlog`` then live samples, with keep-alive comments."""
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        last_id = 0
+        for metric_id, metric in backlog:
+            last_id = metric_id
+            yield format_event(metric_id, metric)
+        while True:
+            try:
+                entries = subscription.get(heartbeat)
+            except SlowConsumer as e:
+                yield _dropped_event(e)
+                return
+            events = [format_event(metric_id, metric) for metric_id, metric in entries if metric_id > last_id]
+            yield ''.join(events) if events else ': keepalive\n\n'
+    finally:
+        subscription.close()
+
+
+async def sse_stream_async(subscription, backlog, heartbeat):
+    """``sse_stream`` for an event loop."""
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+        last_id = 0
+        for metric_id, metric in backlog:
+            last_id = metric_id
+            yield format_event(metric_id, metric)
+        while True:
+            try:
+                entries = await subscription.get_async(heartbeat)
+            except SlowConsumer as e:
+                yield _dropped_event(e)
+                return
+            events = [format_event(metric_id, metric) for metric_id, metric in entries if metric_id > last_id]
+            yield ''.join(events) if events else ': keepalive\n\n'
+    finally:
+        subscription.close()
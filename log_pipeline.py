@@ -0,0 +1,207 @@
+"""Non-blocking log output.
+
+Request threads only put records on a bounded queue; one background
+thread formats them and writes them to a log file and stderr.
+When the queue is full, records are dropped and counted instead of
+blocking the caller. ``RateLimitedLog`` thins out per-request success
+messages on the hot paths.
+
+Several worker processes must not rotate one file between them, so the
+file is either shared and rotated externally (``rotation='external'``,
+reopened when logrotate moves it) or split into one size-rotated file per
+process (``rotation='size'``, ``app.<pid>.log``).
+"""
+import os
+import copy
+import json
+import time
+import queue
+import atexit
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+ROTATIONS = ('external', 'size')
+
+# Attributes every LogRecord has; any others came from ``extra=`` and become JSON fields
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any ``extra=`` fields alongside the standard ones."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records instead of raising when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.setFormatter(logging.Formatter())
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare, keep the traceback out of the message so
+        # the listener's formatter can place it (JSON puts it in its own field)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Root logger output through a queue drained by a ``QueueListener`` thread.
+
+    ``make_handlers()`` returns the handlers that do the actual writing, on
+    the listener thread. A process forked after ``start()`` gets a fresh
+    queue and listener of its own, and with ``reopen_after_fork`` also
+    fresh handlers (for per-process files).
+    """
+
+    def __init__(self, make_handlers, max_queue=10000, reopen_after_fork=False):
+        self._make_handlers = make_handlers
+        self.handlers = make_handlers()
+        self.max_queue = max_queue
+        self.reopen_after_fork = reopen_after_fork
+        self.handler = _DroppingQueueHandler(queue.Queue(max_queue))
+        self._listener = None
+
+    def start(self):
+        if self._listener is not None:
+            return
+        self._listener = QueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self._listener.start()
+
+    def stop(self):
+        """Write out everything queued and stop the listener thread."""
+        listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+        for handler in self.handlers:
+            handler.flush()
+
+    def stats(self):
+        return {
+            'queued': self.handler.queue.qsize(),
+            'max_queue': self.max_queue,
+            'dropped': self.handler.dropped,
+        }
+
+    def _after_fork(self):
+        # The parent's listener thread does not exist in the child
+        self.handler.queue = queue.Queue(self.max_queue)
+        if self.reopen_after_fork:
+            # The inherited handlers write to the parent's file; leave those to the parent
+            self.handlers = self._make_handlers()
+        if self._listener is not None:
+            self._listener = None
+            self.start()
+
+
+_pipeline = None
+
+
+def process_log_path(path, pid=None):
+    """``path`` with the process id before its extension: app.log -> app.1234.log."""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{pid or os.getpid()}{ext}'
+
+
+def configure_logging(path, level='INFO', fmt='json', rotation='size', max_bytes=50 * 1024 * 1024,
+                      backup_count=5, max_queue=10000):
+    """Route the root logger through a LogPipeline to a log file and stderr.
+
+    With ``rotation='size'`` each process writes its own
+    ``process_log_path(path)``, rotated at ``max_bytes``. With
+    ``rotation='external'`` every process appends to ``path`` and reopens it
+    after an external tool (logrotate) renames it; ``max_bytes`` and
+    ``backup_count`` are unused.
+    ``fmt`` is 'json' or 'text'. Safe to call more than once; later calls
+    return the pipeline set up by the first.
+    """
+    global _pipeline
+    if _pipeline is not None:
+        return _pipeline
+    if fmt not in ('json', 'text'):
+        raise ValueError(f"Unknown log format '{fmt}', expected 'json' or 'text'")
+    if rotation not in ROTATIONS:
+        raise ValueError(f"Unknown log rotation '{rotation}', expected one of {', '.join(ROTATIONS)}")
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT)
+
+    def make_handlers():
+        if rotation == 'size':
+            file_handler = RotatingFileHandler(process_log_path(path), maxBytes=max_bytes,
+                                               backupCount=backup_count, encoding='utf-8')
+        else:
+            file_handler = WatchedFileHandler(path, encoding='utf-8')
+        handlers = [file_handler, logging.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        return handlers
+
+    pipeline = LogPipeline(make_handlers, max_queue=max_queue, reopen_after_fork=rotation == 'size')
+    root = logging.getLogger()
+    root.handlers[:] = [pipeline.handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    os.register_at_fork(after_in_child=pipeline._after_fork)
+    _pipeline = pipeline
+    return pipeline
+
+
+class RateLimitedLog:
+    """Log through ``logger`` at most once every ``interval`` seconds; count the calls in between.
+
+    Each emitted record carries ``suppressed``, the number of calls skipped
+    since the previous one (approximate under concurrent callers, which are
+    not serialized). ``interval=0`` logs every call. Arguments are %-style,
+    as for ``logger.info``, and are only formatted when the record is emitted.
+    """
+
+    def __init__(self, logger, interval=10.0, level=logging.INFO):
+        self._logger = logger
+        self.interval = interval
+        self.level = level
+        self._next_at = 0.0
+        self._suppressed = 0
+
+    def __call__(self, msg, *args):
+        if not self._logger.isEnabledFor(self.level):
+            return
+        now = time.monotonic()
+        if now < self._next_at:
+            self._suppressed += 1
+            return
+        self._next_at = now + self.interval
+        suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            msg = f'{msg} (+{suppressed} similar)'
+        self._logger.log(self.level, msg, *args, extra={'suppressed': suppressed})
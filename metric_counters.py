@@ -0,0 +1,102 @@
+"""Incrementally maintained totals for the metrics table."""
+import threading
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class MetricCounters:
+    """O(1) total-metrics and total-clients counts.
+
+    ``load_totals()`` must return ``(total_metrics, client_ids, max_id)`` as
+    of a single point in time. Counts are seeded from it, advanced by
+    ``observe()`` for every newly committed sample, and reconciled against
+    it every ``reconcile_interval`` seconds to absorb deletes and anything a
+    worker missed. Samples with an id at or below the reconciled ``max_id``
+    are already included in the reconciled totals and are ignored.
+    """
+
+    def __init__(self, load_totals, reconcile_interval=300.0):
+        self._load_totals = load_totals
+        self.reconcile_interval = reconcile_interval
+        self._lock = threading.Lock()
+        self._total_metrics = 0
+        self._client_ids = set()
+        self._reconciled_max_id = 0
+        self._ready = False
+        self._reconciles = 0
+        self._last_drift = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._ready
+
+    @property
+    def total_metrics(self):
+        return self._total_metrics
+
+    @property
+    def total_clients(self):
+        return len(self._client_ids)
+
+    def observe(self, entries):
+        """Count newly committed (id, metric) pairs."""
+        with self._lock:
+            for metric_id, metric in entries:
+                if metric_id <= self._reconciled_max_id:
+                    continue
+                self._total_metrics += 1
+                self._client_ids.add(metric.get('client_id'))
+
+    def discount(self, removed):
+        """Account for rows deleted outside the ingest path."""
+        with self._lock:
+            self._total_metrics = max(0, self._total_metrics - removed)
+
+    def reconcile(self):
+        """Reset the counts from the database."""
+        total_metrics, client_ids, max_id = self._load_totals()
+        with self._lock:
+            if self._ready:
+                self._last_drift = self._total_metrics - total_metrics
+                if self._last_drift:
+                    logger.info(f"Metric counters drifted by {self._last_drift}, reconciled")
+            self._total_metrics = total_metrics
+            self._client_ids = set(client_ids)
+            self._reconciled_max_id = max_id or 0
+            self._ready = True
+            self._reconciles += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'total_metrics': self._total_metrics,
+                'total_clients': len(self._client_ids),
+                'reconciles': self._reconciles,
+                'last_drift': self._last_drift,
+            }
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='metric-counters', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error(f"✗ Metric counter reconciliation failed: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._stopping.wait(self.reconcile_interval)
@@ -0,0 +1,257 @@
+"""In-process ring buffers of the most recent metric samples."""
+import threading
+import logging
+import traceback
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def _by_timestamp(entry):
+    return entry[1].get('timestamp') or ''
+
+
+def _newer(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+class RecentMetricsCache:
+    """Hot cache of recent samples, globally and per client.
+
+    The cache tails the metrics table by primary key: ``load_after(after_id,
+    limit)`` must return ``(id, metric)`` pairs with ``id > after_id`` in
+    ascending id order, and ``load_latest(limit, client_id=None)`` the newest
+    ``limit`` pairs, also in ascending id order. Tailing the table (rather
+    than caching what this process inserted) keeps every worker's cache in
+    step with samples written by other workers.
+
+    Identity values can become visible out of order when transactions commit
+    concurrently, so each refresh re-reads the last ``lookback`` ids and skips
+    the ones already cached.
+
+    Samples leave the cache by id, not by timestamp, so a backfilled batch can
+    push out samples newer than the ones it brings in. The cache therefore
+    remembers the newest timestamp of any sample it does not hold (evicted,
+    or older than what it loaded), globally and per client;
+    ``load_newest_before(before_id, client_id=None)`` supplies that timestamp
+    for rows a load left out. ``covering()`` uses it to answer only windows
+    the cache provably holds in full.
+    """
+
+    def __init__(self, load_latest, load_after, load_newest_before, capacity=1000, per_client_capacity=100,
+                 refresh_interval=2.0, lookback=100):
+        self._load_latest = load_latest
+        self._load_after = load_after
+        self._load_newest_before = load_newest_before
+        self.capacity = capacity
+        self.per_client_capacity = per_client_capacity
+        self.refresh_interval = refresh_interval
+        self.lookback = lookback
+
+        self._lock = threading.Lock()
+        self._entries = deque()
+        self._ids = set()
+        self._clients = {}
+        self._seeded_clients = set()
+        self._high_water = 0
+        # Highest id seen per client; kept across warm() as ids only grow
+        self._client_high_water = {}
+        # Newest timestamp of a sample not held, globally and per client (None: none missing)
+        self._missing_newest = None
+        self._client_missing_newest = {}
+        self._sorted = None
+        self._ready = False
+        self._listeners = []
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='recent-cache-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(5)
+
+    def notify(self):
+        """Ask the refresh thread to pick up newly committed rows now."""
+        self._wakeup.set()
+
+    def add_listener(self, callback):
+        """Call ``callback(entries)`` with each list of newly cached (id, metric) pairs."""
+        self._listeners.append(callback)
+
+    @property
+    def ready(self):
+        return self._ready
+
+    @property
+    def version(self):
+        """Highest metric id seen so far; changes whenever new samples land."""
+        return self._high_water
+
+    def client_version(self, client_id):
+        """Highest metric id seen from one client (0 if none); changes only when its samples land."""
+        return self._client_high_water.get(client_id, 0)
+
+    # ---------- reads ----------
+    def latest(self, limit):
+        """Return up to ``limit`` samples, newest timestamp first, or None if cold."""
+        if not self._ready or limit > self.capacity:
+            return None
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = [m for _, m in sorted(self._entries, key=_by_timestamp, reverse=True)]
+            return self._sorted[:limit]
+
+    def latest_for_client(self, client_id, limit):
+        """Return up to ``limit`` samples for one client, or None if not cached."""
+        if not self._ready or limit > self.per_client_capacity:
+            return None
+        if client_id not in self._seeded_clients:
+            self._seed_client(client_id)
+        with self._lock:
+            entries = self._clients.get(client_id, ())
+            return [m for _, m in sorted(entries, key=_by_timestamp, reverse=True)[:limit]]
+
+    def covering(self, start, client_id=None):
+        """Every cached sample (newest timestamp first), or None unless the cache holds
+        every sample with a timestamp at or after ``start`` (a formatted timestamp)."""
+        if client_id:
+            samples = self.latest_for_client(client_id, self.per_client_capacity)
+        else:
+            samples = self.latest(self.capacity)
+        if samples is None:
+            return None
+        # Read after the samples: the watermark only grows, so it covers anything missing from them
+        with self._lock:
+            missing = self._client_missing_newest.get(client_id) if client_id else self._missing_newest
+        if missing is not None and missing >= start:
+            return None
+        return samples
+
+    def entries_after(self, after_id, client_id=None):
+        """Cached (id, metric) pairs with id > after_id in id order, optionally for one client."""
+        if not self._ready:
+            return []
+        with self._lock:
+            entries = [entry for entry in self._entries if entry[0] > after_id
+                       and (client_id is None or entry[1].get('client_id') == client_id)]
+        return sorted(entries, key=lambda entry: entry[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'entries': len(self._entries),
+                'capacity': self.capacity,
+                'clients': len(self._clients),
+                'high_water_id': self._high_water,
+            }
+
+    # ---------- writes ----------
+    def warm(self):
+        """Load the newest ``capacity`` samples from the database."""
+        rows = self._load_latest(self.capacity)
+        missing = self._load_newest_before(rows[0][0]) if len(rows) >= self.capacity else None
+        with self._lock:
+            self._entries.clear()
+            self._ids.clear()
+            self._clients.clear()
+            self._seeded_clients.clear()
+            self._client_missing_newest.clear()
+            self._high_water = 0
+            self._missing_newest = missing
+            self._add_locked(rows)
+            self._ready = True
+        logger.info(f"✓ Recent metrics cache warmed with {len(rows)} samples")
+
+    def refresh(self):
+        """Append rows committed since the last refresh."""
+        if not self._ready:
+            self.warm()
+            return
+        after_id = max(0, self._high_water - self.lookback)
+        added = []
+        while True:
+            rows = self._load_after(after_id, self.capacity)
+            with self._lock:
+                added.extend(self._add_locked(rows))
+            if len(rows) < self.capacity:
+                break
+            after_id = rows[-1][0]
+        if added:
+            for callback in self._listeners:
+                try:
+                    callback(added)
+                except Exception as e:
+                    logger.error(f"✗ Recent cache listener failed: {str(e)}")
+                    logger.error(traceback.format_exc())
+
+    def _add_locked(self, rows):
+        added = []
+        for metric_id, metric in rows:
+            if metric_id in self._ids:
+                continue
+            entry = (metric_id, metric)
+            self._entries.append(entry)
+            self._ids.add(metric_id)
+            while len(self._entries) > self.capacity:
+                old_id, old_metric = self._entries.popleft()
+                self._ids.discard(old_id)
+                self._missing_newest = _newer(self._missing_newest, old_metric.get('timestamp'))
+            client_id = metric.get('client_id')
+            client_entries = self._clients.get(client_id)
+            if client_entries is None:
+                client_entries = self._clients[client_id] = deque(maxlen=self.per_client_capacity)
+            if len(client_entries) == client_entries.maxlen:
+                self._client_missing_newest[client_id] = _newer(
+                    self._client_missing_newest.get(client_id), client_entries[0][1].get('timestamp'))
+            client_entries.append(entry)
+            self._high_water = max(self._high_water, metric_id)
+            self._client_high_water[client_id] = max(self._client_high_water.get(client_id, 0), metric_id)
+            added.append(entry)
+        if added:
+            self._sorted = None
+        return added
+
+    def _seed_client(self, client_id):
+        rows = self._load_latest(self.per_client_capacity, client_id=client_id)
+        missing = None
+        if len(rows) >= self.per_client_capacity:
+            missing = self._load_newest_before(rows[0][0], client_id=client_id)
+        with self._lock:
+            existing = self._clients.get(client_id) or ()
+            merged = {metric_id: metric for metric_id, metric in rows}
+            merged.update(existing)
+            ordered = sorted(merged.items())
+            for _, metric in ordered[:-self.per_client_capacity]:
+                missing = _newer(missing, metric.get('timestamp'))
+            self._clients[client_id] = deque(ordered, maxlen=self.per_client_capacity)
+            self._client_missing_newest[client_id] = _newer(
+                self._client_missing_newest.get(client_id), missing)
+            if ordered:
+                self._client_high_water[client_id] = max(self._client_high_water.get(client_id, 0), ordered[-1][0])
+            self._seeded_clients.add(client_id)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"✗ Recent metrics cache refresh failed: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._wakeup.wait(self.refresh_interval)
+            self._wakeup.clear()
@@ -0,0 +1,169 @@
+"""Chunked purge of expired raw metrics and rollups, with per-run reports."""
+import threading
+import time
+import logging
+import traceback
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from client_state import discount_client_states
+from leader_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+_TABLE_BYTES = '''
+    SELECT COALESCE(SUM(used_page_count), 0) * 8192 AS bytes
+    FROM sys.dm_db_partition_stats WHERE object_id = OBJECT_ID(?)
+'''
+
+
+class RetentionJob:
+    """Delete data older than each tier's retention period.
+
+    ``retention`` maps a tier (``'raw'``, ``'raw_data'`` for the stored agent
+    payload, which is set to NULL rather than deleted, or a rollup resolution
+    such as ``'1h'``) to a number of days; 0 or None keeps that tier forever. Rows are deleted ``chunk_size`` at a
+    time, each chunk in its own short transaction and below SQL Server's
+    lock-escalation threshold, with ``pause`` seconds between chunks so
+    ingestion is never blocked behind a long purge. Raw rows are only deleted
+    once the rollup job has processed them, and each chunk takes its rows
+    out of ``client_state.sample_count`` in the same transaction.
+
+    Only the worker holding an flock on ``lock_path`` (when given) purges,
+    so workers never delete the same rows at once.
+    """
+
+    def __init__(self, pool, retention, interval=3600.0, chunk_size=4000,
+                 pause=0.1, respect_rollups=True, on_purge=None, history=20, lock_path=None):
+        self._pool = pool
+        self._leader = FileLock(lock_path, 'runs the retention job')
+        self.retention = retention
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.respect_rollups = respect_rollups
+        self._on_purge = on_purge
+        self._reports = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='retention-job', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(30)
+        self._leader.release()
+
+    def reports(self):
+        """Most recent run reports, newest first."""
+        with self._lock:
+            return list(reversed(self._reports))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self._leader.acquire():
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"✗ Retention job failed: {str(e)}")
+                logger.error(traceback.format_exc())
+            self._stopping.wait(self.interval)
+
+    # ---------- work ----------
+    def run_once(self):
+        """Purge every tier once and record a report of what was reclaimed."""
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        report = {'started_at': now.isoformat(timespec='seconds'), 'tiers': {}}
+
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            bytes_before = {table: self._table_bytes(cursor, table)
+                            for table in ('metrics', 'metrics_rollup')}
+
+            for tier, days in self.retention.items():
+                if not days:
+                    continue
+                cutoff = now - timedelta(days=days)
+                if tier == 'raw':
+                    rows = self._purge_raw(conn, cursor, cutoff)
+                elif tier == 'raw_data':
+                    rows = self._purge_chunks(conn, cursor, '''
+                        UPDATE TOP (?) metrics SET raw_data = NULL
+                        WHERE timestamp < ? AND raw_data IS NOT NULL
+                    ''', (cutoff,))
+                else:
+                    rows = self._purge_chunks(conn, cursor, '''
+                        DELETE TOP (?) FROM metrics_rollup
+                        WHERE resolution = ? AND bucket_start < ?
+                    ''', (tier, cutoff))
+                report['tiers'][tier] = {'cutoff': cutoff.isoformat(timespec='seconds'), 'rows': rows}
+
+            bytes_after = {table: self._table_bytes(cursor, table) for table in bytes_before}
+
+        report['bytes_reclaimed'] = {table: max(0, bytes_before[table] - bytes_after[table])
+                                     for table in bytes_before}
+        report['bytes_remaining'] = bytes_after
+        # raw_data rows are only cleared, not deleted
+        report['rows_deleted'] = sum(tier['rows'] for name, tier in report['tiers'].items() if name != 'raw_data')
+        report['rows_cleared'] = report['tiers'].get('raw_data', {}).get('rows', 0)
+        report['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        with self._lock:
+            self._reports.append(report)
+
+        if report['rows_deleted'] or report['rows_cleared']:
+            logger.info(f"✓ Retention purged {report['rows_deleted']} rows, "
+                        f"cleared raw_data of {report['rows_cleared']} rows, "
+                        f"reclaimed {sum(report['bytes_reclaimed'].values())} bytes "
+                        f"in {report['duration_ms']} ms")
+        return report
+
+    def _purge_raw(self, conn, cursor, cutoff):
+        if self.respect_rollups:
+            cursor.execute("SELECT last_id FROM rollup_state WHERE name = 'metrics'")
+            row = cursor.fetchone()
+            max_id = row.last_id if row else 0
+            statement = 'DELETE TOP (?) FROM metrics OUTPUT deleted.client_id WHERE timestamp < ? AND id <= ?'
+            params = (cutoff, max_id)
+        else:
+            statement = 'DELETE TOP (?) FROM metrics OUTPUT deleted.client_id WHERE timestamp < ?'
+            params = (cutoff,)
+        rows = self._purge_chunks(conn, cursor, statement, params, discount=True)
+        if rows and self._on_purge:
+            self._on_purge(rows)
+        return rows
+
+    def _purge_chunks(self, conn, cursor, statement, params, discount=False):
+        """Run ``statement`` chunk by chunk until it affects fewer than chunk_size rows.
+
+        With ``discount``, the statement outputs the deleted rows' client ids,
+        which are subtracted from client_state before the chunk commits.
+        """
+        total = 0
+        while not self._stopping.is_set():
+            cursor.execute(statement, (self.chunk_size,) + params)
+            if discount:
+                client_ids = [row.client_id for row in cursor.fetchall()]
+                deleted = len(client_ids)
+                discount_client_states(cursor, client_ids)
+            else:
+                deleted = max(cursor.rowcount, 0)
+            conn.commit()
+            total += deleted
+            if deleted < self.chunk_size:
+                break
+            time.sleep(self.pause)
+        return total
+
+    @staticmethod
+    def _table_bytes(cursor, table):
+        cursor.execute(_TABLE_BYTES, (table,))
+        return int(cursor.fetchone().bytes)
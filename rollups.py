@@ -0,0 +1,326 @@
+"""Downsampled min/max/avg/p95 rollups of raw metrics at 1m, 1h and 1d resolution."""
+import threading
+import logging
+import traceback
+from collections import defaultdict
+from datetime import timedelta
+
+import numpy as np
+
+from leader_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = {
+    '1m': timedelta(minutes=1),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+
+# Rollup column prefix -> column of the raw metrics table
+ROLLUP_METRICS = {
+    'cpu': 'cpu_percent',
+    'gpu': 'gpu_percent',
+    'ram': 'ram_percent',
+    'ping': 'ping_ms',
+}
+STATS = ('min', 'max', 'avg', 'p95')
+ROLLUP_COLUMNS = [f'{metric}_{stat}' for metric in ROLLUP_METRICS for stat in STATS]
+
+CREATE_ROLLUP_TABLES = [
+    f'''
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='metrics_rollup' AND xtype='U')
+    CREATE TABLE metrics_rollup (
+        resolution CHAR(2) NOT NULL,
+        client_id NVARCHAR(255) NOT NULL,
+        bucket_start DATETIME2(0) NOT NULL,
+        sample_count INT NOT NULL,
+        {', '.join(f'{column} FLOAT' for column in ROLLUP_COLUMNS)},
+        PRIMARY KEY (resolution, client_id, bucket_start)
+    )
+    ''',
+    '''
+    IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='rollup_state' AND xtype='U')
+    CREATE TABLE rollup_state (
+        name NVARCHAR(50) PRIMARY KEY,
+        last_id INT NOT NULL
+    )
+    ''',
+]
+
+_MERGE_ROLLUP = f'''
+    MERGE metrics_rollup WITH (HOLDLOCK) AS t
+    USING (SELECT ? AS resolution, ? AS client_id, ? AS bucket_start, ? AS sample_count,
+                  {', '.join(f'? AS {column}' for column in ROLLUP_COLUMNS)}) AS s
+    ON t.resolution = s.resolution AND t.client_id = s.client_id AND t.bucket_start = s.bucket_start
+    WHEN MATCHED THEN UPDATE SET sample_count = s.sample_count,
+        {', '.join(f'{column} = s.{column}' for column in ROLLUP_COLUMNS)}
+    WHEN NOT MATCHED THEN INSERT (resolution, client_id, bucket_start, sample_count, {', '.join(ROLLUP_COLUMNS)})
+        VALUES (s.resolution, s.client_id, s.bucket_start, s.sample_count,
+                {', '.join(f's.{column}' for column in ROLLUP_COLUMNS)});
+'''
+
+
+def truncate(moment, resolution):
+    """Start of the bucket containing ``moment`` at the given resolution."""
+    if resolution == '1m':
+        return moment.replace(second=0, microsecond=0)
+    if resolution == '1h':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def choose_resolution(start, end, min_points):
+    """Pick the coarsest resolution that still yields ``min_points`` buckets, else 'raw'."""
+    span = end - start
+    for resolution in ('1d', '1h', '1m'):
+        if span / RESOLUTIONS[resolution] >= min_points:
+            return resolution
+    return 'raw'
+
+
+def _summarize(values):
+    """min/max/avg/p95 of the non-null values, or Nones if there are none."""
+    array = np.array([v for v in values if v is not None], dtype=float)
+    if not array.size:
+        return [None, None, None, None]
+    return [float(array.min()), float(array.max()), float(array.mean()),
+            float(np.percentile(array, 95))]
+
+
+def _combine(children):
+    """Merge finer rollup rows into one coarser row.
+
+    min and max are exact and avg is weighted by sample count. p95 is
+    approximated as the sample-weighted 95th percentile of the children's
+    p95 values, since the raw distribution is no longer available.
+    """
+    counts = np.array([child['sample_count'] for child in children], dtype=float)
+    row = [int(counts.sum())]
+    for metric in ROLLUP_METRICS:
+        present = [(child, weight) for child, weight in zip(children, counts)
+                   if child[f'{metric}_avg'] is not None]
+        if not present:
+            row.extend([None, None, None, None])
+            continue
+        weights = np.array([weight for _, weight in present])
+        mins = np.array([child[f'{metric}_min'] for child, _ in present], dtype=float)
+        maxs = np.array([child[f'{metric}_max'] for child, _ in present], dtype=float)
+        avgs = np.array([child[f'{metric}_avg'] for child, _ in present], dtype=float)
+        p95s = np.array([child[f'{metric}_p95'] for child, _ in present], dtype=float)
+        order = np.argsort(p95s)
+        cumulative = np.cumsum(weights[order])
+        p95 = p95s[order][np.searchsorted(cumulative, 0.95 * cumulative[-1])]
+        row.extend([float(mins.min()), float(maxs.max()),
+                    float(np.average(avgs, weights=weights)), float(p95)])
+    return row
+
+
+class RollupJob:
+    """Background job that keeps ``metrics_rollup`` up to date.
+
+    Each pass reads raw rows with an id above the stored watermark (minus a
+    ``lookback`` window for identities that committed out of order), works
+    out which (client, minute) buckets they touch and recomputes exactly those
+    buckets from raw data. Touched hours are then recomputed from minutes and
+    touched days from hours, so late-arriving samples are folded in correctly
+    and every recomputation stays small.
+
+    Every worker starts the job, but only the one holding an flock on
+    ``lock_path`` (when given) runs passes, so the rollup MERGEs never race
+    each other; another worker takes over if it exits.
+    """
+
+    def __init__(self, pool, interval=60.0, chunk_size=50000, lookback=1000, lock_path=None):
+        self._pool = pool
+        self._leader = FileLock(lock_path, 'runs the rollup job')
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.lookback = lookback
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._last_id = 0
+        self._buckets_written = 0
+        self._last_error = None
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='rollup-job', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(30)
+        self._leader.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'leader': self._leader.held,
+                'runs': self._runs,
+                'last_id': self._last_id,
+                'buckets_written': self._buckets_written,
+                'last_error': self._last_error,
+            }
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self._leader.acquire():
+                    self.run_once()
+                    with self._lock:
+                        self._last_error = None
+            except Exception as e:
+                logger.error(f"✗ Rollup job failed: {str(e)}")
+                logger.error(traceback.format_exc())
+                with self._lock:
+                    self._last_error = str(e)
+            self._stopping.wait(self.interval)
+
+    # ---------- work ----------
+    def run_once(self):
+        """Roll up everything ingested since the last run."""
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT last_id FROM rollup_state WHERE name = 'metrics'")
+            row = cursor.fetchone()
+            last_id = row.last_id if row else 0
+            cursor.execute('SELECT MAX(id) AS max_id FROM metrics')
+            max_id = cursor.fetchone().max_id or 0
+
+            written = 0
+            low = max(0, last_id - self.lookback)
+            while low < max_id and not self._stopping.is_set():
+                high = min(max_id, low + self.chunk_size)
+                written += self._roll_up_ids(cursor, low, high)
+                cursor.execute('''
+                    MERGE rollup_state AS t
+                    USING (SELECT 'metrics' AS name, ? AS last_id) AS s ON t.name = s.name
+                    WHEN MATCHED THEN UPDATE SET last_id = s.last_id
+                    WHEN NOT MATCHED THEN INSERT (name, last_id) VALUES (s.name, s.last_id);
+                ''', (high,))
+                conn.commit()
+                low = high
+
+        with self._lock:
+            self._runs += 1
+            self._last_id = max_id
+            self._buckets_written += written
+        if written:
+            logger.info(f"✓ Rollup pass wrote {written} buckets up to id {max_id}")
+
+    def _roll_up_ids(self, cursor, low, high):
+        cursor.execute('''
+            SELECT DISTINCT client_id, DATEADD(minute, DATEDIFF(minute, 0, timestamp), 0) AS bucket
+            FROM metrics WHERE id > ? AND id <= ?
+        ''', (low, high))
+        touched = defaultdict(set)
+        for row in cursor.fetchall():
+            touched[row.client_id].add(row.bucket)
+        if not touched:
+            return 0
+
+        written = 0
+        minute_rows = []
+        for client_id, buckets in touched.items():
+            minute_rows.extend(self._minutes_from_raw(cursor, client_id, buckets))
+        written += self._upsert(cursor, minute_rows)
+
+        hours = {(client_id, truncate(bucket, '1h'))
+                 for client_id, buckets in touched.items() for bucket in buckets}
+        written += self._upsert(cursor, self._combine_from(cursor, '1m', '1h', hours))
+
+        days = {(client_id, truncate(hour, '1d')) for client_id, hour in hours}
+        written += self._upsert(cursor, self._combine_from(cursor, '1h', '1d', days))
+        return written
+
+    def _minutes_from_raw(self, cursor, client_id, buckets):
+        start = min(buckets)
+        end = max(buckets) + RESOLUTIONS['1m']
+        cursor.execute(f'''
+            SELECT timestamp, {', '.join(f'{column} AS {metric}' for metric, column in ROLLUP_METRICS.items())}
+            FROM metrics
+            WHERE client_id = ? AND timestamp >= ? AND timestamp < ?
+        ''', (client_id, start, end))
+        grouped = defaultdict(list)
+        for row in cursor.fetchall():
+            bucket = truncate(row.timestamp, '1m')
+            if bucket in buckets:
+                grouped[bucket].append(row)
+
+        rows = []
+        for bucket, samples in grouped.items():
+            row = ['1m', client_id, bucket, len(samples)]
+            for metric in ROLLUP_METRICS:
+                row.extend(_summarize(getattr(sample, metric) for sample in samples))
+            rows.append(row)
+        return rows
+
+    def _combine_from(self, cursor, finer, coarser, targets):
+        by_client = defaultdict(list)
+        for client_id, bucket in targets:
+            by_client[client_id].append(bucket)
+
+        rows = []
+        for client_id, buckets in by_client.items():
+            start = min(buckets)
+            end = max(buckets) + RESOLUTIONS[coarser]
+            cursor.execute(f'''
+                SELECT bucket_start, sample_count, {', '.join(ROLLUP_COLUMNS)}
+                FROM metrics_rollup
+                WHERE resolution = ? AND client_id = ? AND bucket_start >= ? AND bucket_start < ?
+            ''', (finer, client_id, start, end))
+            grouped = defaultdict(list)
+            wanted = set(buckets)
+            for child in cursor.fetchall():
+                bucket = truncate(child.bucket_start, coarser)
+                if bucket in wanted:
+                    grouped[bucket].append({
+                        'sample_count': child.sample_count,
+                        **{column: getattr(child, column) for column in ROLLUP_COLUMNS},
+                    })
+            for bucket, children in grouped.items():
+                rows.append([coarser, client_id, bucket] + _combine(children))
+        return rows
+
+    @staticmethod
+    def _upsert(cursor, rows):
+        if not rows:
+            return 0
+        cursor.fast_executemany = True
+        cursor.executemany(_MERGE_ROLLUP, rows)
+        cursor.fast_executemany = False
+        return len(rows)
+
+
+def load_rollups(pool, resolution, start, end, client_id=None, limit=10000):
+    """Read rollup buckets in [start, end), oldest first, as dicts."""
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        if client_id:
+            cursor.execute(f'''
+                SELECT TOP (?) client_id, bucket_start, sample_count, {', '.join(ROLLUP_COLUMNS)}
+                FROM metrics_rollup
+                WHERE resolution = ? AND client_id = ? AND bucket_start >= ? AND bucket_start < ?
+                ORDER BY bucket_start
+            ''', (limit, resolution, client_id, start, end))
+        else:
+            cursor.execute(f'''
+                SELECT TOP (?) client_id, bucket_start, sample_count, {', '.join(ROLLUP_COLUMNS)}
+                FROM metrics_rollup
+                WHERE resolution = ? AND bucket_start >= ? AND bucket_start < ?
+                ORDER BY bucket_start, client_id
+            ''', (limit, resolution, start, end))
+        rows = cursor.fetchall()
+    return [{
+        'client_id': row.client_id,
+        'bucket_start': row.bucket_start,
+        'sample_count': row.sample_count,
+        **{column: getattr(row, column) for column in ROLLUP_COLUMNS},
+    } for row in rows]
@@ -0,0 +1,482 @@
+"""Write-ahead spool: accepted samples go to local segment files and are replayed into the database."""
+import os
+import json
+import time
+import zlib
+import struct
+import logging
+import threading
+import traceback
+
+from ingest import QueueFull
+from leader_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# length, crc32 of the payload, time the record was appended
+_HEADER = struct.Struct('<IId')
+_SEGMENT_SUFFIX = '.seg'
+
+
+def _segment_name(seq):
+    return f'{seq:012d}{_SEGMENT_SUFFIX}'
+
+
+class Spool:
+    """Durable replacement for BatchWriter's in-memory queue.
+
+    ``submit``/``submit_many`` append JSON-encoded items to the active
+    segment file and return at once; a background thread fsyncs the segment
+    every ``fsync_interval`` seconds, so at most that much acknowledged data
+    is exposed to a power loss (a process crash loses nothing). The fsync
+    runs outside the writer lock, so submitters never wait on the disk.
+    Segments are rotated at ``segment_bytes``; a rotated-out segment stays
+    open until the sync thread has fsynced it. The spool refuses items with
+    QueueFull once ``max_bytes`` are on disk.
+
+    A replayer thread reads records in order and hands batches of up to
+    ``batch_size`` items to ``write_batch``. Its position is checkpointed
+    after every successful batch and fully replayed segments are deleted, so
+    a restart resumes where it left off. A failing batch is retried with
+    exponential backoff for as long as ``health_check()`` reports the
+    database as unavailable; if the database is healthy and the batch still
+    fails ``max_retries`` times, its items are written one by one and those
+    the database refuses are moved to ``dead-letter.jsonl`` instead of
+    blocking the spool.
+
+    Each process claims its own ``slot-N`` directory under ``directory``
+    with an exclusive lock, so workers never share files and a restarted
+    worker picks up the slot (and backlog) of one that exited.
+    """
+
+    def __init__(self, directory, write_batch, health_check=None, segment_bytes=16 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, fsync_interval=0.05, batch_size=500,
+                 idle_interval=1.0, max_retries=3, retry_delay=0.5, max_retry_delay=30.0,
+                 name='ingest-spool'):
+        self.directory = directory
+        self._write_batch = write_batch
+        self._health_check = health_check
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._name = name
+
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wakeup = threading.Event()
+        self._running = False
+        self._threads = []
+        self._slot = None
+        self._slot_lock = None
+
+        # Writer state, guarded by self._lock
+        self._active_seq = 0
+        self._active_fd = None
+        self._active_size = 0
+        self._dirty = False
+        # Rotated-out segment fds the sync thread still has to fsync and close
+        self._retired_fds = []
+        self._disk_bytes = 0
+        self._segments = 0
+
+        # Replayer position
+        self._replay_seq = 0
+        self._replay_offset = 0
+        self._replaying_since = None
+
+        self._appended = 0
+        self._rejected = 0
+        self._invalid = 0
+        self._replayed = 0
+        self._replay_batches = 0
+        self._replay_failures = 0
+        self._dead_lettered = 0
+        self._corrupt = 0
+        self._fsyncs = 0
+        self._last_fsync_ms = 0.0
+        self._max_fsync_ms = 0.0
+        self._last_error = None
+
+    # ---------- producer side ----------
+    def submit(self, item):
+        """Append one item; raise QueueFull when the spool is stopped or full.
+
+        An item that cannot be serialized as JSON raises TypeError or ValueError.
+        """
+        if self._append([self._encode(item, time.time())]) != 1:
+            raise QueueFull(f"Ingestion spool is full ({self.max_bytes} bytes on disk)")
+
+    def submit_many(self, items):
+        """Append several items; return how many were taken before the spool filled.
+
+        Items are serialized one by one: one that is not JSON-serializable is
+        dropped (counted as invalid, and among those taken) instead of
+        failing the rest of the batch.
+        """
+        now = time.time()
+        records = []
+        for item in items:
+            try:
+                records.append(self._encode(item, now))
+            except (TypeError, ValueError) as e:
+                logger.warning(f"✗ Dropping an item the spool cannot serialize: {str(e)}")
+                records.append(None)
+        return self._append(records)
+
+    def _append(self, records):
+        """Write encoded records (None: an invalid item to skip) up to the size limit; return how many were taken."""
+        with self._lock:
+            if not self._running:
+                raise QueueFull("Ingestion spool is not running")
+            room = self.max_bytes - self._disk_bytes
+            taken = 0
+            size = 0
+            for record in records:
+                if record is not None:
+                    if size + len(record) > room:
+                        break
+                    size += len(record)
+                taken += 1
+            written = [record for record in records[:taken] if record is not None]
+            if written:
+                self._write_locked(b''.join(written))
+                self._appended += len(written)
+            self._invalid += taken - len(written)
+            self._rejected += len(records) - taken
+        self._wakeup.set()
+        return taken
+
+    @staticmethod
+    def _encode(item, now):
+        payload = json.dumps(item).encode('utf-8')
+        return _HEADER.pack(len(payload), zlib.crc32(payload), now) + payload
+
+    # ---------- lifecycle ----------
+    def start(self):
+        if self._running:
+            return
+        self._slot, self._slot_lock = self._claim_slot()
+        self._stopping.clear()
+        self._recover()
+        with self._lock:
+            self._open_segment_locked(self._active_seq)
+            self._running = True
+        for target, suffix in ((self._sync_loop, 'sync'), (self._replay_loop, 'replay')):
+            thread = threading.Thread(target=target, name=f'{self._name}-{suffix}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"✓ {self._name} started in {self._slot} ({self._segments} segments, "
+                    f"{self._disk_bytes} bytes pending)")
+
+    def stop(self, timeout=30.0):
+        """Stop accepting items, fsync, and give the replayer ``timeout`` seconds to catch up.
+
+        Whatever is not replayed by then stays on disk for the next start.
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        deadline = time.monotonic() + timeout
+        while self._backlog() and time.monotonic() < deadline and self._last_error is None:
+            self._wakeup.set()
+            time.sleep(0.05)
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()) + 1)
+        self._threads = []
+        self._sync()
+        with self._lock:
+            os.close(self._active_fd)
+            self._active_fd = None
+        if self._slot_lock is not None:
+            self._slot_lock.release()
+            self._slot_lock = None
+        logger.info(f"✓ {self._name} stopped ({self._disk_bytes} bytes left to replay)")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slot': self._slot,
+                'disk_bytes': self._disk_bytes,
+                'max_bytes': self.max_bytes,
+                'segments': self._segments,
+                'appended': self._appended,
+                'rejected': self._rejected,
+                'invalid': self._invalid,
+                'replayed': self._replayed,
+                'replay_batches': self._replay_batches,
+                'replay_failures': self._replay_failures,
+                'replay_lag_seconds': round(time.time() - self._replaying_since, 3)
+                                      if self._replaying_since is not None else 0.0,
+                'dead_lettered': self._dead_lettered,
+                'corrupt_records': self._corrupt,
+                'fsyncs': self._fsyncs,
+                'last_fsync_ms': round(self._last_fsync_ms, 3),
+                'max_fsync_ms': round(self._max_fsync_ms, 3),
+                'last_error': self._last_error,
+            }
+
+    # ---------- files ----------
+    def _claim_slot(self):
+        os.makedirs(self.directory, exist_ok=True)
+        slot = 0
+        while True:
+            path = os.path.join(self.directory, f'slot-{slot}')
+            os.makedirs(path, exist_ok=True)
+            lock = FileLock(os.path.join(path, 'lock'), f'spools to {path}')
+            if lock.acquire():
+                return path, lock
+            slot += 1
+
+    def _path(self, name):
+        return os.path.join(self._slot, name)
+
+    def _segment_seqs(self):
+        return sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self._slot)
+                      if name.endswith(_SEGMENT_SUFFIX))
+
+    def _recover(self):
+        """Load the checkpoint, drop segments it has passed and size up the backlog."""
+        seq, offset = 0, 0
+        try:
+            with open(self._path('checkpoint')) as f:
+                checkpoint = json.load(f)
+            seq, offset = checkpoint['segment'], checkpoint['offset']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.error(f"✗ Unreadable spool checkpoint, replaying {self._slot} from the start: {str(e)}")
+
+        seqs = self._segment_seqs()
+        for old in [s for s in seqs if s < seq]:
+            os.remove(self._path(_segment_name(old)))
+        seqs = [s for s in seqs if s >= seq]
+        if not seqs or seqs[0] != seq:
+            offset = 0
+        self._replay_seq = seqs[0] if seqs else 0
+        self._replay_offset = offset
+        # Never append to a segment left by an earlier process; its tail may be torn.
+        self._active_seq = (seqs[-1] + 1) if seqs else max(seq, 1)
+        if not seqs:
+            self._replay_seq = self._active_seq
+        self._disk_bytes = sum(os.path.getsize(self._path(_segment_name(s))) for s in seqs) - self._replay_offset
+        self._segments = len(seqs)
+
+    def _open_segment_locked(self, seq):
+        self._active_seq = seq
+        self._active_fd = os.open(self._path(_segment_name(seq)), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._active_size = 0
+        self._segments += 1
+
+    def _write_locked(self, data):
+        if self._active_size >= self.segment_bytes:
+            # The sync thread may be fsyncing this fd right now; it closes it
+            self._retired_fds.append(self._active_fd)
+            self._open_segment_locked(self._active_seq + 1)
+        view = memoryview(data)
+        while view:
+            written = os.write(self._active_fd, view)
+            view = view[written:]
+        self._active_size += len(data)
+        self._disk_bytes += len(data)
+        self._dirty = True
+
+    def _sync(self):
+        """fsync everything appended so far without holding the writer lock.
+
+        Only this method closes retired fds, so the ones taken here stay
+        valid while they are synced even if the segment rotates meanwhile.
+        """
+        with self._lock:
+            retired, self._retired_fds = self._retired_fds, []
+            fd = self._active_fd if self._dirty else None
+            generation = self._active_seq
+            self._dirty = False
+        if not retired and fd is None:
+            return
+        started = time.perf_counter()
+        try:
+            while retired:
+                os.fsync(retired[0])
+                os.close(retired.pop(0))
+            if fd is not None:
+                os.fsync(fd)
+        except OSError:
+            with self._lock:
+                self._retired_fds[:0] = retired
+                if fd is not None and generation == self._active_seq:
+                    self._dirty = True
+            raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._fsyncs += 1
+            self._last_fsync_ms = elapsed_ms
+            self._max_fsync_ms = max(self._max_fsync_ms, elapsed_ms)
+
+    def _sync_loop(self):
+        while not self._stopping.wait(self.fsync_interval):
+            try:
+                self._sync()
+            except OSError as e:
+                logger.error(f"✗ Spool fsync failed: {str(e)}")
+
+    def _save_checkpoint(self):
+        path = self._path('checkpoint')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': self._replay_seq, 'offset': self._replay_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    # ---------- replay ----------
+    def _backlog(self):
+        with self._lock:
+            return self._replay_seq < self._active_seq or self._replay_offset < self._active_size
+
+    def _replay_loop(self):
+        while not self._stopping.is_set():
+            try:
+                if not self._replay_step():
+                    self._wakeup.wait(self.idle_interval)
+                    self._wakeup.clear()
+            except Exception as e:
+                logger.error(f"✗ Spool replay failed: {str(e)}")
+                logger.error(traceback.format_exc())
+                self._stopping.wait(self.retry_delay)
+
+    def _replay_step(self):
+        """Replay one batch; return False when there is nothing to do right now."""
+        with self._lock:
+            seq, offset = self._replay_seq, self._replay_offset
+            sealed = seq < self._active_seq
+            limit = None if sealed else self._active_size
+        items, end, appended_at, corrupt = self._read_batch(seq, offset, limit)
+
+        if items:
+            with self._lock:
+                self._replaying_since = appended_at
+            if not self._deliver(items):
+                return False
+        if corrupt:
+            logger.error(f"✗ Corrupt record in spool segment {seq} at byte {end}; skipping the rest of it")
+            with self._lock:
+                self._corrupt += 1
+        if items or corrupt or sealed:
+            self._advance(seq, end, finished=sealed and (corrupt or not items))
+            return True
+        with self._lock:
+            self._replaying_since = None
+        return False
+
+    def _read_batch(self, seq, offset, limit):
+        """Up to batch_size items from a segment, the offset after them and the first item's append time."""
+        items = []
+        appended_at = None
+        with open(self._path(_segment_name(seq)), 'rb') as f:
+            f.seek(offset)
+            while len(items) < self.batch_size and (limit is None or offset < limit):
+                header = f.read(_HEADER.size)
+                if not header:
+                    break
+                if len(header) < _HEADER.size:
+                    return items, offset, appended_at, True
+                length, crc, stamp = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return items, offset, appended_at, True
+                items.append(json.loads(payload))
+                if appended_at is None:
+                    appended_at = stamp
+                offset += _HEADER.size + length
+        return items, offset, appended_at, False
+
+    def _deliver(self, items):
+        """Write items (or dead-letter them); return False if stopped before that happened."""
+        attempt = 0
+        while True:
+            try:
+                self._write_batch(items)
+            except Exception as e:
+                attempt += 1
+                with self._lock:
+                    self._replay_failures += 1
+                    self._last_error = str(e)
+                if attempt >= self.max_retries and self._health_check is not None and self._database_healthy():
+                    if self._isolate_rejects(items, e):
+                        return True
+                delay = min(self.max_retry_delay, self.retry_delay * (2 ** (attempt - 1)))
+                logger.warning(f"✗ Spool replay of {len(items)} samples failed (attempt {attempt}), "
+                               f"retrying in {delay:.1f}s: {str(e)}")
+                if self._stopping.wait(delay):
+                    return False
+                continue
+            self._replayed_batch(len(items))
+            return True
+
+    def _isolate_rejects(self, items, error):
+        """Write items one by one and dead-letter those the healthy database refuses.
+
+        Returns False (keep retrying the batch) if every item failed and the
+        database has meanwhile become unavailable.
+        """
+        rejects = []
+        for item in items:
+            try:
+                self._write_batch([item])
+            except Exception as e:
+                rejects.append((item, e))
+        if len(rejects) == len(items) and not self._database_healthy():
+            return False
+        if rejects:
+            logger.error(f"✗ Moving {len(rejects)} of {len(items)} samples to the dead-letter file; "
+                         f"the database refused them: {str(error)}")
+            self._dead_letter(rejects)
+        self._replayed_batch(len(items) - len(rejects))
+        return True
+
+    def _replayed_batch(self, count):
+        with self._lock:
+            self._replayed += count
+            self._replay_batches += 1
+            self._last_error = None
+
+    def _database_healthy(self):
+        try:
+            self._health_check()
+            return True
+        except Exception:
+            return False
+
+    def _dead_letter(self, rejects):
+        with open(self._path('dead-letter.jsonl'), 'a') as f:
+            for item, error in rejects:
+                f.write(json.dumps({'error': str(error), 'item': item}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        with self._lock:
+            self._dead_lettered += len(rejects)
+
+    def _advance(self, seq, offset, finished):
+        with self._lock:
+            consumed = offset - self._replay_offset
+            self._disk_bytes -= consumed
+            if finished:
+                # Anything after a corrupt record was never replayed but goes with the file.
+                size = os.path.getsize(self._path(_segment_name(seq)))
+                self._disk_bytes -= size - offset
+                self._segments -= 1
+                later = [s for s in self._segment_seqs() if seq < s < self._active_seq]
+                self._replay_seq = later[0] if later else self._active_seq
+                self._replay_offset = 0
+            else:
+                self._replay_offset = offset
+        self._save_checkpoint()
+        if finished:
+            os.remove(self._path(_segment_name(seq)))
@@ -0,0 +1,792 @@
+"""Storage backends for metric samples.
+
+``MetricStore`` is the interface the app's data-access functions call.
+``AzureSQLStore`` keeps samples in Azure SQL through pooled pyodbc
+connections; ``SQLiteStore`` keeps them in a local SQLite database in WAL
+mode, for edge sites without a remote database, development and load tests.
+Both return samples as the same metric dicts.
+"""
+import os
+import json
+import sqlite3
+import threading
+import time
+import logging
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from aggregates import STAT_METRICS, load_columns
+from client_state import (VALUE_COLUMNS, CREATE_CLIENT_STATE_TABLE, BACKFILL_CLIENT_STATE,
+                          client_state_params, load_client_states, upsert_client_states)
+from rollups import CREATE_ROLLUP_TABLES, load_rollups
+
+logger = logging.getLogger(__name__)
+
+# Typed columns the read path projects; raw_data is only selected on demand
+METRIC_COLUMNS = (
+    'id, client_id, client_name, timestamp, received_at, cpu_percent, gpu_percent, '
+    'ram_used_gb, ram_total_gb, ram_percent, ping_ms, internet_connected'
+)
+_INSERT_COLUMNS = ('client_id, client_name, timestamp, received_at, cpu_percent, gpu_percent, '
+                   'ram_used_gb, ram_total_gb, ram_percent, ping_ms, internet_connected, raw_data')
+
+
+def _format(value):
+    if value is None or isinstance(value, str):
+        return value
+    return value.isoformat(timespec='milliseconds')
+
+
+def row_to_metric(row, include_raw=False):
+    """Build the metric dict returned by the API from a row's typed columns."""
+    if row.ram_used_gb is None and row.ram_total_gb is None and row.ram_percent is None:
+        ram = None
+    else:
+        ram = {'used_gb': row.ram_used_gb, 'total_gb': row.ram_total_gb, 'percent': row.ram_percent}
+    metric = {
+        'client_id': row.client_id,
+        'client_name': row.client_name,
+        'timestamp': _format(row.timestamp),
+        'received_at': _format(row.received_at),
+        'cpu_percent': row.cpu_percent,
+        'gpu_percent': row.gpu_percent,
+        'ram': ram,
+        'ping_ms': row.ping_ms,
+        'internet_connected': None if row.internet_connected is None else bool(row.internet_connected)
+    }
+    if include_raw:
+        metric['raw_data'] = json.loads(row.raw_data) if row.raw_data else None
+    return metric
+
+
+class MetricStore:
+    """Interface of a storage backend.
+
+    Rows passed to ``insert_metrics`` are metrics INSERT parameter tuples:
+    ``(client_id, client_name, timestamp, received_at, cpu_percent,
+    gpu_percent, ram_used_gb, ram_total_gb, ram_percent, ping_ms,
+    internet_connected, raw_data)`` with naive UTC datetimes. Samples come
+    back as metric dicts (see ``row_to_metric``); times passed in are naive
+    UTC datetimes.
+    """
+    backend = None
+    # Whether the rollup and retention jobs (and rollup queries) are available
+    supports_rollups = False
+
+    def init_schema(self):
+        """Create or migrate the tables."""
+        raise NotImplementedError
+
+    def check(self):
+        """Raise if the store cannot answer a trivial query."""
+        raise NotImplementedError
+
+    def insert_metrics(self, rows):
+        """Insert samples and fold them into ``client_state`` in one transaction."""
+        raise NotImplementedError
+
+    def latest_entries(self, limit, client_id=None):
+        """The newest (id, metric) pairs by id, in ascending id order."""
+        raise NotImplementedError
+
+    def entries_after(self, after_id, limit):
+        """(id, metric) pairs with id greater than after_id, in ascending id order."""
+        raise NotImplementedError
+
+    def newest_timestamp_before(self, before_id, client_id=None):
+        """The latest sample timestamp among ids below ``before_id``, formatted as in metrics, or None."""
+        raise NotImplementedError
+
+    def newest_metrics(self, limit, client_id=None, include_raw=False):
+        """Up to ``limit`` samples, newest timestamp first."""
+        raise NotImplementedError
+
+    def metrics_range(self, start, end, client_id=None, limit=1000, include_raw=False):
+        """Samples with start <= timestamp < end, oldest first."""
+        raise NotImplementedError
+
+    def stream_metrics(self, after_id, limit, client_id=None, include_raw=False, fetch_size=500):
+        """Yield samples with id > after_id in id order, each carrying its 'id'."""
+        raise NotImplementedError
+
+    def totals(self):
+        """(total samples, distinct client ids, max id)."""
+        raise NotImplementedError
+
+    def count_metrics(self):
+        raise NotImplementedError
+
+    def count_clients(self):
+        raise NotImplementedError
+
+    def client_states(self):
+        """(client_state rows as dicts with datetime values, max metrics id)."""
+        raise NotImplementedError
+
+    def metric_columns(self, metrics, start, end, client_id=None, limit=5000000, fetch_size=50000, after_id=None):
+        """Samples in [start, end) (and with id > after_id) as the matrix described in ``aggregates.load_columns``."""
+        raise NotImplementedError
+
+    def rollups(self, resolution, start, end, client_id=None, limit=10000):
+        raise NotImplementedError(f"The {self.backend} backend keeps no rollups")
+
+    def stats(self):
+        return {'backend': self.backend}
+
+    def close(self):
+        pass
+
+
+# ==================== Azure SQL ====================
+class AzureSQLStore(MetricStore):
+    """Samples in Azure SQL, borrowed connections from a ``ConnectionPool``."""
+    backend = 'azuresql'
+    supports_rollups = True
+
+    def __init__(self, pool, migration_chunk_size=10000):
+        self.pool = pool
+        self.migration_chunk_size = migration_chunk_size
+
+    def init_schema(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            logger.info("Creating metrics table if not exists...")
+            cursor.execute('''
+                IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='metrics' AND xtype='U')
+                CREATE TABLE metrics (
+                    id INT IDENTITY(1,1) PRIMARY KEY,
+                    client_id NVARCHAR(255) NOT NULL,
+                    client_name NVARCHAR(255),
+                    timestamp DATETIME2(3) NOT NULL,
+                    received_at DATETIME2(3) NOT NULL,
+                    cpu_percent FLOAT,
+                    gpu_percent FLOAT,
+                    ram_used_gb FLOAT,
+                    ram_total_gb FLOAT,
+                    ram_percent FLOAT,
+                    ping_ms FLOAT,
+                    internet_connected BIT,
+                    raw_data NVARCHAR(MAX),
+                    created_at DATETIME2 DEFAULT GETDATE()
+                )
+            ''')
+            logger.info("✓ Metrics table created/verified")
+
+            self._migrate_timestamp_columns(conn)
+            self._migrate_ram_columns(conn)
+
+            logger.info("Creating index on client_id, timestamp...")
+            cursor.execute('''
+                IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_client_timestamp' AND object_id = OBJECT_ID('metrics'))
+                CREATE INDEX idx_client_timestamp ON metrics(client_id, timestamp DESC)
+            ''')
+            logger.info("✓ Index idx_client_timestamp created/verified")
+
+            logger.info("Creating index on timestamp...")
+            cursor.execute('''
+                IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='idx_timestamp' AND object_id = OBJECT_ID('metrics'))
+                CREATE INDEX idx_timestamp ON metrics(timestamp DESC)
+            ''')
+            logger.info("✓ Index idx_timestamp created/verified")
+
+            logger.info("Creating rollup tables if not exist...")
+            for statement in CREATE_ROLLUP_TABLES:
+                cursor.execute(statement)
+            logger.info("✓ Rollup tables created/verified")
+
+            logger.info("Creating client_state table if not exists...")
+            cursor.execute(CREATE_CLIENT_STATE_TABLE)
+            cursor.execute(BACKFILL_CLIENT_STATE)
+            logger.info("✓ client_state table created/verified")
+
+            conn.commit()
+        self.pool.fill()
+
+    def _migrate_timestamp_columns(self, conn):
+        """Convert legacy NVARCHAR timestamp/received_at columns to DATETIME2(3) UTC.
+
+        Values are parsed with their UTC offset where one is present, backfilled
+        in chunks so the log does not balloon, and fall back to created_at when a
+        stored string cannot be parsed.
+        """
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_NAME = 'metrics' AND COLUMN_NAME = 'timestamp'
+        ''')
+        row = cursor.fetchone()
+        if not row or row.DATA_TYPE.lower() not in ('nvarchar', 'varchar'):
+            return
+
+        logger.info("Migrating metrics timestamp columns to DATETIME2...")
+        cursor.execute('''
+            IF COL_LENGTH('metrics', 'timestamp_dt') IS NULL
+            ALTER TABLE metrics ADD timestamp_dt DATETIME2(3) NULL, received_at_dt DATETIME2(3) NULL
+        ''')
+        conn.commit()
+
+        migrated = 0
+        while True:
+            cursor.execute('''
+                UPDATE TOP (?) metrics SET
+                    received_at_dt = COALESCE(
+                        CAST(SWITCHOFFSET(TRY_CONVERT(DATETIMEOFFSET, received_at), '+00:00') AS DATETIME2(3)),
+                        created_at, SYSUTCDATETIME()),
+                    timestamp_dt = COALESCE(
+                        CAST(SWITCHOFFSET(TRY_CONVERT(DATETIMEOFFSET, timestamp), '+00:00') AS DATETIME2(3)),
+                        CAST(SWITCHOFFSET(TRY_CONVERT(DATETIMEOFFSET, received_at), '+00:00') AS DATETIME2(3)),
+                        created_at, SYSUTCDATETIME())
+                WHERE timestamp_dt IS NULL
+            ''', (self.migration_chunk_size,))
+            updated = cursor.rowcount
+            conn.commit()
+            migrated += max(updated, 0)
+            if updated < self.migration_chunk_size:
+                break
+        logger.info(f"✓ Backfilled {migrated} rows")
+
+        cursor.execute("IF EXISTS (SELECT * FROM sys.indexes WHERE name='idx_timestamp' AND object_id = OBJECT_ID('metrics')) DROP INDEX idx_timestamp ON metrics")
+        cursor.execute("IF EXISTS (SELECT * FROM sys.indexes WHERE name='idx_client_id' AND object_id = OBJECT_ID('metrics')) DROP INDEX idx_client_id ON metrics")
+        cursor.execute("ALTER TABLE metrics DROP COLUMN timestamp, received_at")
+        cursor.execute("EXEC sp_rename 'metrics.timestamp_dt', 'timestamp', 'COLUMN'")
+        cursor.execute("EXEC sp_rename 'metrics.received_at_dt', 'received_at', 'COLUMN'")
+        cursor.execute("ALTER TABLE metrics ALTER COLUMN timestamp DATETIME2(3) NOT NULL")
+        cursor.execute("ALTER TABLE metrics ALTER COLUMN received_at DATETIME2(3) NOT NULL")
+        conn.commit()
+        logger.info("✓ Timestamp columns migrated to DATETIME2")
+
+    def _migrate_ram_columns(self, conn):
+        """Replace the legacy ram_json column with typed ram_used_gb/ram_total_gb/ram_percent."""
+        cursor = conn.cursor()
+        cursor.execute("SELECT COL_LENGTH('metrics', 'ram_json') AS length")
+        if cursor.fetchone().length is None:
+            return
+
+        logger.info("Migrating ram_json to typed RAM columns...")
+        cursor.execute('''
+            IF COL_LENGTH('metrics', 'ram_percent') IS NULL
+            ALTER TABLE metrics ADD ram_used_gb FLOAT NULL, ram_total_gb FLOAT NULL, ram_percent FLOAT NULL
+        ''')
+        conn.commit()
+
+        cursor.execute('SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM metrics')
+        bounds = cursor.fetchone()
+        low = (bounds.min_id or 1) - 1
+        while bounds.max_id is not None and low < bounds.max_id:
+            high = low + self.migration_chunk_size
+            cursor.execute('''
+                UPDATE metrics SET
+                    ram_used_gb = TRY_CAST(JSON_VALUE(ram_json, '$.used_gb') AS FLOAT),
+                    ram_total_gb = TRY_CAST(JSON_VALUE(ram_json, '$.total_gb') AS FLOAT),
+                    ram_percent = TRY_CAST(JSON_VALUE(ram_json, '$.percent') AS FLOAT)
+                WHERE id > ? AND id <= ? AND ram_json IS NOT NULL
+            ''', (low, high))
+            conn.commit()
+            low = high
+
+        cursor.execute("ALTER TABLE metrics DROP COLUMN ram_json")
+        conn.commit()
+        logger.info("✓ RAM columns migrated")
+
+    def check(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+
+    def insert_metrics(self, rows):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.fast_executemany = True
+            cursor.executemany(f'''
+                INSERT INTO metrics ({_INSERT_COLUMNS})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            upsert_client_states(cursor, rows)
+            conn.commit()
+
+    def latest_entries(self, limit, client_id=None):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if client_id:
+                cursor.execute(f'''
+                    SELECT TOP (?) {METRIC_COLUMNS} FROM metrics
+                    WHERE client_id = ?
+                    ORDER BY id DESC
+                ''', (limit, client_id))
+            else:
+                cursor.execute(f'''
+                    SELECT TOP (?) {METRIC_COLUMNS} FROM metrics
+                    ORDER BY id DESC
+                ''', (limit,))
+            rows = cursor.fetchall()
+        return [(row.id, row_to_metric(row)) for row in reversed(rows)]
+
+    def entries_after(self, after_id, limit):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT TOP (?) {METRIC_COLUMNS} FROM metrics
+                WHERE id > ?
+                ORDER BY id
+            ''', (limit, after_id))
+            rows = cursor.fetchall()
+        return [(row.id, row_to_metric(row)) for row in rows]
+
+    def newest_timestamp_before(self, before_id, client_id=None):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if client_id:
+                cursor.execute('''
+                    SELECT MAX(timestamp) AS newest FROM metrics WHERE client_id = ? AND id < ?
+                ''', (client_id, before_id))
+            else:
+                cursor.execute('SELECT MAX(timestamp) AS newest FROM metrics WHERE id < ?', (before_id,))
+            return _format(cursor.fetchone().newest)
+
+    def newest_metrics(self, limit, client_id=None, include_raw=False):
+        columns = METRIC_COLUMNS + (', raw_data' if include_raw else '')
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if client_id:
+                cursor.execute(f'''
+                    SELECT TOP (?) {columns} FROM metrics
+                    WHERE client_id = ?
+                    ORDER BY timestamp DESC
+                ''', (limit, client_id))
+            else:
+                cursor.execute(f'''
+                    SELECT TOP (?) {columns} FROM metrics
+                    ORDER BY timestamp DESC
+                ''', (limit,))
+            rows = cursor.fetchall()
+        return [row_to_metric(row, include_raw) for row in rows]
+
+    def metrics_range(self, start, end, client_id=None, limit=1000, include_raw=False):
+        columns = METRIC_COLUMNS + (', raw_data' if include_raw else '')
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if client_id:
+                cursor.execute(f'''
+                    SELECT TOP (?) {columns} FROM metrics
+                    WHERE client_id = ? AND timestamp >= ? AND timestamp < ?
+                    ORDER BY timestamp
+                ''', (limit, client_id, start, end))
+            else:
+                cursor.execute(f'''
+                    SELECT TOP (?) {columns} FROM metrics
+                    WHERE timestamp >= ? AND timestamp < ?
+                    ORDER BY timestamp
+                ''', (limit, start, end))
+            rows = cursor.fetchall()
+        return [row_to_metric(row, include_raw) for row in rows]
+
+    def stream_metrics(self, after_id, limit, client_id=None, include_raw=False, fetch_size=500):
+        """The pooled connection is held until the generator finishes or is closed."""
+        columns = METRIC_COLUMNS + (', raw_data' if include_raw else '')
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if client_id:
+                cursor.execute(f'''
+                    SELECT TOP (?) {columns} FROM metrics
+                    WHERE client_id = ? AND id > ?
+                    ORDER BY id
+                ''', (limit, client_id, after_id))
+            else:
+                cursor.execute(f'''
+                    SELECT TOP (?) {columns} FROM metrics
+                    WHERE id > ?
+                    ORDER BY id
+                ''', (limit, after_id))
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    metric = row_to_metric(row, include_raw)
+                    metric['id'] = row.id
+                    yield metric
+
+    def totals(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT_BIG(*) as count, MAX(id) as max_id FROM metrics')
+            row = cursor.fetchone()
+            cursor.execute('SELECT DISTINCT client_id FROM metrics')
+            client_ids = [r.client_id for r in cursor.fetchall()]
+        return row.count, client_ids, row.max_id
+
+    def count_metrics(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) as count FROM metrics')
+            return cursor.fetchone()[0]
+
+    def count_clients(self):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(DISTINCT client_id) as count FROM metrics')
+            return cursor.fetchone()[0]
+
+    def client_states(self):
+        return load_client_states(self.pool)
+
+    def metric_columns(self, metrics, start, end, client_id=None, limit=5000000, fetch_size=50000, after_id=None):
+        return load_columns(self.pool, metrics, start, end, client_id=client_id,
+                            limit=limit, fetch_size=fetch_size, after_id=after_id)
+
+    def rollups(self, resolution, start, end, client_id=None, limit=10000):
+        return load_rollups(self.pool, resolution, start, end, client_id=client_id, limit=limit)
+
+    def stats(self):
+        return {'backend': self.backend, **self.pool.stats()}
+
+    def close(self):
+        self.pool.close()
+
+
+# ==================== SQLite ====================
+# Times are stored as fixed-width ISO 8601 text ('2024-01-31T12:00:00.000'),
+# which sorts and compares correctly as strings.
+_SQLITE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        client_id TEXT NOT NULL,
+        client_name TEXT,
+        timestamp TEXT NOT NULL,
+        received_at TEXT NOT NULL,
+        cpu_percent REAL,
+        gpu_percent REAL,
+        ram_used_gb REAL,
+        ram_total_gb REAL,
+        ram_percent REAL,
+        ping_ms REAL,
+        internet_connected INTEGER,
+        raw_data TEXT,
+        created_at TEXT DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_client_timestamp ON metrics(client_id, timestamp DESC)',
+    'CREATE INDEX IF NOT EXISTS idx_timestamp ON metrics(timestamp DESC)',
+    f'''
+    CREATE TABLE IF NOT EXISTS client_state (
+        client_id TEXT PRIMARY KEY,
+        client_name TEXT,
+        first_seen TEXT NOT NULL,
+        last_seen TEXT NOT NULL,
+        last_received_at TEXT NOT NULL,
+        {', '.join(f'{column} REAL' for column in VALUE_COLUMNS if column != 'internet_connected')},
+        internet_connected INTEGER,
+        sample_count INTEGER NOT NULL
+    )
+    ''',
+]
+
+_SQLITE_NEWER = 'excluded.last_seen >= client_state.last_seen'
+_SQLITE_UPSERT_CLIENT_STATE = f'''
+    INSERT INTO client_state (client_id, client_name, first_seen, last_seen, last_received_at,
+                              {', '.join(VALUE_COLUMNS)}, sample_count)
+    VALUES ({', '.join('?' for _ in range(6 + len(VALUE_COLUMNS)))})
+    ON CONFLICT (client_id) DO UPDATE SET
+        sample_count = client_state.sample_count + excluded.sample_count,
+        first_seen = MIN(client_state.first_seen, excluded.first_seen),
+        last_received_at = MAX(client_state.last_received_at, excluded.last_received_at),
+        client_name = CASE WHEN {_SQLITE_NEWER} THEN COALESCE(excluded.client_name, client_state.client_name)
+                           ELSE client_state.client_name END,
+        {', '.join(f'{column} = CASE WHEN {_SQLITE_NEWER} THEN excluded.{column} ELSE client_state.{column} END'
+                   for column in VALUE_COLUMNS)},
+        last_seen = MAX(client_state.last_seen, excluded.last_seen)
+'''
+
+_SQLITE_BACKFILL_CLIENT_STATE = f'''
+    INSERT INTO client_state (client_id, client_name, first_seen, last_seen, last_received_at,
+                              {', '.join(VALUE_COLUMNS)}, sample_count)
+    SELECT client_id, client_name, first_seen, timestamp, last_received_at,
+           {', '.join(VALUE_COLUMNS)}, sample_count
+    FROM (
+        SELECT client_id, client_name, timestamp, {', '.join(VALUE_COLUMNS)},
+               ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY timestamp DESC, id DESC) AS newest,
+               MIN(timestamp) OVER (PARTITION BY client_id) AS first_seen,
+               MAX(received_at) OVER (PARTITION BY client_id) AS last_received_at,
+               COUNT(*) OVER (PARTITION BY client_id) AS sample_count
+        FROM metrics
+    ) AS ranked
+    WHERE newest = 1 AND NOT EXISTS (SELECT 1 FROM client_state)
+'''
+
+_row_types = {}
+
+
+def _row_factory(cursor, row):
+    """Rows with attribute access, like pyodbc's, so ``row_to_metric`` serves both backends."""
+    fields = tuple(column[0] for column in cursor.description)
+    row_type = _row_types.get(fields)
+    if row_type is None:
+        row_type = _row_types[fields] = namedtuple('Row', fields)
+    return row_type(*row)
+
+
+def _text(value):
+    return value.isoformat(timespec='milliseconds') if isinstance(value, datetime) else value
+
+
+def _parse(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+class SQLiteStore(MetricStore):
+    """Samples in a local SQLite database file in WAL mode.
+
+    Each thread gets its own connection, so readers never wait on each other
+    or on the writer. Writes take an in-process lock and ``BEGIN IMMEDIATE``,
+    so batches from several threads (or gunicorn workers, through
+    ``busy_timeout``) queue for the single writer instead of failing.
+    ``synchronous=NORMAL`` keeps commits off fsync; WAL stays consistent
+    after a crash but may lose the last commits on power loss.
+    """
+    backend = 'sqlite'
+
+    def __init__(self, path, busy_timeout=5.0, synchronous='NORMAL'):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._writes = 0
+        self._rows_written = 0
+        self._last_write_ms = 0.0
+        self._max_write_ms = 0.0
+
+    def _connect(self):
+        # Connections stay with one thread; check_same_thread is off only so a
+        # dead thread's connection can be closed from another one.
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.row_factory = _row_factory
+        return conn
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._lock:
+                dead = [(thread, c) for thread, c in self._connections if not thread.is_alive()]
+                self._connections = [(thread, c) for thread, c in self._connections if thread.is_alive()]
+                self._connections.append((threading.current_thread(), conn))
+            for _, c in dead:
+                c.close()
+        return conn
+
+    def init_schema(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._conn()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in _SQLITE_SCHEMA:
+                    conn.execute(statement)
+                conn.execute(_SQLITE_BACKFILL_CLIENT_STATE)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        logger.info(f"✓ SQLite database ready at {self.path}")
+
+    def check(self):
+        self._conn().execute('SELECT 1').fetchall()
+
+    def insert_metrics(self, rows):
+        rows = [(row[0], row[1], _text(row[2]), _text(row[3])) + tuple(row[4:]) for row in rows]
+        states = client_state_params(rows)
+        conn = self._conn()
+        started = time.perf_counter()
+        with self._write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(f'''
+                    INSERT INTO metrics ({_INSERT_COLUMNS})
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+                conn.executemany(_SQLITE_UPSERT_CLIENT_STATE, states)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._writes += 1
+            self._rows_written += len(rows)
+            self._last_write_ms = elapsed_ms
+            self._max_write_ms = max(self._max_write_ms, elapsed_ms)
+
+    def latest_entries(self, limit, client_id=None):
+        if client_id:
+            rows = self._conn().execute(f'''
+                SELECT {METRIC_COLUMNS} FROM metrics WHERE client_id = ? ORDER BY id DESC LIMIT ?
+            ''', (client_id, limit)).fetchall()
+        else:
+            rows = self._conn().execute(f'''
+                SELECT {METRIC_COLUMNS} FROM metrics ORDER BY id DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        return [(row.id, row_to_metric(row)) for row in reversed(rows)]
+
+    def entries_after(self, after_id, limit):
+        rows = self._conn().execute(f'''
+            SELECT {METRIC_COLUMNS} FROM metrics WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after_id, limit)).fetchall()
+        return [(row.id, row_to_metric(row)) for row in rows]
+
+    def newest_timestamp_before(self, before_id, client_id=None):
+        if client_id:
+            row = self._conn().execute('''
+                SELECT MAX(timestamp) AS newest FROM metrics WHERE client_id = ? AND id < ?
+            ''', (client_id, before_id)).fetchone()
+        else:
+            row = self._conn().execute('SELECT MAX(timestamp) AS newest FROM metrics WHERE id < ?',
+                                       (before_id,)).fetchone()
+        return _format(row.newest)
+
+    def newest_metrics(self, limit, client_id=None, include_raw=False):
+        columns = METRIC_COLUMNS + (', raw_data' if include_raw else '')
+        if client_id:
+            rows = self._conn().execute(f'''
+                SELECT {columns} FROM metrics WHERE client_id = ? ORDER BY timestamp DESC LIMIT ?
+            ''', (client_id, limit)).fetchall()
+        else:
+            rows = self._conn().execute(f'''
+                SELECT {columns} FROM metrics ORDER BY timestamp DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        return [row_to_metric(row, include_raw) for row in rows]
+
+    def metrics_range(self, start, end, client_id=None, limit=1000, include_raw=False):
+        columns = METRIC_COLUMNS + (', raw_data' if include_raw else '')
+        if client_id:
+            rows = self._conn().execute(f'''
+                SELECT {columns} FROM metrics
+                WHERE client_id = ? AND timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp LIMIT ?
+            ''', (client_id, _text(start), _text(end), limit)).fetchall()
+        else:
+            rows = self._conn().execute(f'''
+                SELECT {columns} FROM metrics
+                WHERE timestamp >= ? AND timestamp < ?
+                ORDER BY timestamp LIMIT ?
+            ''', (_text(start), _text(end), limit)).fetchall()
+        return [row_to_metric(row, include_raw) for row in rows]
+
+    def stream_metrics(self, after_id, limit, client_id=None, include_raw=False, fetch_size=500):
+        """Uses a connection of its own, since a streamed response may resume on another thread."""
+        columns = METRIC_COLUMNS + (', raw_data' if include_raw else '')
+        conn = self._connect()
+        try:
+            if client_id:
+                cursor = conn.execute(f'''
+                    SELECT {columns} FROM metrics WHERE client_id = ? AND id > ? ORDER BY id LIMIT ?
+                ''', (client_id, after_id, limit))
+            else:
+                cursor = conn.execute(f'''
+                    SELECT {columns} FROM metrics WHERE id > ? ORDER BY id LIMIT ?
+                ''', (after_id, limit))
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    metric = row_to_metric(row, include_raw)
+                    metric['id'] = row.id
+                    yield metric
+        finally:
+            conn.close()
+
+    def totals(self):
+        conn = self._conn()
+        row = conn.execute('SELECT COUNT(*) AS count, MAX(id) AS max_id FROM metrics').fetchone()
+        client_ids = [r.client_id for r in conn.execute('SELECT DISTINCT client_id FROM metrics')]
+        return row.count, client_ids, row.max_id
+
+    def count_metrics(self):
+        return self._conn().execute('SELECT COUNT(*) AS count FROM metrics').fetchone().count
+
+    def count_clients(self):
+        return self._conn().execute('SELECT COUNT(DISTINCT client_id) AS count FROM metrics').fetchone().count
+
+    def client_states(self):
+        conn = self._conn()
+        rows = conn.execute(f'''
+            SELECT client_id, client_name, first_seen, last_seen, last_received_at,
+                   {', '.join(VALUE_COLUMNS)}, sample_count
+            FROM client_state
+        ''').fetchall()
+        max_id = conn.execute('SELECT MAX(id) AS max_id FROM metrics').fetchone().max_id
+        states = [{
+            'client_id': row.client_id,
+            'client_name': row.client_name,
+            'first_seen': _parse(row.first_seen),
+            'last_seen': _parse(row.last_seen),
+            'last_received_at': _parse(row.last_received_at),
+            **{column: getattr(row, column) for column in VALUE_COLUMNS},
+            'sample_count': row.sample_count,
+        } for row in rows]
+        return states, max_id
+
+    def metric_columns(self, metrics, start, end, client_id=None, limit=5000000, fetch_size=50000, after_id=None):
+        columns = ', '.join(STAT_METRICS[metric] for metric in metrics)
+        present = ' OR '.join(f'{STAT_METRICS[metric]} IS NOT NULL' for metric in metrics)
+        where = 'timestamp >= ? AND timestamp < ?'
+        params = [_text(start), _text(end)]
+        if client_id:
+            where = 'client_id = ? AND ' + where
+            params.insert(0, client_id)
+        if after_id is not None:
+            where += ' AND id > ?'
+            params.append(after_id)
+        cursor = self._conn().cursor()
+        cursor.row_factory = None
+        cursor.execute(f'''
+            SELECT (julianday(timestamp) - 2440587.5) * 86400000.0 AS t, {columns}
+            FROM metrics
+            WHERE {where} AND ({present})
+            ORDER BY timestamp LIMIT ?
+        ''', params + [limit])
+        chunks = []
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.float64))
+        if not chunks:
+            return np.empty((0, 1 + len(metrics)), dtype=np.float64)
+        data = np.concatenate(chunks)
+        data[:, 0] = np.round(data[:, 0])
+        return data
+
+    def stats(self):
+        wal_path = self.path + '-wal'
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'path': self.path,
+                'connections': len(self._connections),
+                'writes': self._writes,
+                'rows_written': self._rows_written,
+                'last_write_ms': round(self._last_write_ms, 3),
+                'max_write_ms': round(self._max_write_ms, 3),
+                'db_bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+                'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+            }
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for _, conn in connections:
+            conn.close()
+        self._local = threading.local()
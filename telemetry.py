@@ -0,0 +1,290 @@
+"""Self-metrics for the server, exposed in the Prometheus text format.
+
+Counters and histograms are recorded on the ingest and request paths, so
+recording takes no lock: every thread adds into its own shard of each
+series, and a scrape sums the shards. Only the first observation of a
+series from a new thread takes a lock, to register that thread's shard.
+A thread that reuses a finished thread's ident inherits its shard, so the
+number of shards stays bounded by the number of threads alive at once.
+
+A scrape can see one observation's bucket count without its sum; counts
+are always consistent with their buckets.
+
+Every process keeps its own values: behind a pre-forking server each
+worker reports only the requests it served.
+"""
+import math
+import time
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Request and query latencies, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Payload sizes, in bytes (64 B to 16 MiB in powers of 4)
+SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(10))
+
+# Label value that series beyond a family's max_series are folded into
+OVERFLOW_LABEL = '__other__'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _ShardedValues:
+    """A fixed-size array of numbers that threads add to without locking.
+
+    Each thread writes only its own shard; ``snapshot()`` sums all shards.
+    """
+
+    __slots__ = ('_size', '_shards', '_lock')
+
+    def __init__(self, size):
+        self._size = size
+        self._shards = {}
+        self._lock = threading.Lock()
+
+    def add(self, index, amount):
+        shard = self._shards.get(threading.get_ident())
+        if shard is None:
+            shard = self._register()
+        shard[index] += amount
+
+    def snapshot(self):
+        with self._lock:
+            shards = list(self._shards.values())
+        totals = [0] * self._size
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+    def _register(self):
+        ident = threading.get_ident()
+        with self._lock:
+            shard = self._shards.get(ident)
+            if shard is None:
+                shard = self._shards[ident] = [0] * self._size
+        return shard
+
+
+class _CounterChild:
+    __slots__ = ('_values',)
+
+    def __init__(self):
+        self._values = _ShardedValues(1)
+
+    def inc(self, amount=1):
+        self._values.add(0, amount)
+
+    def _samples(self, name, labelnames, labelvalues):
+        yield f'{name}{_format_labels(labelnames, labelvalues)} {_format_value(self._values.snapshot()[0])}'
+
+
+class _Timer:
+    """Context manager that observes its block's wall time in a histogram."""
+
+    __slots__ = ('_histogram', '_started')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class _HistogramChild:
+    __slots__ = ('_bounds', '_values')
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        # One slot per bucket, one for +Inf, then the sum
+        self._values = _ShardedValues(len(bounds) + 2)
+
+    def observe(self, value):
+        values = self._values
+        values.add(bisect_left(self._bounds, value), 1)
+        values.add(len(self._bounds) + 1, value)
+
+    def time(self):
+        return _Timer(self)
+
+    def _samples(self, name, labelnames, labelvalues):
+        totals = self._values.snapshot()
+        cumulative = 0
+        for bound, count in zip(self._bounds + (math.inf,), totals):
+            cumulative += count
+            labels = _format_labels(labelnames, labelvalues, ('le', _format_value(float(bound))))
+            yield f'{name}_bucket{labels} {cumulative}'
+        labels = _format_labels(labelnames, labelvalues)
+        yield f'{name}_sum{labels} {_format_value(float(totals[-1]))}'
+        yield f'{name}_count{labels} {cumulative}'
+
+
+class _Family:
+    """A named metric and its series, one per combination of label values.
+
+    At most ``max_series`` series are created; later label combinations are
+    counted under OVERFLOW_LABEL in every label.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=(), max_series=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._create(labelvalues)
+        return child
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            children = sorted(self._children.items())
+        for labelvalues, child in children:
+            lines.extend(child._samples(self.name, self.labelnames, labelvalues))
+        return lines
+
+    def _create(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {labelvalues!r}")
+        labelvalues = tuple(str(value) for value in labelvalues)
+        with self._lock:
+            child = self._children.get(labelvalues)
+            if child is not None:
+                return child
+            if self.max_series is not None and len(self._children) >= self.max_series:
+                labelvalues = (OVERFLOW_LABEL,) * len(self.labelnames)
+                child = self._children.get(labelvalues)
+                if child is not None:
+                    return child
+            child = self._children[labelvalues] = self._new_child()
+            return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+
+class Counter(_Family):
+    """Monotonic count; ``name`` should end in ``_total``."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Histogram(_Family):
+    """Distribution of observed values over fixed upper bounds (``le`` buckets)."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, max_series=None):
+        super().__init__(name, help, labelnames, max_series)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class Gauge(_Family):
+    """Point-in-time values read at scrape time from ``collect()``.
+
+    ``collect()`` returns ``(labelvalues, value)`` pairs.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, collect, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._collect = collect
+
+    def labels(self, *labelvalues):
+        raise TypeError(f"{self.name} is read from its collect function")
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for labelvalues, value in sorted(self._collect()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    """The metric families a process exposes, rendered in registration order."""
+
+    def __init__(self):
+        self._families = []
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def register(self, family):
+        with self._lock:
+            if family.name in self._names:
+                raise ValueError(f"Metric {family.name} is already registered")
+            self._names.add(family.name)
+            self._families.append(family)
+        return family
+
+    def counter(self, name, help, labelnames=(), max_series=None):
+        return self.register(Counter(name, help, labelnames, max_series=max_series))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, max_series=None):
+        return self.register(Histogram(name, help, labelnames, buckets=buckets, max_series=max_series))
+
+    def gauge(self, name, help, collect, labelnames=()):
+        return self.register(Gauge(name, help, collect, labelnames))
+
+    def render(self):
+        """All families in the Prometheus text exposition format."""
+        with self._lock:
+            families = list(self._families)
+        lines = []
+        for family in families:
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+
+def numeric_stats(stats, prefix=''):
+    """Flatten a nested ``stats()`` dict into (dotted key, number) pairs, skipping non-numbers."""
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from numeric_stats(value, f'{prefix}{key}.')
+        elif isinstance(value, (bool, int, float)):
+            yield f'{prefix}{key}', float(value)
@@ -0,0 +1,28 @@
+import pytest
+
+import leader_lock
+from leader_lock import FileLock
+
+
+@pytest.mark.skipif(leader_lock.fcntl is None, reason='flock is unavailable')
+def test_one_holder_at_a_time(tmp_path):
+    path = str(tmp_path / 'job.lock')
+    first, second = FileLock(path), FileLock(path)
+
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.held and not second.held
+    assert first.acquire()
+
+    first.release()
+    assert not first.held
+    assert second.acquire()
+    second.release()
+
+
+def test_no_path_always_holds():
+    lock = FileLock(None)
+    assert lock.held
+    assert lock.acquire()
+    lock.release()
+    assert lock.held
@@ -0,0 +1,240 @@
+import os
+import time
+import threading
+
+import pytest
+
+from ingest import QueueFull
+from spool import Spool, _HEADER, _segment_name
+
+
+class Recorder:
+    """write_batch that keeps what it was given and fails while ``failing`` is set."""
+
+    def __init__(self, fail_after=None):
+        self.items = []
+        self.calls = 0
+        self.fail_after = fail_after
+        self.failing = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, items):
+        with self._lock:
+            self.calls += 1
+            if self.failing.is_set() or (self.fail_after is not None and self.calls > self.fail_after):
+                raise RuntimeError('database unavailable')
+            self.items.extend(items)
+
+
+def make_spool(directory, write_batch, **kwargs):
+    kwargs.setdefault('fsync_interval', 0.01)
+    kwargs.setdefault('idle_interval', 0.01)
+    kwargs.setdefault('retry_delay', 0.01)
+    kwargs.setdefault('max_retry_delay', 0.02)
+    return Spool(str(directory), write_batch, **kwargs)
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out waiting for the spool')
+        time.sleep(0.01)
+
+
+def segments(directory):
+    slot = os.path.join(directory, 'slot-0')
+    return sorted(os.path.join(slot, name) for name in os.listdir(slot) if name.endswith('.seg'))
+
+
+def test_replays_items_in_order(tmp_path):
+    writer = Recorder()
+    spool = make_spool(tmp_path, writer, batch_size=7)
+    spool.start()
+    try:
+        for i in range(20):
+            spool.submit({'n': i})
+        assert spool.submit_many([{'n': i} for i in range(20, 50)]) == 30
+        wait_until(lambda: len(writer.items) == 50)
+    finally:
+        spool.stop(timeout=1)
+    assert writer.items == [{'n': i} for i in range(50)]
+    assert spool.stats()['disk_bytes'] == 0
+
+
+def test_rejects_items_when_stopped_or_full(tmp_path):
+    writer = Recorder()
+    writer.failing.set()
+    spool = make_spool(tmp_path, writer, max_bytes=200)
+    with pytest.raises(QueueFull):
+        spool.submit({'n': 0})
+    spool.start()
+    try:
+        accepted = spool.submit_many([{'n': i} for i in range(20)])
+        assert 0 < accepted < 20
+        with pytest.raises(QueueFull):
+            spool.submit({'n': 99})
+        assert spool.stats()['rejected'] == 21 - accepted
+    finally:
+        spool.stop(timeout=0.1)
+
+
+def test_rotates_segments_and_deletes_replayed_ones(tmp_path):
+    writer = Recorder()
+    spool = make_spool(tmp_path, writer, segment_bytes=256)
+    spool.start()
+    try:
+        for i in range(40):
+            spool.submit({'n': i, 'pad': 'x' * 20})
+        wait_until(lambda: len(writer.items) == 40)
+        wait_until(lambda: len(segments(tmp_path)) == 1)
+    finally:
+        spool.stop(timeout=1)
+    assert [item['n'] for item in writer.items] == list(range(40))
+
+
+def test_backlog_survives_a_restart(tmp_path):
+    writer = Recorder()
+    writer.failing.set()
+    spool = make_spool(tmp_path, writer)
+    spool.start()
+    for i in range(10):
+        spool.submit({'n': i})
+    wait_until(lambda: writer.calls > 0)
+    spool.stop(timeout=0.1)
+    assert writer.items == []
+
+    writer = Recorder()
+    spool = make_spool(tmp_path, writer)
+    spool.start()
+    try:
+        wait_until(lambda: len(writer.items) == 10)
+    finally:
+        spool.stop(timeout=1)
+    assert writer.items == [{'n': i} for i in range(10)]
+
+
+def test_resumes_from_the_checkpoint(tmp_path):
+    writer = Recorder(fail_after=1)
+    spool = make_spool(tmp_path, writer, batch_size=4)
+    spool.start()
+    spool.submit_many([{'n': i} for i in range(10)])
+    wait_until(lambda: writer.calls > 1)
+    spool.stop(timeout=0.1)
+    assert writer.items == [{'n': i} for i in range(4)]
+
+    writer = Recorder()
+    spool = make_spool(tmp_path, writer, batch_size=4)
+    spool.start()
+    try:
+        wait_until(lambda: len(writer.items) == 6)
+    finally:
+        spool.stop(timeout=1)
+    # Items replayed before the restart are not delivered again
+    assert writer.items == [{'n': i} for i in range(4, 10)]
+
+
+def fill_and_stop(directory, count):
+    """Leave ``count`` unreplayed items in one segment; return its path and record offsets."""
+    writer = Recorder()
+    writer.failing.set()
+    spool = make_spool(directory, writer)
+    spool.start()
+    spool.submit_many([{'n': i} for i in range(count)])
+    wait_until(lambda: writer.calls > 0)
+    spool.stop(timeout=0.1)
+    (path,) = segments(directory)
+    with open(path, 'rb') as f:
+        data = f.read()
+    offsets, offset = [], 0
+    while offset < len(data):
+        offsets.append(offset)
+        length = _HEADER.unpack_from(data, offset)[0]
+        offset += _HEADER.size + length
+    return path, offsets
+
+
+def replay(directory, count):
+    writer = Recorder()
+    spool = make_spool(directory, writer)
+    spool.start()
+    try:
+        wait_until(lambda: len(writer.items) == count and spool.stats()['corrupt_records'] == 1)
+        wait_until(lambda: not os.path.exists(os.path.join(spool._slot, _segment_name(1))))
+        spool.submit({'n': 'after'})
+        wait_until(lambda: len(writer.items) == count + 1)
+    finally:
+        spool.stop(timeout=1)
+    return writer.items, spool.stats()
+
+
+def test_truncated_segment_replays_complete_records(tmp_path):
+    path, offsets = fill_and_stop(tmp_path, 5)
+    with open(path, 'r+b') as f:
+        f.truncate(offsets[3] + _HEADER.size + 2)
+
+    items, stats = replay(tmp_path, 3)
+    assert items == [{'n': 0}, {'n': 1}, {'n': 2}, {'n': 'after'}]
+    assert stats['disk_bytes'] == 0
+
+
+def test_corrupt_record_skips_the_rest_of_its_segment(tmp_path):
+    path, offsets = fill_and_stop(tmp_path, 5)
+    with open(path, 'r+b') as f:
+        f.seek(offsets[2] + _HEADER.size)
+        byte = f.read(1)
+        f.seek(offsets[2] + _HEADER.size)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    items, stats = replay(tmp_path, 2)
+    assert items == [{'n': 0}, {'n': 1}, {'n': 'after'}]
+    assert stats['disk_bytes'] == 0
+
+
+def test_unreadable_checkpoint_replays_from_the_start(tmp_path):
+    fill_and_stop(tmp_path, 3)
+    with open(os.path.join(tmp_path, 'slot-0', 'checkpoint'), 'w') as f:
+        f.write('{not json')
+
+    writer = Recorder()
+    spool = make_spool(tmp_path, writer)
+    spool.start()
+    try:
+        wait_until(lambda: len(writer.items) == 3)
+    finally:
+        spool.stop(timeout=1)
+    assert writer.items == [{'n': 0}, {'n': 1}, {'n': 2}]
+
+
+def test_refused_items_go_to_the_dead_letter_file(tmp_path):
+    def write_batch(items):
+        if any(item.get('bad') for item in items):
+            raise ValueError('constraint violation')
+        delivered.extend(items)
+
+    delivered = []
+    spool = make_spool(tmp_path, write_batch, max_retries=2, health_check=lambda: None)
+    spool.start()
+    try:
+        spool.submit_many([{'n': 0}, {'n': 1, 'bad': True}, {'n': 2}])
+        wait_until(lambda: spool.stats()['dead_lettered'] == 1)
+    finally:
+        spool.stop(timeout=1)
+    assert delivered == [{'n': 0}, {'n': 2}]
+    with open(os.path.join(tmp_path, 'slot-0', 'dead-letter.jsonl')) as f:
+        assert '"bad": true' in f.read()
+
+
+def test_unserializable_item_does_not_fail_the_batch(tmp_path):
+    writer = Recorder()
+    spool = make_spool(tmp_path, writer)
+    spool.start()
+    try:
+        assert spool.submit_many([{'n': 0}, {'blob': b'\x00\x01'}, {'n': 2}]) == 3
+        with pytest.raises(TypeError):
+            spool.submit({'blob': b'\x00'})
+        wait_until(lambda: len(writer.items) == 2)
+    finally:
+        spool.stop(timeout=1)
+    assert writer.items == [{'n': 0}, {'n': 2}]
+    assert spool.stats()['invalid'] == 1
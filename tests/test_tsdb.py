@@ -0,0 +1,186 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import tsdb
+from tsdb import TimeSeriesStore, decode_chunk, encode_chunk, read_header, series_of
+
+
+def roundtrip(ids, times, values):
+    ids = np.asarray(ids, dtype=np.int64)
+    times = np.asarray(times, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    chunk = encode_chunk(ids, times, values)
+    header, end = read_header(chunk, 0)
+    assert end == len(chunk)
+    got_ids, got_times, got_values = decode_chunk(chunk, 0, header)
+    np.testing.assert_array_equal(got_ids, ids)
+    np.testing.assert_array_equal(got_times, times)
+    # Compare bit patterns so NaN and -0.0 count too
+    np.testing.assert_array_equal(got_values.view(np.uint64), values.view(np.uint64))
+    return chunk
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 512])
+def test_steady_series_roundtrip(count):
+    ids = np.arange(100, 100 + count)
+    times = 1_700_000_000_000 + 5000 * np.arange(count)
+    roundtrip(ids, times, np.full(count, 42.5))
+
+
+def test_random_series_roundtrip():
+    rng = np.random.default_rng(7)
+    count = 1000
+    ids = np.cumsum(rng.integers(1, 10_000_000_000, count))
+    times = 1_700_000_000_000 + np.cumsum(rng.integers(-5000, 90_000_000, count))
+    roundtrip(ids, times, rng.normal(0, 1e6, count))
+
+
+def test_special_values_roundtrip():
+    values = [0.0, -0.0, float('nan'), float('inf'), -float('inf'), 1e-300, -1e300, 5e-324]
+    roundtrip(np.arange(len(values)), np.arange(len(values)) * 1000, values)
+
+
+def test_steady_times_and_repeated_values_take_no_column_space():
+    steady = roundtrip(np.arange(512), np.arange(512) * 5000, np.full(512, 1.0))
+    # Only the id deltas (1 byte each) remain after the header
+    assert len(steady) == tsdb._HEADER.size + 511
+
+
+def test_header_summarizes_the_chunk():
+    times = [3000, 1000, 2000]
+    chunk = encode_chunk(np.array([5, 9, 7]), np.array(times), np.array([1.0, 2.0, 3.0]))
+    header, _ = read_header(chunk, 0)
+    assert header[1] == 3
+    assert (header[2], header[3]) == (5, 9)
+    assert (header[5], header[6]) == (1000, 3000)
+
+
+def test_read_header_rejects_bad_magic_and_short_buffers():
+    chunk = encode_chunk(np.arange(3), np.arange(3), np.arange(3, dtype=np.float64))
+    assert read_header(b'XXXX' + chunk[4:], 0) is None
+    assert read_header(chunk[:tsdb._HEADER.size - 1], 0) is None
+    assert read_header(chunk, len(chunk)) is None
+
+
+def test_series_of_strips_the_generation():
+    assert series_of('c1/cpu_percent@3.ts') == 'c1/cpu_percent.ts'
+    assert series_of('c1/cpu_percent.ts') == 'c1/cpu_percent.ts'
+
+
+class Table:
+    """Stand-in for the metrics table, tailed by id."""
+
+    def __init__(self):
+        self.rows = []
+
+    def add(self, client_id, timestamp, cpu):
+        self.rows.append((len(self.rows) + 1, {'client_id': client_id, 'timestamp': timestamp.isoformat(),
+                                               'cpu_percent': cpu}))
+
+    def load_after(self, after_id, limit):
+        return [row for row in self.rows if row[0] > after_id][:limit]
+
+
+def make_store(root, table, **kwargs):
+    kwargs.setdefault('chunk_points', 10)
+    kwargs.setdefault('lookback', 0)
+    return TimeSeriesStore(str(root), table.load_after, **kwargs)
+
+
+def sync_all(store):
+    while not store.sync():
+        pass
+    store.flush()
+
+
+NOW = datetime.utcnow().replace(microsecond=0)
+
+
+def read_cpu(store, client_id=None, start=NOW - timedelta(days=60), end=NOW + timedelta(days=1)):
+    series, through_id = store.read(['cpu_percent'], start, end, client_id=client_id)
+    times, values = series['cpu_percent']
+    return times, values.tolist(), through_id
+
+
+def test_store_reads_back_what_it_wrote(tmp_path):
+    table = Table()
+    for i in range(25):
+        table.add('a', NOW - timedelta(minutes=25 - i), float(i))
+        table.add('b/x', NOW - timedelta(minutes=25 - i), 100.0 + i)
+    store = make_store(tmp_path, table)
+    sync_all(store)
+
+    _, values, through_id = read_cpu(store, 'a')
+    assert values == [float(i) for i in range(25)]
+    assert through_id == 50
+    _, values, _ = read_cpu(store, 'b/x', start=NOW - timedelta(minutes=10))
+    assert values == [100.0 + i for i in range(15, 25)]
+    times, values, _ = read_cpu(store)
+    assert len(values) == 50 and (np.diff(times) >= 0).all()
+    store.stop()
+
+
+def test_store_resumes_from_its_manifest(tmp_path):
+    table = Table()
+    for i in range(15):
+        table.add('a', NOW - timedelta(minutes=30 - i), float(i))
+    store = make_store(tmp_path, table)
+    sync_all(store)
+    store.stop()
+
+    for i in range(15, 30):
+        table.add('a', NOW - timedelta(minutes=30 - i), float(i))
+    store = make_store(tmp_path, table)
+    sync_all(store)
+    _, values, through_id = read_cpu(store, 'a')
+    assert values == [float(i) for i in range(30)]
+    assert through_id == 30
+    store.stop()
+
+
+def test_reader_stops_at_a_corrupt_chunk(tmp_path):
+    table = Table()
+    for i in range(30):
+        table.add('a', NOW - timedelta(minutes=30 - i), float(i))
+    store = make_store(tmp_path, table)
+    sync_all(store)
+    store.stop()
+
+    with open(os.path.join(tmp_path, 'manifest.json')) as f:
+        (path,) = json.load(f)['series']
+    with open(os.path.join(tmp_path, path), 'r+b') as f:
+        data = f.read()
+        _, second = read_header(data, 0)
+        f.seek(second)
+        f.write(b'JUNK')
+
+    reader = make_store(tmp_path, table)
+    _, values, _ = read_cpu(reader, 'a')
+    assert values == [float(i) for i in range(10)]
+    reader.stop()
+
+
+def test_prune_drops_expired_chunks_and_reads_clamp(tmp_path):
+    table = Table()
+    for i in range(20):
+        table.add('a', NOW - timedelta(days=10, minutes=-i), float(i))
+    for i in range(20, 30):
+        table.add('a', NOW - timedelta(minutes=30 - i), float(i))
+    store = make_store(tmp_path, table, retention_days=3)
+    sync_all(store)
+    _, values, _ = read_cpu(store, 'a')
+    assert values == [float(i) for i in range(20, 30)]
+
+    assert store.prune() == 0  # sync() already pruned the first pass
+    assert sorted(os.listdir(tmp_path / 'a')) == ['cpu_percent@1.ts']
+    assert store.stats()['chunks_pruned'] == 2
+
+    reader = make_store(tmp_path, table)
+    _, values, _ = read_cpu(reader, 'a')
+    assert values == [float(i) for i in range(20, 30)]
+    reader.stop()
+    store.stop()
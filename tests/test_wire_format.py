@@ -0,0 +1,147 @@
+import zlib
+import struct
+
+import pytest
+
+from wire_format import (MSGPACK_CONTENT_TYPES, STRUCT_CONTENT_TYPE, PayloadTooLarge, UnsupportedFormat,
+                         WireFormatError, _RECORD, decode_body, decode_sample, decode_samples, encode_body,
+                         encode_samples)
+
+SAMPLE = {
+    'client_id': 'host-1',
+    'client_name': 'Büro PC',
+    'timestamp': '2024-05-01T12:30:15.250',
+    'cpu_percent': 12.5,
+    'gpu_percent': 3.25,
+    'ram': {'used_gb': 7.5, 'total_gb': 16.0, 'percent': 46.875},
+    'ping_ms': 21.0,
+    'internet_connected': True,
+}
+
+
+# ---------- struct records ----------
+def test_struct_roundtrip():
+    body = encode_samples([SAMPLE, SAMPLE], STRUCT_CONTENT_TYPE)
+    assert decode_samples(body, STRUCT_CONTENT_TYPE) == [SAMPLE, SAMPLE]
+
+
+def test_struct_leaves_out_fields_not_sent():
+    sample = {'client_id': 'host-2', 'cpu_percent': 50.0, 'ram': {'percent': 10.0}, 'internet_connected': False}
+    (decoded,) = decode_samples(encode_samples([sample], STRUCT_CONTENT_TYPE), STRUCT_CONTENT_TYPE)
+    assert decoded == {'client_id': 'host-2', 'cpu_percent': 50.0, 'internet_connected': False,
+                       'ram': {'used_gb': None, 'total_gb': None, 'percent': 10.0}}
+
+
+def test_struct_single_sample():
+    body = encode_samples([SAMPLE], STRUCT_CONTENT_TYPE)
+    assert decode_sample(body, STRUCT_CONTENT_TYPE) == SAMPLE
+    with pytest.raises(WireFormatError, match='Expected one sample'):
+        decode_sample(body + body, STRUCT_CONTENT_TYPE)
+
+
+@pytest.mark.parametrize('cut', [1, _RECORD.size - 1, _RECORD.size + 1, _RECORD.size + 3])
+def test_struct_rejects_truncated_records(cut):
+    body = encode_samples([SAMPLE], STRUCT_CONTENT_TYPE)
+    with pytest.raises(WireFormatError, match='Truncated or corrupt'):
+        decode_samples(body[:len(body) - cut], STRUCT_CONTENT_TYPE)
+
+
+def test_struct_rejects_unknown_version():
+    body = bytearray(encode_samples([SAMPLE], STRUCT_CONTENT_TYPE))
+    body[0] = 9
+    with pytest.raises(WireFormatError, match='Unsupported record version 9'):
+        decode_samples(bytes(body), STRUCT_CONTENT_TYPE)
+
+
+def test_struct_rejects_invalid_utf8():
+    body = _RECORD.pack(1, 0, float('nan'), *[float('nan')] * 6) + struct.pack('<H', 2) + b'\xff\xfe' + b'\0\0'
+    with pytest.raises(WireFormatError):
+        decode_samples(body, STRUCT_CONTENT_TYPE)
+
+
+def test_struct_rejects_out_of_range_timestamp():
+    body = _RECORD.pack(1, 0, 1e300, *[float('nan')] * 6) + b'\0\0\0\0'
+    with pytest.raises(WireFormatError, match='out of range'):
+        decode_samples(body, STRUCT_CONTENT_TYPE)
+
+
+# ---------- MessagePack ----------
+@pytest.mark.parametrize('content_type', MSGPACK_CONTENT_TYPES)
+def test_msgpack_roundtrip(content_type):
+    pytest.importorskip('msgpack')
+    assert decode_samples(encode_samples([SAMPLE], content_type), content_type) == [SAMPLE]
+    assert decode_sample(encode_samples(SAMPLE, content_type), content_type) == SAMPLE
+
+
+def test_msgpack_rejects_malformed_bodies():
+    msgpack = pytest.importorskip('msgpack')
+    content_type = MSGPACK_CONTENT_TYPES[0]
+    with pytest.raises(WireFormatError, match='Invalid MessagePack'):
+        decode_samples(b'\xc1', content_type)
+    with pytest.raises(WireFormatError, match='Invalid MessagePack'):
+        decode_samples(msgpack.packb(SAMPLE)[:-3], content_type)
+    with pytest.raises(WireFormatError, match='Invalid MessagePack'):
+        decode_samples(msgpack.packb({1: 'non-string key'}), content_type)
+
+
+# ---------- JSON and content types ----------
+def test_json_single_sample():
+    assert decode_sample(b'{"cpu_percent": 1.5}', 'application/json') == {'cpu_percent': 1.5}
+    assert decode_sample(b'', 'application/json') is None
+    with pytest.raises(WireFormatError, match='Invalid JSON'):
+        decode_sample(b'{"cpu_percent": ', 'application/json')
+
+
+def test_unknown_content_type_is_unsupported():
+    with pytest.raises(UnsupportedFormat) as excinfo:
+        decode_samples(b'cpu=1', 'text/plain')
+    assert excinfo.value.status == 415
+
+
+# ---------- compression ----------
+BODY = encode_samples([SAMPLE] * 50, STRUCT_CONTENT_TYPE)
+
+
+@pytest.mark.parametrize('encoding', [None, 'identity', 'gzip'])
+def test_body_roundtrip(encoding):
+    assert decode_body(encode_body(BODY, encoding), encoding, len(BODY)) == BODY
+
+
+def test_deflate_body():
+    assert decode_body(zlib.compress(BODY), 'deflate', len(BODY)) == BODY
+
+
+def test_zstd_body_roundtrip():
+    pytest.importorskip('zstandard')
+    assert decode_body(encode_body(BODY, 'zstd'), 'zstd', len(BODY)) == BODY
+
+
+def test_zstd_body_without_content_size():
+    zstandard = pytest.importorskip('zstandard')
+    body = zstandard.ZstdCompressor(write_content_size=False).compress(BODY)
+    assert decode_body(body, 'zstd', len(BODY)) == BODY
+    with pytest.raises(PayloadTooLarge):
+        decode_body(body, 'zstd', len(BODY) - 1)
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_compressed_body_past_the_limit_is_too_large(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    with pytest.raises(PayloadTooLarge) as excinfo:
+        decode_body(encode_body(BODY, encoding), encoding, len(BODY) - 1)
+    assert excinfo.value.status == 413
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate', 'zstd'])
+def test_corrupt_compressed_body_is_rejected(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    with pytest.raises(WireFormatError) as excinfo:
+        decode_body(b'\x28\xb5\x2f\xfd' + b'not compressed at all', encoding, 1024)
+    assert excinfo.value.status == 400
+
+
+def test_unknown_encoding_is_unsupported():
+    with pytest.raises(UnsupportedFormat):
+        decode_body(BODY, 'br', len(BODY))
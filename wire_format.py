@@ -0,0 +1,226 @@
+"""Compact alternatives to JSON for agent uploads, negotiated by Content-Type.
+
+``application/msgpack`` carries the same object (or, for batches, array of
+objects) as the JSON API, MessagePack-encoded. ``application/x-metrics-struct``
+is a fixed little-endian record layout, one record per sample::
+
+    B   version (1)
+    B   flags: bit 0 = internet_connected known, bit 1 = internet_connected
+    d   timestamp, seconds since the Unix epoch (NaN = not sent)
+    6f  cpu_percent, gpu_percent, ram used_gb, ram total_gb, ram percent, ping_ms (NaN = not sent)
+    H   length of client_id in bytes, followed by the UTF-8 bytes
+    H   length of client_name in bytes, followed by the UTF-8 bytes
+
+Any body, JSON included, may be compressed with Content-Encoding gzip or
+(when the zstandard package is installed) zstd.
+"""
+import io
+import json
+import zlib
+import struct
+import threading
+from datetime import datetime, timedelta, timezone
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+STRUCT_CONTENT_TYPE = 'application/x-metrics-struct'
+BINARY_CONTENT_TYPES = MSGPACK_CONTENT_TYPES + (STRUCT_CONTENT_TYPE,)
+
+STRUCT_VERSION = 1
+_RECORD = struct.Struct('<BBd6f')
+_LENGTH = struct.Struct('<H')
+_NAN = float('nan')
+_EPOCH = datetime(1970, 1, 1)
+# Creating a zstd context costs more than decoding a small body; keep one per thread.
+_zstd_contexts = threading.local()
+
+
+class WireFormatError(ValueError):
+    """A body that cannot be decoded; ``status`` is the HTTP status to answer with."""
+    status = 400
+
+
+class UnsupportedFormat(WireFormatError):
+    """Content-Type or Content-Encoding this server cannot decode."""
+    status = 415
+
+
+class PayloadTooLarge(WireFormatError):
+    """A body that decompresses to more than the allowed size."""
+    status = 413
+
+
+# ---------- compression ----------
+def decode_body(body, content_encoding, max_size):
+    """Undo Content-Encoding, refusing bodies that inflate past ``max_size`` bytes."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    if encoding in ('gzip', 'x-gzip', 'deflate'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS if encoding != 'deflate' else zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(body, max_size + 1)
+        except zlib.error as e:
+            raise WireFormatError(f"Invalid {encoding} body: {str(e)}")
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedFormat("zstd bodies require the zstandard package")
+        try:
+            decompressor = getattr(_zstd_contexts, 'decompressor', None)
+            if decompressor is None:
+                decompressor = _zstd_contexts.decompressor = zstandard.ZstdDecompressor()
+            size = zstandard.frame_content_size(body)
+            if size > max_size:
+                raise PayloadTooLarge(f"Body decompresses to more than {max_size} bytes")
+            if size >= 0:
+                data = decompressor.decompress(body)
+            else:  # size not recorded in the frame header
+                data = decompressor.stream_reader(io.BytesIO(body)).read(max_size + 1)
+        except zstandard.ZstdError as e:
+            raise WireFormatError(f"Invalid zstd body: {str(e)}")
+    else:
+        raise UnsupportedFormat(f"Unsupported Content-Encoding '{content_encoding}'")
+    if len(data) > max_size:
+        raise PayloadTooLarge(f"Body decompresses to more than {max_size} bytes")
+    return data
+
+
+def encode_body(body, content_encoding):
+    """Apply Content-Encoding (for agents and benchmarks)."""
+    if not content_encoding or content_encoding == 'identity':
+        return body
+    if content_encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if content_encoding == 'zstd':
+        if zstandard is None:
+            raise UnsupportedFormat("zstd bodies require the zstandard package")
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    raise UnsupportedFormat(f"Unsupported Content-Encoding '{content_encoding}'")
+
+
+# ---------- samples ----------
+def decode_samples(body, content_type):
+    """Decode a binary body into a list of sample dicts shaped like the JSON API's."""
+    if content_type in MSGPACK_CONTENT_TYPES:
+        payload = _unpack_msgpack(body)
+        return payload if isinstance(payload, list) else [payload]
+    if content_type == STRUCT_CONTENT_TYPE:
+        return _unpack_records(body)
+    raise UnsupportedFormat(f"Unsupported Content-Type '{content_type}'")
+
+
+def decode_sample(body, content_type):
+    """Decode a single-sample body (JSON or binary) into a dict."""
+    if content_type not in BINARY_CONTENT_TYPES:
+        try:
+            return json.loads(body) if body else None
+        except ValueError as e:
+            raise WireFormatError(f"Invalid JSON: {str(e)}")
+    samples = decode_samples(body, content_type)
+    if len(samples) != 1:
+        raise WireFormatError(f"Expected one sample, got {len(samples)}")
+    return samples[0]
+
+
+def encode_samples(samples, content_type):
+    """Encode sample dicts for ``content_type`` (for agents and benchmarks)."""
+    if content_type in MSGPACK_CONTENT_TYPES:
+        if msgpack is None:
+            raise UnsupportedFormat("MessagePack bodies require the msgpack package")
+        return msgpack.packb(samples, use_bin_type=True)
+    if content_type == STRUCT_CONTENT_TYPE:
+        return b''.join(_pack_record(sample) for sample in samples)
+    return json.dumps(samples).encode('utf-8')
+
+
+def _unpack_msgpack(body):
+    if msgpack is None:
+        raise UnsupportedFormat("MessagePack bodies require the msgpack package")
+    try:
+        return msgpack.unpackb(body, raw=False, strict_map_key=True)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise WireFormatError(f"Invalid MessagePack body: {str(e)}")
+
+
+def _pack_record(sample):
+    ram = sample.get('ram') or {}
+    connected = sample.get('internet_connected')
+    flags = 0 if connected is None else (1 | (2 if connected else 0))
+    epoch = _NAN
+    if sample.get('timestamp'):
+        moment = datetime.fromisoformat(sample['timestamp'])
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        epoch = moment.timestamp()
+    values = [sample.get('cpu_percent'), sample.get('gpu_percent'), ram.get('used_gb'),
+              ram.get('total_gb'), ram.get('percent'), sample.get('ping_ms')]
+    client_id = (sample.get('client_id') or '').encode('utf-8')
+    client_name = (sample.get('client_name') or '').encode('utf-8')
+    return b''.join((
+        _RECORD.pack(STRUCT_VERSION, flags, epoch, *(_NAN if v is None else v for v in values)),
+        _LENGTH.pack(len(client_id)), client_id,
+        _LENGTH.pack(len(client_name)), client_name,
+    ))
+
+
+def _unpack_records(body):
+    samples = []
+    offset = 0
+    end = len(body)
+    unpack_record = _RECORD.unpack_from
+    unpack_length = _LENGTH.unpack_from
+    try:
+        while offset < end:
+            version, flags, epoch, cpu, gpu, used, total, percent, ping = unpack_record(body, offset)
+            if version != STRUCT_VERSION:
+                raise WireFormatError(f"Unsupported record version {version} at byte {offset}")
+            offset += _RECORD.size
+            texts = []
+            for _ in range(2):
+                (length,) = unpack_length(body, offset)
+                offset += _LENGTH.size
+                if offset + length > end:
+                    raise struct.error(f"string of {length} bytes runs past the end of the body")
+                texts.append(body[offset:offset + length].decode('utf-8'))
+                offset += length
+
+            # NaN marks a field the agent did not send (NaN != NaN).
+            sample = {}
+            if texts[0]:
+                sample['client_id'] = texts[0]
+            if texts[1]:
+                sample['client_name'] = texts[1]
+            if epoch == epoch:
+                try:
+                    moment = _EPOCH + timedelta(seconds=epoch)
+                except OverflowError:
+                    raise WireFormatError(f"Timestamp {epoch} out of range at byte {offset}")
+                sample['timestamp'] = moment.isoformat(timespec='milliseconds')
+            if cpu == cpu:
+                sample['cpu_percent'] = round(cpu, 3)
+            if gpu == gpu:
+                sample['gpu_percent'] = round(gpu, 3)
+            if used == used or total == total or percent == percent:
+                sample['ram'] = {
+                    'used_gb': round(used, 3) if used == used else None,
+                    'total_gb': round(total, 3) if total == total else None,
+                    'percent': round(percent, 3) if percent == percent else None,
+                }
+            if ping == ping:
+                sample['ping_ms'] = round(ping, 3)
+            if flags & 1:
+                sample['internet_connected'] = bool(flags & 2)
+            samples.append(sample)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise WireFormatError(f"Truncated or corrupt record at byte {offset}: {str(e)}")
+    return samples